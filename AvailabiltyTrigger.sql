@@ -1,5 +1,19 @@
+-- Keeps books.available in step with books.quantity for every write,
+-- including ones made outside the application. Installed by migration 0003.
 DELIMITER $$
 
+CREATE TRIGGER update_availability_before_insert
+BEFORE INSERT ON books
+FOR EACH ROW
+BEGIN
+    -- New books are available only if they have copies
+    IF NEW.quantity > 0 THEN
+        SET NEW.available = TRUE;
+    ELSE
+        SET NEW.available = FALSE;
+    END IF;
+END$$
+
 CREATE TRIGGER update_availability_before_update
 BEFORE UPDATE ON books
 FOR EACH ROW
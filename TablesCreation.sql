@@ -1,9 +1,16 @@
+-- Schema matching backend/models.py. Existing databases are upgraded with
+-- `flask --app app db-upgrade` (backend/migrations) instead of this script.
+
 -- Create the Users table
 CREATE TABLE Users (
     id INT AUTO_INCREMENT PRIMARY KEY,
     username VARCHAR(50) NOT NULL UNIQUE,
     password VARCHAR(255) NOT NULL,
-    role ENUM('member', 'librarian') NOT NULL
+    role ENUM('member', 'librarian') NOT NULL,
+    email VARCHAR(120) NOT NULL UNIQUE,
+    name VARCHAR(100),
+    last_name VARCHAR(100),
+    active_loans INT NOT NULL DEFAULT 0  -- Open loans, maintained by backend/inventory.py
 );
 
 -- Create the Books table
@@ -11,7 +18,12 @@ CREATE TABLE Books (
     id INT AUTO_INCREMENT PRIMARY KEY,
     title VARCHAR(100) NOT NULL,
     author VARCHAR(100) NOT NULL,
-    available BOOLEAN DEFAULT TRUE
+    available BOOLEAN DEFAULT TRUE,
+    quantity INT DEFAULT 0,
+    image_url VARCHAR(255) NULL,
+    active_loans INT NOT NULL DEFAULT 0,  -- Open loans, maintained by backend/inventory.py
+    INDEX ix_books_title (title),   -- Title prefix search, (title, id) keyset pages
+    INDEX ix_books_author (author)  -- Author prefix filter
 );
 
 -- Create the Loans table
@@ -20,7 +32,110 @@ CREATE TABLE Loans (
     user_id INT NOT NULL,
     book_id INT NOT NULL,
     loan_date DATE NOT NULL,
+    title VARCHAR(100) NOT NULL,
     return_date DATE NOT NULL,
+    date_returned DATETIME NULL,
+    active_key SMALLINT NULL,  -- 1 while the loan is open, NULL once returned
+    fine_cents INT NOT NULL DEFAULT 0,  -- As of the last overdue scan
+    FOREIGN KEY (user_id) REFERENCES Users(id) ON DELETE CASCADE,
+    FOREIGN KEY (book_id) REFERENCES Books(id) ON DELETE CASCADE,
+    INDEX ix_loans_user_book_returned (user_id, book_id, date_returned),  -- Active loan check in borrow
+    INDEX ix_loans_user_loan_date (user_id, loan_date, id),               -- User loan history, newest first
+    INDEX ix_loans_book_returned (book_id, date_returned),                -- Active loans of a book
+    INDEX ix_loans_open_due (date_returned, return_date, id),             -- Overdue scan
+    INDEX ix_loans_loan_date (loan_date),                                 -- Analytics rebuild by day range
+    UNIQUE INDEX uq_loans_one_active (user_id, book_id, active_key)       -- At most one open loan per (user, book)
+);
+
+-- Per-table version counters used for ETag / Last-Modified on the read endpoints
+CREATE TABLE Table_Versions (
+    name VARCHAR(50) PRIMARY KEY,
+    version BIGINT NOT NULL DEFAULT 0,
+    updated_at DATETIME NULL
+);
+
+-- Reminder notifications written by batch jobs, drained by a mailer
+CREATE TABLE Notifications (
+    id INT AUTO_INCREMENT PRIMARY KEY,
+    user_id INT NOT NULL,
+    loan_id INT NULL,
+    kind VARCHAR(50) NOT NULL,
+    payload TEXT NOT NULL,
+    created_at DATETIME NOT NULL,
+    sent_at DATETIME NULL,
+    FOREIGN KEY (user_id) REFERENCES Users(id) ON DELETE CASCADE,
+    FOREIGN KEY (loan_id) REFERENCES Loans(id) ON DELETE CASCADE,
+    UNIQUE INDEX uq_notifications_loan_kind (loan_id, kind),  -- One reminder per loan and level
+    INDEX ix_notifications_unsent (sent_at, id)
+);
+
+-- Resume point and lease of each batch job
+CREATE TABLE Job_Checkpoints (
+    name VARCHAR(50) PRIMARY KEY,
+    status VARCHAR(20) NOT NULL DEFAULT 'done',
+    as_of DATE NULL,
+    position VARCHAR(255) NULL,
+    processed BIGINT NOT NULL DEFAULT 0,
+    locked_until DATETIME NULL,
+    updated_at DATETIME NULL
+);
+
+-- Daily loan rollups behind the analytics endpoints, kept by backend/analytics.py.
+-- No foreign keys: rows of deleted books and users are dropped by the next rebuild of their days
+CREATE TABLE Book_Daily_Loans (
+    day DATE NOT NULL,
+    book_id INT NOT NULL,
+    borrows INT NOT NULL DEFAULT 0,
+    returns INT NOT NULL DEFAULT 0,
+    PRIMARY KEY (day, book_id)
+);
+
+CREATE TABLE User_Daily_Loans (
+    day DATE NOT NULL,
+    user_id INT NOT NULL,
+    borrows INT NOT NULL DEFAULT 0,
+    returns INT NOT NULL DEFAULT 0,
+    PRIMARY KEY (day, user_id)
+);
+
+-- Members waiting for a book with no copy on the shelf, kept by backend/holds.py
+CREATE TABLE Holds (
+    id INT AUTO_INCREMENT PRIMARY KEY,
+    user_id INT NOT NULL,
+    book_id INT NOT NULL,
+    status VARCHAR(20) NOT NULL DEFAULT 'waiting',  -- waiting, ready, fulfilled, cancelled, expired
+    active_key SMALLINT NULL,  -- 1 while waiting or ready, NULL once closed
+    created_at DATETIME NOT NULL,
+    ready_at DATETIME NULL,
+    expires_at DATETIME NULL,  -- Pickup deadline of a ready hold
+    closed_at DATETIME NULL,
     FOREIGN KEY (user_id) REFERENCES Users(id) ON DELETE CASCADE,
-    FOREIGN KEY (book_id) REFERENCES Books(id) ON DELETE CASCADE
+    FOREIGN KEY (book_id) REFERENCES Books(id) ON DELETE CASCADE,
+    INDEX ix_holds_book_queue (book_id, status, id),            -- Head of a book's queue and queue positions
+    INDEX ix_holds_status_expires (status, expires_at),         -- Expiry sweep
+    UNIQUE INDEX uq_holds_one_active (user_id, book_id, active_key)  -- At most one open hold per (user, book)
+);
+
+-- Token ids revoked by logout, until the token would have expired anyway
+CREATE TABLE Revoked_Tokens (
+    jti VARCHAR(64) PRIMARY KEY,
+    expires_at DATETIME NOT NULL,
+    INDEX ix_revoked_tokens_expires_at (expires_at)
 );
+
+-- Applied schema migrations; a database created from this script is at 0008
+CREATE TABLE Schema_Migrations (
+    version VARCHAR(20) PRIMARY KEY,
+    name VARCHAR(100) NOT NULL,
+    applied_at DATETIME NOT NULL
+);
+
+INSERT INTO Schema_Migrations (version, name, applied_at) VALUES
+('0001', 'baseline', NOW()),
+('0002', 'hot_path_indexes', NOW()),
+('0003', 'availability_triggers', NOW()),
+('0004', 'active_loan_counters', NOW()),
+('0005', 'overdue_scan', NOW()),
+('0006', 'loan_analytics', NOW()),
+('0007', 'holds', NOW()),
+('0008', 'revoked_tokens', NOW());
@@ -1,20 +1,26 @@
 -- Insert test data into Users table
-INSERT INTO Users (username, password, role) VALUES
-('john_doe', 'hashed_password1', 'member'),
-('jane_smith', 'hashed_password2', 'librarian'),
-('alice_wonder', 'hashed_password3', 'member'),
-('bob_builder', 'hashed_password4', 'member');
+INSERT INTO Users (username, password, role, email, active_loans) VALUES
+('john_doe', 'hashed_password1', 'member', 'john_doe@example.com', 1),
+('jane_smith', 'hashed_password2', 'librarian', 'jane_smith@example.com', 0),
+('alice_wonder', 'hashed_password3', 'member', 'alice_wonder@example.com', 1),
+('bob_builder', 'hashed_password4', 'member', 'bob_builder@example.com', 1);
 
 -- Insert test data into Books table
-INSERT INTO Books (title, author, available) VALUES
-('The Great Gatsby', 'F. Scott Fitzgerald', TRUE),
-('To Kill a Mockingbird', 'Harper Lee', TRUE),
-('1984', 'George Orwell', FALSE),
-('Moby Dick', 'Herman Melville', TRUE),
-('War and Peace', 'Leo Tolstoy', FALSE);
+INSERT INTO Books (title, author, available, quantity, active_loans) VALUES
+('The Great Gatsby', 'F. Scott Fitzgerald', TRUE, 3, 0),
+('To Kill a Mockingbird', 'Harper Lee', TRUE, 2, 1),
+('1984', 'George Orwell', FALSE, 0, 1),
+('Moby Dick', 'Herman Melville', TRUE, 1, 0),
+('War and Peace', 'Leo Tolstoy', FALSE, 0, 1);
 
 -- Insert test data into Loans table
-INSERT INTO Loans (user_id, book_id, loan_date, return_date) VALUES
-(1, 3, '2024-12-28', '2025-01-10'),  -- John borrowed 1984
-(3, 5, '2024-12-29', '2025-01-12'),  -- Alice borrowed War and Peace
-(4, 2, '2024-12-30', '2025-01-15');  -- Bob borrowed To Kill a Mockingbird
+-- Open loans have active_key = 1 (see uq_loans_one_active)
+INSERT INTO Loans (user_id, book_id, title, loan_date, return_date, active_key) VALUES
+(1, 3, '1984', '2024-12-28', '2025-01-10', 1),  -- John borrowed 1984
+(3, 5, 'War and Peace', '2024-12-29', '2025-01-12', 1),  -- Alice borrowed War and Peace
+(4, 2, 'To Kill a Mockingbird', '2024-12-30', '2025-01-15', 1);  -- Bob borrowed To Kill a Mockingbird
+
+-- Initial table versions
+INSERT INTO Table_Versions (name, version, updated_at) VALUES
+('books', 1, NOW()),
+('loans', 1, NOW());
@@ -0,0 +1,311 @@
+import json
+import logging
+import time
+from collections import Counter, defaultdict
+from datetime import date, datetime, timedelta
+import click
+from flask.cli import with_appcontext
+from sqlalchemy import delete, func, insert, literal, select, union_all, update
+from sqlalchemy.exc import IntegrityError
+from db import db
+from models import Book, BookDailyLoans, Loan, User, UserDailyLoans
+import periodic
+from versioning import bump
+
+logger = logging.getLogger(__name__)
+
+# Loan analytics. Borrows and returns are counted per day in two rollup
+# tables, one keyed by book and one by user. The loan write paths in
+# inventory.py add to them in the same transaction as the loan change, so the
+# dashboard queries sum a few rows per day of the window instead of grouping
+# the loans history. rebuild() recomputes a range of days from the loans table
+# and corrects what the incremental counts cannot see: loans deleted together
+# with their book or user, and edits made outside the app.
+
+loans_table = Loan.__table__
+books_table = Book.__table__
+users_table = User.__table__
+book_daily_table = BookDailyLoans.__table__
+user_daily_table = UserDailyLoans.__table__
+
+ROLLUPS = ((book_daily_table, 'book_id'), (user_daily_table, 'user_id'))
+
+REBUILD_CHUNK_DAYS = 31  # Days per transaction
+
+
+def as_day(value):
+    """The calendar day of a date, datetime or ISO date string; None if it cannot be read."""
+    if isinstance(value, datetime):
+        return value.date()
+    if isinstance(value, date):
+        return value
+    try:
+        return date.fromisoformat(str(value)[:10])
+    except ValueError:
+        return None
+
+
+def add(table, key, key_value, day, borrows=0, returns=0):
+    """Adds to one rollup row, creating it with the first loan event of the day."""
+    where = (table.c.day == day, table.c[key] == key_value)
+    values = {'borrows': table.c.borrows + borrows, 'returns': table.c.returns + returns}
+    if db.session.execute(update(table).where(*where).values(**values)).rowcount:
+        return
+    try:
+        with db.session.begin_nested():
+            db.session.execute(insert(table).values(day=day, borrows=borrows, returns=returns, **{key: key_value}))
+    except IntegrityError:
+        # Inserted by a concurrent transaction since our UPDATE
+        db.session.execute(update(table).where(*where).values(**values))
+
+
+def count(book_id, user_id, day, borrows=0, returns=0):
+    if day is None:
+        return  # A date we could not read; the rebuild job counts it from the stored loan
+    for table, key in ROLLUPS:
+        add(table, key, book_id if key == 'book_id' else user_id, day, borrows, returns)
+
+
+def count_loan(book_id, user_id, loan_date, date_returned, sign=1):
+    """Counts a loan's borrow and, if it has been returned, its return; sign=-1 takes them back out."""
+    count(book_id, user_id, as_day(loan_date), borrows=sign)
+    if date_returned is not None:
+        count(book_id, user_id, as_day(date_returned), returns=sign)
+
+
+def count_return(book_id, user_id, returned_at):
+    count(book_id, user_id, as_day(returned_at), returns=1)
+
+
+def add_many(table, key, counts, day, column):
+    """
+    Adds counts {key value: n} to `column` ('borrows' or 'returns') of a day's
+    rollup rows with a few statements for any number of keys: one UPDATE per
+    distinct n for the rows that exist, one INSERT for the others.
+    """
+    existing = set(db.session.scalars(select(table.c[key]).where(table.c.day == day, table.c[key].in_(counts))))
+    by_amount = defaultdict(list)
+    for key_value in existing:
+        by_amount[counts[key_value]].append(key_value)
+    for amount, key_values in by_amount.items():
+        db.session.execute(
+            update(table).where(table.c.day == day, table.c[key].in_(key_values))
+            .values({column: table.c[column] + amount})
+        )
+    missing = [key_value for key_value in counts if key_value not in existing]
+    if not missing:
+        return
+    try:
+        with db.session.begin_nested():
+            db.session.execute(insert(table), [
+                {'day': day, key: key_value, 'borrows': 0, 'returns': 0, column: counts[key_value]}
+                for key_value in missing
+            ])
+    except IntegrityError:
+        # Some were inserted by a concurrent transaction since our SELECT
+        for key_value in missing:
+            add(table, key, key_value, day, **{column: counts[key_value]})
+
+
+def count_many(events, column):
+    """Counts (book_id, user_id, when) borrow or return events, with a few statements per day."""
+    by_day = defaultdict(lambda: (Counter(), Counter()))
+    for book_id, user_id, when in events:
+        day = as_day(when)
+        if day is not None:
+            by_day[day][0][book_id] += 1
+            by_day[day][1][user_id] += 1
+    for day, (books, users) in by_day.items():
+        add_many(book_daily_table, 'book_id', books, day, column)
+        add_many(user_daily_table, 'user_id', users, day, column)
+
+
+def daily_counts(key, start=None, end=None):
+    """SELECT day, <key>, borrows, returns grouped from the loans table, for days in [start, end]."""
+    borrowed = select(
+        loans_table.c.loan_date.label('day'), loans_table.c[key].label('key'),
+        literal(1).label('borrows'), literal(0).label('returns'),
+    )
+    returned = select(
+        func.date(loans_table.c.date_returned, type_=db.Date).label('day'), loans_table.c[key].label('key'),
+        literal(0).label('borrows'), literal(1).label('returns'),
+    ).where(loans_table.c.date_returned.isnot(None))
+    # Plain range conditions on the stored columns, so the loan_date and date_returned indexes apply
+    if start is not None:
+        borrowed = borrowed.where(loans_table.c.loan_date >= start)
+        returned = returned.where(loans_table.c.date_returned >= datetime.combine(start, datetime.min.time()))
+    if end is not None:
+        borrowed = borrowed.where(loans_table.c.loan_date <= end)
+        returned = returned.where(
+            loans_table.c.date_returned < datetime.combine(end + timedelta(days=1), datetime.min.time())
+        )
+    events = union_all(borrowed, returned).subquery()
+    return (
+        select(events.c.day, events.c.key, func.sum(events.c.borrows), func.sum(events.c.returns))
+        .group_by(events.c.day, events.c.key)
+    )
+
+
+def rebuild_days(executor, start=None, end=None):
+    """
+    Replaces the rollup rows for days in [start, end] (every day when both
+    are None) with counts from the loans table. `executor` is the session or
+    a migration's connection; the caller commits.
+    """
+    for table, key in ROLLUPS:
+        stale = delete(table)
+        if start is not None:
+            stale = stale.where(table.c.day >= start)
+        if end is not None:
+            stale = stale.where(table.c.day <= end)
+        # Deleting first locks the range: a loan committed before our SELECT is
+        # counted by it, and a concurrent count() waits and then adds to our row
+        executor.execute(stale)
+        executor.execute(insert(table).from_select(['day', key, 'borrows', 'returns'], daily_counts(key, start, end)))
+
+
+def history_bounds():
+    """The first and last day that has a loan event or a rollup row, or (None, None)."""
+    days = [
+        *db.session.execute(select(func.min(loans_table.c.loan_date), func.max(loans_table.c.loan_date))).one(),
+        *db.session.execute(select(func.min(loans_table.c.date_returned),
+                                   func.max(loans_table.c.date_returned))).one(),
+        *db.session.execute(select(func.min(book_daily_table.c.day), func.max(book_daily_table.c.day))).one(),
+        *db.session.execute(select(func.min(user_daily_table.c.day), func.max(user_daily_table.c.day))).one(),
+    ]
+    days = [as_day(day) for day in days if day is not None]
+    return (min(days), max(days)) if days else (None, None)
+
+
+def rebuild(start=None, end=None, chunk_days=REBUILD_CHUNK_DAYS):
+    """
+    Recomputes the rollups for the days in [start, end], by default the whole
+    history, one chunk of days per transaction. Returns a summary dict.
+    """
+    started = time.perf_counter()
+    first, last = history_bounds() if start is None or end is None else (start, end)
+    start = start or first
+    end = end or last
+    summary = {'from': start and start.isoformat(), 'to': end and end.isoformat(), 'days': 0}
+    if start is None or end < start:
+        return summary
+
+    day = start
+    while day <= end:
+        chunk_end = min(day + timedelta(days=chunk_days - 1), end)
+        rebuild_days(db.session, day, chunk_end)
+        db.session.commit()
+        summary['days'] += (chunk_end - day).days + 1
+        day = chunk_end + timedelta(days=1)
+    bump('analytics')
+    summary['seconds'] = round(time.perf_counter() - started, 2)
+    return summary
+
+
+# Dashboard queries; all of them read the rollups or the books counters only
+
+def popular_books(start, end, limit):
+    """Most borrowed books in [start, end]: rows of book_id, title, author, borrows."""
+    totals = (
+        select(book_daily_table.c.book_id, func.sum(book_daily_table.c.borrows).label('borrows'))
+        .where(book_daily_table.c.day.between(start, end))
+        .group_by(book_daily_table.c.book_id)
+        .having(func.sum(book_daily_table.c.borrows) > 0)
+        .order_by(func.sum(book_daily_table.c.borrows).desc(), book_daily_table.c.book_id)
+        .limit(limit)
+        .subquery()
+    )
+    return db.session.execute(
+        select(totals.c.book_id, books_table.c.title, books_table.c.author, totals.c.borrows)
+        .join(books_table, books_table.c.id == totals.c.book_id)
+        .order_by(totals.c.borrows.desc(), totals.c.book_id)
+    ).all()
+
+
+def active_borrowers(start, end, limit):
+    """
+    Returns (number of users who borrowed in [start, end], rows of user_id,
+    username, borrows for the `limit` most active of them).
+    """
+    window = (user_daily_table.c.day.between(start, end), user_daily_table.c.borrows > 0)
+    total = db.session.scalar(select(func.count(func.distinct(user_daily_table.c.user_id))).where(*window))
+    totals = (
+        select(user_daily_table.c.user_id, func.sum(user_daily_table.c.borrows).label('borrows'))
+        .where(*window)
+        .group_by(user_daily_table.c.user_id)
+        .order_by(func.sum(user_daily_table.c.borrows).desc(), user_daily_table.c.user_id)
+        .limit(limit)
+        .subquery()
+    )
+    rows = db.session.execute(
+        select(totals.c.user_id, users_table.c.username, totals.c.borrows)
+        .join(users_table, users_table.c.id == totals.c.user_id)
+        .order_by(totals.c.borrows.desc(), totals.c.user_id)
+    ).all()
+    return total, rows
+
+
+def circulation(start, end):
+    """Borrows and returns per day in [start, end], with zeros for days without loans."""
+    rows = db.session.execute(
+        select(book_daily_table.c.day, func.sum(book_daily_table.c.borrows), func.sum(book_daily_table.c.returns))
+        .where(book_daily_table.c.day.between(start, end))
+        .group_by(book_daily_table.c.day)
+    ).all()
+    by_day = {as_day(day): (borrows, returns) for day, borrows, returns in rows}
+    days = []
+    for offset in range((end - start).days + 1):
+        day = start + timedelta(days=offset)
+        borrows, returns = by_day.get(day, (0, 0))
+        days.append({'day': day.isoformat(), 'borrows': int(borrows), 'returns': int(returns)})
+    return days
+
+
+def copies_on_loan(limit):
+    """
+    Titles with the most copies out right now and the share of their copies
+    that is out, from the counters inventory.py keeps on books.
+    """
+    return db.session.execute(
+        select(
+            books_table.c.id.label('book_id'), books_table.c.title, books_table.c.author,
+            books_table.c.active_loans.label('on_loan'), books_table.c.quantity.label('on_shelf'),
+            (books_table.c.active_loans * 1.0 / (books_table.c.active_loans + books_table.c.quantity)).label('utilization'),
+        )
+        .where(books_table.c.active_loans > 0)
+        .order_by(books_table.c.active_loans.desc(), books_table.c.id)
+        .limit(limit)
+    ).all()
+
+
+def run_scheduled(app):
+    with app.app_context():
+        try:
+            days = app.config['ANALYTICS_REBUILD_DAYS']
+            today = date.today()
+            summary = rebuild(today - timedelta(days=days - 1), today)
+            logger.info('Analytics rebuild: %s', summary)
+        except Exception:
+            db.session.rollback()
+            logger.exception('Analytics rebuild failed')
+
+
+def start_scheduler(app):
+    """
+    Rebuilds the last ANALYTICS_REBUILD_DAYS days every ANALYTICS_REBUILD_INTERVAL
+    seconds in this process. Off by default: the write paths keep the rollups
+    current, so the rebuild only catches up on changes made around them.
+    """
+    return periodic.run_every(app, 'analytics-rebuild', app.config.get('ANALYTICS_REBUILD_INTERVAL', 0),
+                              run_scheduled)
+
+
+@click.command('analytics-rebuild')
+@click.option('--from', 'start', type=click.DateTime(formats=['%Y-%m-%d']), help='First day, default the oldest loan.')
+@click.option('--to', 'end', type=click.DateTime(formats=['%Y-%m-%d']), help='Last day, default the newest loan.')
+@click.option('--chunk-days', default=REBUILD_CHUNK_DAYS, show_default=True, help='Days per transaction.')
+@with_appcontext
+def rebuild_command(start, end, chunk_days):
+    """Recomputes the daily loan rollups behind /analytics from the loans table."""
+    summary = rebuild(start.date() if start else None, end.date() if end else None, chunk_days)
+    click.echo(json.dumps(summary))
@@ -0,0 +1,100 @@
+from datetime import date, timedelta
+from flask import Blueprint, request, jsonify
+import analytics
+from auth import role_required
+import serializers
+from replicas import read_replica
+from versioning import conditional
+from flask_cors import CORS
+# Initialize Blueprint
+analytics_routes = Blueprint('analytics', __name__)
+CORS(analytics_routes)
+
+DEFAULT_WINDOW_DAYS = 30
+MAX_WINDOW_DAYS = 366
+DEFAULT_LIMIT = 10
+MAX_LIMIT = 100
+
+# The rollups change with every loan write (the loans and books versions) and
+# with a rebuild (the analytics version)
+ANALYTICS_TABLES = ('loans', 'books', 'analytics')
+
+
+class WindowError(ValueError):
+    """Raised for a from/to window we cannot use."""
+
+
+@analytics_routes.errorhandler(WindowError)
+def window_error(e):
+    return jsonify({'message': str(e)}), 400
+
+
+def parse_window():
+    """The ?from=YYYY-MM-DD&to=YYYY-MM-DD window, inclusive; the last 30 days by default."""
+    try:
+        end = date.fromisoformat(request.args['to']) if request.args.get('to') else date.today()
+        start = (date.fromisoformat(request.args['from']) if request.args.get('from')
+                 else end - timedelta(days=DEFAULT_WINDOW_DAYS - 1))
+    except ValueError:
+        raise WindowError('from and to must be dates in YYYY-MM-DD format')
+    if start > end:
+        raise WindowError('from must not be after to')
+    if (end - start).days >= MAX_WINDOW_DAYS:
+        raise WindowError(f'The window can span at most {MAX_WINDOW_DAYS} days')
+    return start, end
+
+
+def window_key():
+    # The default window moves with the date, so a day without writes still changes the response
+    start, end = parse_window()
+    return f'{start.isoformat()}..{end.isoformat()}'
+
+
+def parse_limit():
+    return max(1, min(request.args.get('limit', DEFAULT_LIMIT, type=int), MAX_LIMIT))
+
+
+# Most borrowed books in the window
+@analytics_routes.route('/popular', methods=['GET'])
+@read_replica
+@role_required('librarian')
+@conditional(*ANALYTICS_TABLES, key=window_key)
+def popular_books():
+    start, end = parse_window()
+    rows = analytics.popular_books(start, end, parse_limit())
+    return jsonify({'from': start.isoformat(), 'to': end.isoformat(), 'books': serializers.popular_book.many(rows)})
+
+
+# Number of users who borrowed in the window, and the most active of them
+@analytics_routes.route('/borrowers', methods=['GET'])
+@read_replica
+@role_required('librarian')
+@conditional(*ANALYTICS_TABLES, key=window_key)
+def active_borrowers():
+    start, end = parse_window()
+    total, rows = analytics.active_borrowers(start, end, parse_limit())
+    return jsonify({
+        'from': start.isoformat(),
+        'to': end.isoformat(),
+        'active_borrowers': total,
+        'users': serializers.top_borrower.many(rows),
+    })
+
+
+# Borrows and returns per day in the window
+@analytics_routes.route('/circulation', methods=['GET'])
+@read_replica
+@role_required('librarian')
+@conditional(*ANALYTICS_TABLES, key=window_key)
+def circulation():
+    start, end = parse_window()
+    return jsonify({'from': start.isoformat(), 'to': end.isoformat(), 'days': analytics.circulation(start, end)})
+
+
+# Copies on loan per title right now
+@analytics_routes.route('/on-loan', methods=['GET'])
+@read_replica
+@role_required('librarian')
+@conditional(*ANALYTICS_TABLES)
+def copies_on_loan():
+    return jsonify({'books': serializers.copies_on_loan.many(analytics.copies_on_loan(parse_limit()))})
@@ -1,47 +1,141 @@
 from flask import Flask, jsonify, request
 from flask_cors import CORS
-from flask_jwt_extended import JWTManager, jwt_required, get_jwt_identity
+from flask_jwt_extended import JWTManager
 from db import db
+import atexit
 import os
 from config import Config
 from auth_routes import auth_routes
 from user_routes import user_routes
 from book_routes import book_routes
 from loan_routes import loan_routes
+from analytics_routes import analytics_routes
+from hold_routes import hold_routes
+from event_routes import event_routes
+from suggest_index import suggest_index
+import db_pool
+import sql_stats
+import metrics
+import replicas
+import auth
+import passwords
+import health
+import holds
+import changefeed
+import json_provider
+from cache import cache
+from bulk_import import import_books_command, import_users_command
+from migrate import status_command, upgrade_command
+from inventory import reconcile_command, start_hold_sweeper, sweep_holds_command
+import overdue
+import analytics
 
-
-# Initialize the Flask app
-app = Flask(__name__)
-
-app.config.from_object(Config)
-db.init_app(app)
-jwt = JWTManager(app)
-app.config['ALLOWED_EXTENSIONS'] = {'png', 'jpg', 'jpeg', 'gif', 'webp'}  # Allowed file types
 BASE_DIR = os.path.abspath(os.path.dirname(__file__))  # Backend folder
 FRONTEND_DIR = os.path.join(BASE_DIR, '..', 'frontend', 'public', 'images')  # Relative path to frontend/public/images
-app.config['UPLOAD_FOLDER'] = os.path.abspath(FRONTEND_DIR)
-
-# CORS handling for OPTIONS requests (preflight)
-@app.before_request
-def handle_options():
-    if request.method == 'OPTIONS':
-        response = jsonify({'message': 'CORS preflight passed'})
-        response.headers.add('Access-Control-Allow-Origin', 'http://localhost:5173')
-        response.headers.add('Access-Control-Allow-Headers', 'Content-Type,Authorization')
-        response.headers.add('Access-Control-Allow-Methods', 'GET,POST,PUT,DELETE,OPTIONS')
-        return response, 200
-
-# JWT protection for all routes except login/register
-@app.before_request
-def check_authentication():
-    if request.endpoint not in ['auth.login', 'auth.register']:  # Don't apply to login/register endpoints
-        jwt_required()(lambda: None)  # Apply the jwt_required decorator
-
-# Register Blueprints
-app.register_blueprint(auth_routes, url_prefix='/auth')
-app.register_blueprint(user_routes, url_prefix='/users')
-app.register_blueprint(book_routes, url_prefix='/books')
-app.register_blueprint(loan_routes, url_prefix='/loans')
+
+
+def check_long_lived_requests(config):
+    """Refuses caps on long polls and event streams that could take most of the request threads."""
+    long_lived = config['HOLD_MAX_WAITERS'] + config['EVENTS_MAX_SUBSCRIBERS']
+    if long_lived > config['WEB_THREADS'] // 2:
+        raise RuntimeError(
+            f'HOLD_MAX_WAITERS + EVENTS_MAX_SUBSCRIBERS ({long_lived}) may hold at most half of the '
+            f"{config['WEB_THREADS']} WEB_THREADS, or normal requests and health probes can starve"
+        )
+
+
+def create_app(config_object=Config, start_background=True):
+    """
+    Builds the Flask app. Importing this module has no side effects; servers
+    that fork after loading the app (gunicorn with preload_app) pass
+    start_background=False and call start_background_tasks in each worker,
+    since threads do not survive a fork.
+    """
+    app = Flask(__name__)
+
+    app.config.from_object(config_object)
+    check_long_lived_requests(app.config)
+    json_provider.init_app(app)
+    app.config['SQLALCHEMY_ENGINE_OPTIONS'] = db_pool.engine_options(app.config)
+    app.config['SQLALCHEMY_BINDS'] = replicas.binds(app.config)
+    db.init_app(app)
+    db_pool.init_app(app)
+    sql_stats.init_app(app)
+    metrics.init_app(app)  # Registered first so its timer starts before the other request hooks
+    health.init_app(app)
+    cache.init_app(app)
+    JWTManager(app)
+    auth.init_app(app)
+    passwords.init_app(app)
+    replicas.init_app(app)
+    holds.init_app(app)
+    changefeed.init_app(app)
+    app.config['ALLOWED_EXTENSIONS'] = {'png', 'jpg', 'jpeg', 'gif', 'webp'}  # Allowed file types
+    app.config['UPLOAD_FOLDER'] = os.path.abspath(FRONTEND_DIR)
+
+    # Warm the typeahead index from its snapshot instead of scanning the books table,
+    # and write a fresh snapshot when the process exits if it is newer than the saved one
+    suggest_index.load_snapshot(app.config['SUGGEST_SNAPSHOT_PATH'], app.config['SUGGEST_SNAPSHOT_MAX_AGE'])
+    atexit.register(suggest_index.save_snapshot, app.config['SUGGEST_SNAPSHOT_PATH'])
+
+    # CORS handling for OPTIONS requests (preflight)
+    @app.before_request
+    def handle_options():
+        if request.method == 'OPTIONS':
+            response = jsonify({'message': 'CORS preflight passed'})
+            response.headers.add('Access-Control-Allow-Origin', 'http://localhost:5173')
+            response.headers.add('Access-Control-Allow-Headers', f'Content-Type,Authorization,{replicas.STICKY_HEADER}')
+            response.headers.add('Access-Control-Allow-Methods', 'GET,POST,PUT,DELETE,OPTIONS')
+            return response, 200
+
+    # JWT protection for all routes except login/register/refresh, health and /metrics (see auth.PUBLIC_ENDPOINTS)
+    @app.before_request
+    def check_authentication():
+        with metrics.jwt_timer():
+            return auth.authenticate()
+
+    # Register Blueprints
+    app.register_blueprint(auth_routes, url_prefix='/auth')
+    app.register_blueprint(user_routes, url_prefix='/users')
+    app.register_blueprint(book_routes, url_prefix='/books')
+    app.register_blueprint(loan_routes, url_prefix='/loans')
+    app.register_blueprint(analytics_routes, url_prefix='/analytics')
+    app.register_blueprint(hold_routes, url_prefix='/holds')
+    app.register_blueprint(event_routes, url_prefix='/events')
+
+    # Cache hit/miss/eviction counters
+    @app.route('/cache/stats', methods=['GET'])
+    @auth.role_required('librarian')
+    def cache_stats():
+        return jsonify(cache.stats())
+
+    # CLI commands, e.g. `flask --app app import-books catalog.csv --batch-size 2000`
+    app.cli.add_command(import_books_command)
+    app.cli.add_command(import_users_command)
+    app.cli.add_command(upgrade_command)
+    app.cli.add_command(status_command)
+    app.cli.add_command(reconcile_command)
+    app.cli.add_command(sweep_holds_command)
+    app.cli.add_command(overdue.scan_command)
+    app.cli.add_command(analytics.rebuild_command)
+
+    if start_background:
+        start_background_tasks(app)
+    return app
+
+
+def start_background_tasks(app):
+    """Starts the threads that run alongside request handling in this process."""
+    # Optional in-process overdue scan; `flask overdue-scan` from cron does the same
+    overdue.start_scheduler(app)
+    # Optional in-process analytics rebuild; `flask analytics-rebuild` from cron does the same
+    analytics.start_scheduler(app)
+    # Expires holds that were not picked up; `flask sweep-holds` from cron does the same
+    start_hold_sweeper(app)
+
 
 if __name__ == '__main__':
+    # Development server; see wsgi.py for production
+    app = create_app()
+    health.warm_up(app)
     app.run(debug=True)
@@ -0,0 +1,182 @@
+import heapq
+import threading
+import time
+from datetime import datetime
+from functools import wraps
+from flask import g, jsonify, request
+from flask_jwt_extended import create_access_token, create_refresh_token, decode_token
+from flask_jwt_extended.exceptions import JWTExtendedException
+from jwt import ExpiredSignatureError, PyJWTError
+from sqlalchemy import delete, insert, select
+from sqlalchemy.exc import IntegrityError
+from cache import LRUCache
+from db import db
+from models import RevokedToken
+
+# One token system for the whole API: access and refresh tokens minted by
+# flask_jwt_extended, with the user id as `sub` and `role` / `user_id` claims,
+# so role checks never read the users table. A token's signature is verified
+# once per process; the verified claims are then kept in an LRU keyed by the
+# token string for at most AUTH_CLAIMS_TTL seconds. Logout records the token
+# id (jti) in the revoked_tokens table until the token would have expired
+# anyway, and in this process's denylist. Other processes look a token up in
+# the table when they first verify it, so a token they had already verified
+# stays usable there for at most AUTH_CLAIMS_TTL seconds after a logout.
+
+# Endpoint names are the view function names
+PUBLIC_ENDPOINTS = {
+    'auth.login_user', 'auth.register_user', 'auth.refresh_token', 'metrics', 'healthz', 'readyz', 'static',
+}
+
+# Streams opened with EventSource, which cannot send headers, may pass the access token as ?access_token=
+QUERY_TOKEN_ENDPOINTS = {'events.stream_events'}
+
+# Budget for authenticating a request with an already seen token, checked by benchmarks/auth_bench.py
+VERIFY_BUDGET_US = 50
+
+
+class AuthError(Exception):
+    def __init__(self, message, status=401):
+        super().__init__(message)
+        self.message = message
+        self.status = status
+
+
+class Denylist:
+    """
+    Revoked token ids, each kept until its token's own expiry. A heap of
+    expiry times lets add() drop entries that can no longer matter, so the
+    size is bounded by the revocations made within one token lifetime.
+    """
+
+    def __init__(self):
+        self._expires = {}
+        self._heap = []
+        self._lock = threading.Lock()
+
+    def add(self, jti, expires_at):
+        now = time.time()
+        with self._lock:
+            self._expires[jti] = expires_at
+            heapq.heappush(self._heap, (expires_at, jti))
+            while self._heap and self._heap[0][0] <= now:
+                expired_at, old = heapq.heappop(self._heap)
+                if self._expires.get(old) == expired_at:
+                    del self._expires[old]
+
+    def __contains__(self, jti):
+        return jti in self._expires
+
+    def __len__(self):
+        return len(self._expires)
+
+
+denylist = Denylist()
+_claims = LRUCache(max_entries=10000, ttl=60)
+revoked_table = RevokedToken.__table__
+
+
+def init_app(app):
+    global _claims
+    _claims = LRUCache(app.config.get('AUTH_CLAIMS_CACHE_SIZE', 10000), app.config.get('AUTH_CLAIMS_TTL', 60))
+
+
+def issue_tokens(user_id, role):
+    """Returns (access token, refresh token) for a user."""
+    claims = {'role': role, 'user_id': user_id}
+    return (
+        create_access_token(identity=str(user_id), additional_claims=claims),
+        create_refresh_token(identity=str(user_id), additional_claims=claims),
+    )
+
+
+def issue_access_token(user_id, role):
+    return create_access_token(identity=str(user_id), additional_claims={'role': role, 'user_id': user_id})
+
+
+def is_revoked(claims):
+    """Checks the denylist, then the revoked_tokens table for revocations made by other processes."""
+    if claims['jti'] in denylist:
+        return True
+    found = db.session.scalar(select(revoked_table.c.jti).where(revoked_table.c.jti == claims['jti']))
+    if found is None:
+        return False
+    denylist.add(claims['jti'], claims['exp'])
+    return True
+
+
+def verify(token, token_type='access'):
+    """Returns the claims of a valid token of the given type, or raises AuthError."""
+    claims = _claims.get(token)
+    if isinstance(claims, dict):
+        if claims['exp'] <= time.time():
+            _claims.delete(token)
+            raise AuthError('Token has expired')
+    else:
+        try:
+            claims = decode_token(token)
+        except ExpiredSignatureError:
+            raise AuthError('Token has expired')
+        except (PyJWTError, JWTExtendedException):
+            raise AuthError('Invalid token')
+        if is_revoked(claims):
+            raise AuthError('Token has been revoked')
+        _claims.set(token, claims, min(_claims.ttl, claims['exp'] - time.time()))
+
+    if claims['type'] != token_type:
+        raise AuthError(f'{token_type.capitalize()} token required')
+    if claims['jti'] in denylist:
+        raise AuthError('Token has been revoked')
+    return claims
+
+
+def token_from_header():
+    header = request.headers.get('Authorization', '')
+    if not header.startswith('Bearer '):
+        if request.endpoint in QUERY_TOKEN_ENDPOINTS and request.args.get('access_token'):
+            return request.args['access_token']
+        raise AuthError('Missing Authorization header')
+    return header[7:]
+
+
+def revoke(claims):
+    """Revokes a token until its expiry, for every process; also purges revocations that have expired."""
+    denylist.add(claims['jti'], claims['exp'])
+    try:
+        with db.session.begin_nested():
+            db.session.execute(insert(revoked_table).values(
+                jti=claims['jti'], expires_at=datetime.utcfromtimestamp(claims['exp'])
+            ))
+    except IntegrityError:
+        pass  # Already revoked
+    db.session.execute(delete(revoked_table).where(revoked_table.c.expires_at < datetime.utcnow()))
+    db.session.commit()
+
+
+def authenticate():
+    """before_request hook: verifies the access token and stores its claims in g.jwt_claims."""
+    if request.method == 'OPTIONS' or request.endpoint in PUBLIC_ENDPOINTS:
+        return None
+    try:
+        g.jwt_claims = verify(token_from_header())
+    except AuthError as e:
+        return jsonify({'message': e.message}), e.status
+    return None
+
+
+def current_claims():
+    return g.get('jwt_claims')
+
+
+def role_required(*roles):
+    """Restricts a view to users whose token carries one of `roles`; no database lookup."""
+    def decorator(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            claims = current_claims()
+            if claims is None or claims.get('role') not in roles:
+                return jsonify({'message': 'Insufficient permissions'}), 403
+            return view(*args, **kwargs)
+        return wrapper
+    return decorator
+
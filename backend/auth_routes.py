@@ -1,27 +1,13 @@
 from flask import Blueprint, request, jsonify
-from werkzeug.security import generate_password_hash, check_password_hash
 from models import User
 from db import db
-import jwt
-from datetime import datetime, timedelta
-from config import Config
+from passwords import hash_password, passwords
+from cache import get_user_data, get_user_id_by_username
+from auth import AuthError, current_claims, issue_access_token, issue_tokens, revoke, token_from_header, verify
 from flask_cors import CORS
 # Initialize Blueprint
 auth_routes = Blueprint('auth', __name__)
 CORS(auth_routes)
-# Function to generate JWT Token
-def generate_jwt_token(user_id: int, role: str) -> str:
-    """
-    Generates a JWT token with the user_id and role.
-    """
-    expiration = datetime.utcnow() + timedelta(hours=1)  # Token expires in 1 hour
-    payload = {
-        'user_id': user_id,
-        'role': role,
-        'exp': expiration
-    }
-    token = jwt.encode(payload, Config.SECRET_KEY, algorithm='HS256')
-    return token
 
 # Route for User Registration
 @auth_routes.route('/register', methods=['POST'])
@@ -33,11 +19,11 @@ def register_user():
         return jsonify({'message': 'Missing required fields'}), 400
     
     # Check if username already exists
-    if User.query.filter_by(username=data['username']).first():
+    if get_user_id_by_username(data['username']):
         return jsonify({'message': 'Username already taken'}), 400
 
     # Hash the password
-    hashed_password = generate_password_hash(data['password'])
+    hashed_password = hash_password(data['password'])
     
     # Create new user with the default role 'member'
     new_user = User(
@@ -66,30 +52,48 @@ def login_user():
     # Get user from the database
     user = User.query.filter_by(username=data['username']).first()
 
-    if user and check_password_hash(user.password, data['password']):
-        # Generate JWT token
-        token = generate_jwt_token(user.id, user.role)
-        return jsonify({'message': 'Login successful', 'token': token, 'username': user.username,'user_id': user.id}), 200
+    valid, new_hash = passwords.verify_and_update(user.password, data['password']) if user else (False, None)
+    if valid:
+        # Hashes made with an older method or cost are upgraded while the plain password is at hand
+        if new_hash:
+            user.password = new_hash
+            db.session.commit()
+        # Short-lived access token plus a refresh token for /auth/refresh
+        token, refresh_token = issue_tokens(user.id, user.role)
+        return jsonify({'message': 'Login successful', 'token': token, 'refresh_token': refresh_token,
+                        'username': user.username,'user_id': user.id}), 200
     
     return jsonify({'message': 'Invalid credentials'}), 401
 
 # Route for checking if user is logged in (using JWT)
 @auth_routes.route('/validate', methods=['GET'])
 def validate_user():
-    token = request.headers.get('Authorization')  # Expecting token in the Authorization header
-
-    if not token:
-        return jsonify({'message': 'Token is missing'}), 400
+    # The access token was already verified by the authentication hook in app.py
+    claims = current_claims()
+    return jsonify({'message': 'Token is valid', 'user_id': claims['user_id'], 'role': claims['role']}), 200
 
+# Route for exchanging a refresh token (in the Authorization header) for a new access token
+@auth_routes.route('/refresh', methods=['POST'])
+def refresh_token():
     try:
-        # Remove "Bearer " from token if included
-        if token.startswith("Bearer "):
-            token = token[7:]
+        claims = verify(token_from_header(), 'refresh')
+    except AuthError as e:
+        return jsonify({'message': e.message}), e.status
+
+    # The role is read again here, so role changes apply from the next refresh on
+    user = get_user_data(claims['user_id'])
+    if not user:
+        return jsonify({'message': 'User not found'}), 401
+    return jsonify({'token': issue_access_token(user['id'], user['role'])}), 200
 
-        # Decode the JWT token
-        payload = jwt.decode(token, Config.SECRET_KEY, algorithms=['HS256'])
-        return jsonify({'message': 'Token is valid', 'user_id': payload['user_id'], 'role': payload['role']}), 200
-    except jwt.ExpiredSignatureError:
-        return jsonify({'message': 'Token has expired'}), 401
-    except jwt.InvalidTokenError:
-        return jsonify({'message': 'Invalid token'}), 401
+# Route for logging out: revokes the access token and, if given, the refresh token
+@auth_routes.route('/logout', methods=['POST'])
+def logout_user():
+    revoke(current_claims())
+    refresh = (request.get_json(silent=True) or {}).get('refresh_token')
+    if refresh:
+        try:
+            revoke(verify(refresh, 'refresh'))
+        except AuthError:
+            pass  # Already expired or revoked
+    return jsonify({'message': 'Logged out'}), 200
@@ -1,8 +1,19 @@
 from flask import Blueprint, request, jsonify,current_app
 from models import Book
-from werkzeug.utils import secure_filename
 from db import db
-import os
+from auth import role_required
+from bulk_import import IMPORTED_TABLES, RowError, import_upload
+from cache import get_book_data, invalidate_books
+from changefeed import changes, publish
+from images import submit_cover
+from export import EXPORT_FORMATS, stream_export
+from loan_queries import delete_loans_for_book
+from pagination import CursorError, decode_cursor, encode_cursor, keyset_page, parse_limit
+from search_index import search_index
+import serializers
+from suggest_index import suggest_index
+from replicas import read_replica
+from versioning import bump, conditional, table_version
 from flask_cors import CORS
 # Initialize Blueprint
 book_routes = Blueprint('book', __name__)
@@ -12,10 +23,32 @@ CORS(book_routes)
 def allowed_file(filename):
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in current_app.config['ALLOWED_EXTENSIONS']
 
+def file_extension(filename):
+    return filename.rsplit('.', 1)[1].lower()
+
+# Keep in-process indexes in sync after a book write has been committed, and
+# publish it to the change feed; with `before`, only the fields that changed
+def book_written(book, op, before=None):
+    invalidate_books(book.id)
+    versions = bump('books', 'catalog')
+    fields = changes(before, serializers.book(book))
+    if fields:
+        publish('book', book.id, op, fields, versions.get('books'))
+    search_index.add(book.id, book.title, book.author, versions.get('catalog'))
+    suggest_index.add_book(book.id, book.title, book.author, versions.get('catalog'))
+
+def book_removed(book_id):
+    invalidate_books(book_id)
+    versions = bump('books', 'loans', 'catalog')
+    publish('book', book_id, 'delete', version=versions.get('books'))
+    # The book's loan history went with it
+    publish('loan', None, 'reload', {'book_id': book_id}, versions.get('loans'))
+    search_index.remove(book_id, versions.get('catalog'))
+    suggest_index.remove_book(book_id, versions.get('catalog'))
+
 @book_routes.route('/add', methods=['POST'])
 def add_book():
     data = request.form  
-    print(f"Received data: {data}")
 
     # Check and convert 'available' to boolean if it's a string, otherwise leave it as is
     available = data.get('available', 'true')
@@ -29,37 +62,45 @@ def add_book():
     if 'title' not in data or 'author' not in data:
         return jsonify({'message': 'Title and author are required'}), 400
 
-    # Handle the image upload
+    # The image upload is processed in the background once the book has an id
     image_file = request.files.get('image')  # 'image' is the key used in the form
-    image_url = None
-
-    if image_file and allowed_file(image_file.filename):
-        filename = secure_filename(image_file.filename)
-        # Save the image to the correct folder
-        image_path = os.path.join(current_app.config['UPLOAD_FOLDER'], filename)
-        
-        # Save the image file
-        image_file.save(image_path)
-        
-       
-        image_url = f"images/{filename}" 
+    if image_file and not allowed_file(image_file.filename):
+        image_file = None
+
     # Create new book
     new_book = Book(
         title=data['title'],
         author=data['author'],
         available=available,
         quantity=quantity,
-        image_url=image_url
+        image_url=None
     )
 
     try:
         db.session.add(new_book)
         db.session.commit()
-        return jsonify({'message': 'Book added successfully'}), 201
+        book_written(new_book, 'create')
+        if image_file:
+            submit_cover(current_app._get_current_object(), new_book.id, image_file, file_extension(image_file.filename))
+        return jsonify({'message': 'Book added successfully', 'image_pending': bool(image_file)}), 201
     except Exception as e:
         db.session.rollback()
         return jsonify({'message': 'Error adding book', 'error': str(e)}), 500
     
+# Bulk import books from an uploaded CSV or NDJSON file
+@book_routes.route('/import', methods=['POST'])
+@role_required('librarian')
+def import_books():
+    try:
+        summary = import_upload(Book, request)
+    except RowError as e:
+        return jsonify({'message': str(e)}), 400
+    if summary['inserted']:
+        versions = bump(*IMPORTED_TABLES[Book])
+        # Too many rows for one event each: subscribers reload the catalog
+        publish('book', None, 'reload', {'inserted': summary['inserted']}, versions.get('books'))
+    return jsonify(summary), 200 if not summary['failed'] else 207
+
 @book_routes.route('/<int:book_id>/update-availability', methods=['PUT'])
 def update_book_availability(book_id):
     try:
@@ -67,6 +108,9 @@ def update_book_availability(book_id):
         if book:
             book.available = True  # Mark the book as available
             db.session.commit()
+            invalidate_books(book_id)
+            versions = bump('books')
+            publish('book', book_id, 'update', {'available': True}, versions.get('books'))
             return jsonify({'message': 'Book availability updated successfully'}), 200
         else:
             return jsonify({'message': 'Book not found'}), 404
@@ -74,42 +118,95 @@ def update_book_availability(book_id):
         return jsonify({'message': str(e)}), 500
 
 
+# Sort keys accepted by the paginated listing, mapped to their keyset columns
+BOOK_SORT_KEYS = {
+    'id': (Book.id,),
+    'title': (Book.title, Book.id),
+}
+
+PAGINATION_ARGS = ('limit', 'after', 'sort', 'available', 'author', 'count')
+
+# Columns of serializers.book, queried as rows rather than whole Book objects
+BOOK_LIST_COLUMNS = (Book.id, Book.title, Book.author, Book.available, Book.quantity, Book.image_url)
+
+
+def escape_like(value):
+    """Escapes LIKE wildcards so user input is matched literally."""
+    return value.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+
+
 # Get all books
 @book_routes.route('/', methods=['GET'])
+@read_replica
+@conditional('books')
 def get_books():
-    books = Book.query.all()
+    fmt = request.args.get('format')
+    if fmt:
+        if fmt not in EXPORT_FORMATS:
+            return jsonify({'message': f'Unsupported format: {fmt}'}), 400
+        query = db.session.query(*BOOK_LIST_COLUMNS).order_by(Book.id)
+        return stream_export(query, fmt, 'books')
+
+    # Any of the listing parameters switches to the keyset-paginated response
+    if any(arg in request.args for arg in PAGINATION_ARGS):
+        return get_books_page()
+
+    return jsonify(serializers.book.many(db.session.query(*BOOK_LIST_COLUMNS))), 200
 
-    return jsonify([{
-        'id': book.id,
-        'title': book.title,
-        'author': book.author,
-        'available': book.available,
-        'quantity': book.quantity,
-        'image_url': book.image_url  
-    } for book in books]), 200
+
+def get_books_page():
+    """
+    Keyset-paginated catalog listing.
+
+    Query parameters: limit, after (cursor from a previous page), sort
+    (id, -id, title, -title), available (true/false), author (prefix match)
+    and count (true to include the total number of matching books).
+    """
+    sort = request.args.get('sort', 'id')
+    descending = sort.startswith('-')
+    columns = BOOK_SORT_KEYS.get(sort.lstrip('-'))
+    if columns is None:
+        return jsonify({'message': f'Invalid sort: {sort}'}), 400
+
+    limit = parse_limit(request.args.get('limit', type=int))
+
+    query = Book.query
+    available = request.args.get('available')
+    if available is not None:
+        query = query.filter(Book.available == (available.lower() == 'true'))
+    author = request.args.get('author')
+    if author:
+        query = query.filter(Book.author.like(f'{escape_like(author)}%', escape='\\'))
+
+    try:
+        after = request.args.get('after')
+        after = decode_cursor(after) if after else None
+        books, next_values = keyset_page(query, columns, limit, after, descending)
+    except CursorError as e:
+        return jsonify({'message': str(e)}), 400
+
+    result = {
+        'books': serializers.book.many(books),
+        'next_cursor': encode_cursor(next_values) if next_values else None,
+    }
+    # Counting is a full index scan, so it is only done when asked for
+    if request.args.get('count', 'false').lower() == 'true':
+        result['total'] = query.order_by(None).count()
+    return jsonify(result), 200
 
 # Get a specific book by ID
 @book_routes.route('/<int:id>', methods=['GET'])
+@read_replica
+@conditional('books')
 def get_book(id):
-    book = Book.query.get(id)
+    book = get_book_data(id)
 
     if book:
-        return jsonify({
-            'id': book.id,
-            'title': book.title,
-            'author': book.author,
-            'available': book.available,
-            'quantity': book.quantity,
-            'image_url': book.image_url   
-        }), 200
+        return jsonify(book), 200
     else:
         return jsonify({'message': 'Book not found'}), 404
 
 # Update a book's details
-from flask import request, jsonify
-from werkzeug.utils import secure_filename
-import os
-
 @book_routes.route('/<int:id>', methods=['PUT'])
 def update_book(id):
     book = Book.query.get(id)
@@ -117,7 +214,7 @@ def update_book(id):
     if not book:
         return jsonify({'message': 'Book not found'}), 404
 
-    
+    before = serializers.book(book)
     title = request.form.get('title')
     author = request.form.get('author')
     quantity = request.form.get('quantity')
@@ -130,30 +227,48 @@ def update_book(id):
         book.author = author
     if quantity:
         book.quantity = int(quantity)  # Make sure it's an integer
-    if image:
-        # Handle the image upload
-        if allowed_file(image.filename):
-            image_filename = secure_filename(image.filename)
-            image_path = os.path.join(current_app.config['UPLOAD_FOLDER'], image_filename)  # Use the same upload folder
-            image.save(image_path)
-            book.image_url = f"images/{image_filename}"  # Save the relative image path in the database
+    # A new image keeps the current cover until its variants are ready
+    if image and not allowed_file(image.filename):
+        image = None
 
     try:
         db.session.commit()
-        return jsonify({'message': 'Book updated successfully'}), 200
+        book_written(book, 'update', before)
+        if image:
+            submit_cover(current_app._get_current_object(), book.id, image, file_extension(image.filename))
+        return jsonify({'message': 'Book updated successfully', 'image_pending': bool(image)}), 200
     except Exception as e:
         db.session.rollback()
         return jsonify({'message': 'Error updating book', 'error': str(e)}), 500
 
 @book_routes.route('/search', methods=['GET'])
+@read_replica
+@conditional('books', 'catalog')
 def search_books():
     query = request.args.get('query')
     if query:
-        # Case-insensitive search for books that start with the search term
-        books = Book.query.filter(Book.title.ilike(f'{query}%')).all()
-        return jsonify({'books': [book.to_dict() for book in books]})
+        limit = max(1, min(request.args.get('limit', 20, type=int), 100))
+
+        # Rank matches on title and author with the in-process index, then load only those rows
+        search_index.ensure_current(table_version('catalog'))
+        book_ids = search_index.search(query, limit)
+        if not book_ids:
+            return jsonify({'books': []})
+        books = {book.id: book for book in Book.query.filter(Book.id.in_(book_ids))}
+        return jsonify({'books': serializers.book.many(books[book_id] for book_id in book_ids if book_id in books)})
     return jsonify({'books': []})
 
+# Typeahead completions for the search box, ranked by loan popularity
+@book_routes.route('/suggest', methods=['GET'])
+@conditional('books', 'loans', 'catalog')
+def suggest_books():
+    prefix = request.args.get('prefix', '')
+    limit = max(1, min(request.args.get('limit', 10, type=int), 50))
+
+    suggest_index.ensure_current(table_version('catalog'), table_version('loans'),
+                                 current_app.config['SUGGEST_POPULARITY_MAX_AGE'])
+    return jsonify({'suggestions': suggest_index.suggest(prefix, limit)})
+
 # Delete a book by ID
 @book_routes.route('/<int:id>', methods=['DELETE'])
 def delete_book(id):
@@ -161,15 +276,15 @@ def delete_book(id):
     if not book:
         return jsonify({'message': 'Book not found'}), 404
 
-    # Check if the book has active loans (loans where date_returned is NULL)
-    active_loans = any(loan.date_returned is None for loan in book.loans)
-    print(active_loans)
-    if active_loans:
+    # Active loans are counted on the book row itself
+    if book.active_loans > 0:
         return jsonify({'message': 'Cannot delete a book with active loans'}), 400
 
     try:
+        delete_loans_for_book(id)
         db.session.delete(book)
         db.session.commit()
+        book_removed(id)
         return jsonify({'message': 'Book deleted successfully'}), 200
     except Exception as e:
         db.session.rollback()
@@ -0,0 +1,306 @@
+import csv
+import io
+import json
+import time
+import click
+from flask.cli import with_appcontext
+from sqlalchemy import insert
+from flask import current_app
+from sqlalchemy.exc import DataError, IntegrityError
+from db import db
+from models import Book, User
+from passwords import passwords
+from versioning import bump
+
+IMPORT_FORMATS = ('csv', 'ndjson')
+DEFAULT_BATCH_SIZE = 1000
+MAX_BATCH_SIZE = 10000
+MAX_REPORTED_ERRORS = 1000
+TRUE_VALUES = {'true', '1', 'yes', 'y'}
+
+# Table versions an import moves, so caches, ETags and search indexes everywhere catch up
+IMPORTED_TABLES = {Book: ('books', 'catalog'), User: ('users',)}
+
+
+class RowError(ValueError):
+    """A single input row that failed validation."""
+
+
+def read_records(stream, fmt):
+    """Yields (row_number, record) from a text stream of CSV (with header) or NDJSON."""
+    if fmt == 'csv':
+        for row_number, record in enumerate(csv.DictReader(stream), start=2):
+            yield row_number, record
+        return
+    for row_number, line in enumerate(stream, start=1):
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            record = json.loads(line)
+        except ValueError:
+            yield row_number, None
+            continue
+        yield row_number, record
+
+
+def text_value(record, field):
+    value = record.get(field)
+    if value is None:
+        return ''
+    # NDJSON rows may carry any JSON type; numbers are taken as text, objects and lists are not
+    if isinstance(value, bool) or not isinstance(value, (str, int, float)):
+        raise RowError(f'{field} must be text')
+    return str(value).strip()
+
+
+def required_text(record, field, max_length):
+    value = text_value(record, field)
+    if not value:
+        raise RowError(f'Missing field: {field}')
+    if len(value) > max_length:
+        raise RowError(f'{field} is longer than {max_length} characters')
+    return value
+
+
+def optional_text(record, field, max_length):
+    value = text_value(record, field)
+    if len(value) > max_length:
+        raise RowError(f'{field} is longer than {max_length} characters')
+    return value or None
+
+
+def validate_book(record):
+    title = required_text(record, 'title', 100)
+    author = required_text(record, 'author', 100)
+    try:
+        quantity = int(record.get('quantity') or 0)
+    except (TypeError, ValueError):
+        raise RowError('quantity must be an integer')
+    if quantity < 0:
+        raise RowError('quantity cannot be negative')
+
+    available = record.get('available')
+    if available is None or available == '':
+        available = quantity > 0
+    elif isinstance(available, str):
+        available = available.strip().lower() in TRUE_VALUES
+
+    return {
+        'title': title,
+        'author': author,
+        'quantity': quantity,
+        'available': bool(available),
+        'image_url': optional_text(record, 'image_url', 255),
+    }
+
+
+def validate_user(record):
+    """
+    Validates a user row. Plain passwords are left under `plain_password` for
+    hash_passwords() to hash a whole batch at once.
+    """
+    username = required_text(record, 'username', 50)
+    email = required_text(record, 'email', 120)
+    role = optional_text(record, 'role', 20) or 'member'
+    if role not in ('member', 'librarian'):
+        raise RowError(f'Invalid role: {role}')
+
+    mapping = {
+        'username': username,
+        'email': email,
+        'role': role,
+        'name': optional_text(record, 'name', 100),
+        'last_name': optional_text(record, 'last_name', 100),
+    }
+    # Migrations from another system can carry existing hashes instead of plain passwords
+    password_hash = optional_text(record, 'password_hash', 255)
+    if password_hash:
+        mapping['password'] = password_hash
+    else:
+        password = record.get('password')
+        if not password:
+            raise RowError('Missing field: password or password_hash')
+        if not isinstance(password, str):
+            raise RowError('password must be text')
+        mapping['plain_password'] = password
+    return mapping
+
+
+def hash_passwords(batch, errors, budget=None):
+    """
+    Hashes the plain passwords of a batch of user rows in parallel on the
+    password pool. `budget` is a one-item list with the number of passwords
+    the import may still hash, or None for no limit; rows beyond it are
+    reported as failed.
+    """
+    kept, pending = [], []
+    for row_number, mapping in batch:
+        if 'plain_password' in mapping:
+            if budget is not None and len(pending) >= budget[0]:
+                errors.append({'row': row_number, 'error': 'Too many passwords to hash in one request; '
+                                                           'import the rest with flask import-users'})
+                continue
+            pending.append(mapping)
+        kept.append((row_number, mapping))
+    if budget is not None:
+        budget[0] -= len(pending)
+    hashes = passwords.hash_many([mapping.pop('plain_password') for mapping in pending])
+    for mapping, password_hash in zip(pending, hashes):
+        mapping['password'] = password_hash
+    return kept
+
+
+def drop_existing_users(batch, errors):
+    """Set-based duplicate check: one IN query per batch for usernames and one for emails."""
+    usernames = {mapping['username'] for _, mapping in batch}
+    emails = {mapping['email'] for _, mapping in batch}
+    taken_usernames = {row[0] for row in db.session.query(User.username).filter(User.username.in_(usernames))}
+    taken_emails = {row[0] for row in db.session.query(User.email).filter(User.email.in_(emails))}
+
+    kept, seen_usernames, seen_emails = [], set(), set()
+    for row_number, mapping in batch:
+        if mapping['username'] in taken_usernames or mapping['username'] in seen_usernames:
+            errors.append({'row': row_number, 'error': f"Username already exists: {mapping['username']}"})
+        elif mapping['email'] in taken_emails or mapping['email'] in seen_emails:
+            errors.append({'row': row_number, 'error': f"Email already exists: {mapping['email']}"})
+        else:
+            seen_usernames.add(mapping['username'])
+            seen_emails.add(mapping['email'])
+            kept.append((row_number, mapping))
+    return kept
+
+
+def insert_batch(model, batch, errors):
+    """
+    Inserts a batch with one multi-row INSERT. If the batch hits a constraint
+    or a value the database rejects, falls back to row-by-row inserts in savepoints so only the bad rows fail.
+    Returns the number of rows inserted.
+    """
+    if not batch:
+        return 0
+    table = model.__table__
+    try:
+        db.session.execute(insert(table), [mapping for _, mapping in batch])
+        db.session.commit()
+        return len(batch)
+    except (IntegrityError, DataError):
+        db.session.rollback()
+
+    inserted = 0
+    for row_number, mapping in batch:
+        try:
+            with db.session.begin_nested():
+                db.session.execute(insert(table), [mapping])
+            inserted += 1
+        except (IntegrityError, DataError) as e:
+            errors.append({'row': row_number, 'error': str(e.orig)})
+    db.session.commit()
+    return inserted
+
+
+def import_records(model, records, batch_size=DEFAULT_BATCH_SIZE, max_passwords=None):
+    """
+    Validates and inserts records in batches. Invalid rows are reported and
+    skipped without aborting their batch, as are user rows beyond the first
+    `max_passwords` that need their password hashed. Returns a summary with
+    per-row errors and the achieved throughput.
+    """
+    validate = validate_book if model is Book else validate_user
+    batch_size = max(1, min(batch_size, MAX_BATCH_SIZE))
+    budget = None if max_passwords is None else [max_passwords]
+    started = time.perf_counter()
+    inserted = 0
+    total = 0
+    errors = []
+    batch = []
+
+    def flush():
+        nonlocal inserted
+        # Duplicates are dropped before hashing so no time is spent on rows that will not be inserted
+        rows = hash_passwords(drop_existing_users(batch, errors), errors, budget) if model is User else batch
+        inserted += insert_batch(model, rows, errors)
+        batch.clear()
+
+    for row_number, record in records:
+        total += 1
+        if not isinstance(record, dict):
+            errors.append({'row': row_number, 'error': 'Row is not a JSON object'})
+            continue
+        try:
+            batch.append((row_number, validate(record)))
+        except RowError as e:
+            errors.append({'row': row_number, 'error': str(e)})
+        if len(batch) >= batch_size:
+            flush()
+    flush()
+
+    elapsed = time.perf_counter() - started
+    return {
+        'rows': total,
+        'inserted': inserted,
+        'failed': len(errors),
+        'errors': sorted(errors, key=lambda e: e['row'])[:MAX_REPORTED_ERRORS],
+        'seconds': round(elapsed, 3),
+        'rows_per_second': round(inserted / elapsed, 1) if elapsed else None,
+    }
+
+
+def detect_format(filename, fmt=None):
+    if fmt:
+        return fmt.lower()
+    if filename and filename.lower().endswith(('.ndjson', '.jsonl')):
+        return 'ndjson'
+    return 'csv'
+
+
+def import_file(model, path, fmt, batch_size):
+    """Imports a file from the command line; the running server processes see the rows through the table versions."""
+    with open(path, newline='', encoding='utf-8') as f:
+        summary = import_records(model, read_records(f, fmt), batch_size)
+    if summary['inserted']:
+        bump(*IMPORTED_TABLES[model])
+    return summary
+
+
+def import_upload(model, request):
+    """
+    Imports the uploaded 'file' (or the raw request body) of an HTTP request.
+    Hashes at most IMPORT_MAX_PASSWORDS passwords, so the request ends before
+    the server's timeout; larger user files go through `flask import-users`.
+    """
+    upload = request.files.get('file')
+    fmt = detect_format(upload.filename if upload else None, request.args.get('format'))
+    if fmt not in IMPORT_FORMATS:
+        raise RowError(f'Unsupported format: {fmt}')
+    stream = upload.stream if upload else request.stream
+    text = io.TextIOWrapper(stream, encoding='utf-8', newline='')
+    batch_size = request.args.get('batch_size', DEFAULT_BATCH_SIZE, type=int)
+    return import_records(model, read_records(text, fmt), batch_size, current_app.config['IMPORT_MAX_PASSWORDS'])
+
+
+def echo_summary(summary):
+    click.echo(f"{summary['inserted']}/{summary['rows']} rows inserted in {summary['seconds']}s "
+               f"({summary['rows_per_second']} rows/s), {summary['failed']} failed")
+    for error in summary['errors']:
+        click.echo(f"  row {error['row']}: {error['error']}", err=True)
+
+
+@click.command('import-books')
+@click.argument('path', type=click.Path(exists=True, dir_okay=False))
+@click.option('--format', 'fmt', type=click.Choice(IMPORT_FORMATS))
+@click.option('--batch-size', default=DEFAULT_BATCH_SIZE, show_default=True)
+@with_appcontext
+def import_books_command(path, fmt, batch_size):
+    """Bulk-imports books from a CSV or NDJSON file."""
+    echo_summary(import_file(Book, path, detect_format(path, fmt), batch_size))
+
+
+@click.command('import-users')
+@click.argument('path', type=click.Path(exists=True, dir_okay=False))
+@click.option('--format', 'fmt', type=click.Choice(IMPORT_FORMATS))
+@click.option('--batch-size', default=DEFAULT_BATCH_SIZE, show_default=True)
+@with_appcontext
+def import_users_command(path, fmt, batch_size):
+    """Bulk-imports users from a CSV or NDJSON file."""
+    echo_summary(import_file(User, path, detect_format(path, fmt), batch_size))
@@ -0,0 +1,276 @@
+import json
+import secrets
+import threading
+import time
+from collections import OrderedDict
+import serializers
+
+MISSING = object()
+
+
+class LRUCache:
+    """Thread-safe in-process LRU cache with a per-entry TTL."""
+
+    def __init__(self, max_entries=10000, ttl=30):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.evictions = 0
+        self.expirations = 0
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return MISSING
+            value, expires_at = entry
+            if expires_at < time.monotonic():
+                del self._entries[key]
+                self.expirations += 1
+                return MISSING
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl=None):
+        expires_at = time.monotonic() + (self.ttl if ttl is None else ttl)
+        with self._lock:
+            self._entries[key] = (value, expires_at)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class InMemorySharedBackend:
+    """
+    Dict-backed stand-in for a shared cache server, with the same interface
+    as RedisBackend. Used in tests and single-process deployments.
+    """
+
+    def __init__(self):
+        self._data = {}
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                return MISSING
+            raw, expires_at = entry
+            if expires_at < time.monotonic():
+                del self._data[key]
+                return MISSING
+        return json.loads(raw)
+
+    def set(self, key, value, ttl):
+        raw = json.dumps(value)
+        with self._lock:
+            self._data[key] = (raw, time.monotonic() + ttl)
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+
+class RedisBackend:
+    """Shared cache in Redis. Requires the optional `redis` package."""
+
+    def __init__(self, url, prefix='library:'):
+        import redis
+
+        self._client = redis.Redis.from_url(url)
+        self._prefix = prefix
+
+    def get(self, key):
+        raw = self._client.get(self._prefix + key)
+        return MISSING if raw is None else json.loads(raw)
+
+    def set(self, key, value, ttl):
+        self._client.set(self._prefix + key, json.dumps(value), ex=max(1, int(ttl)))
+
+    def delete(self, key):
+        self._client.delete(self._prefix + key)
+
+
+class Cache:
+    """
+    Read-through cache: a local LRU in front of an optional shared backend.
+
+    Values must be JSON-serializable. `None` results are never cached, so a
+    lookup for a row that does not exist yet always reaches the database.
+
+    Each key has a generation, which invalidate() replaces after a write, and
+    an entry is only served while the generation it was loaded under is still
+    the key's. A loader that read the row before a write committed therefore
+    stores it under the old generation, where no later lookup finds it. With
+    a shared backend the generations live there, so a write in any process
+    retires that one key in every process; without one only the process that
+    made the write knows, and the others serve the key for up to
+    CACHE_LOCAL_TTL.
+    """
+
+    def __init__(self):
+        self.enabled = True
+        self.local = LRUCache()
+        self.generations = LRUCache()
+        self.shared = None
+        self.shared_ttl = 300
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.shared_hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    def init_app(self, app):
+        self.enabled = app.config.get('CACHE_ENABLED', True)
+        self.local = LRUCache(app.config.get('CACHE_MAX_ENTRIES', 10000), app.config.get('CACHE_LOCAL_TTL', 30))
+        self.shared_ttl = app.config.get('CACHE_SHARED_TTL', 300)
+        # A generation outlives every entry loaded under the one before it
+        self.generations = LRUCache(self.local.max_entries, 2 * max(self.local.ttl, self.shared_ttl))
+        shared_url = app.config.get('CACHE_SHARED_URL')
+        if shared_url == 'memory://':
+            self.shared = InMemorySharedBackend()
+        elif shared_url:
+            self.shared = RedisBackend(shared_url)
+        else:
+            self.shared = None
+
+    def _count(self, counter):
+        with self._lock:
+            setattr(self, counter, getattr(self, counter) + 1)
+
+    def _generation(self, key):
+        if self.shared is not None:
+            generation = self.shared.get(generation_key(key))
+        else:
+            generation = self.generations.get(key)
+        return None if generation is MISSING else generation
+
+    def get_or_load(self, key, loader):
+        if not self.enabled:
+            return loader()
+
+        generation = self._generation(key)
+        entry = self.local.get(key)
+        if entry is not MISSING and entry[0] == generation:
+            self._count('hits')
+            return entry[1]
+
+        if self.shared is not None:
+            entry = self.shared.get(key)
+            if entry is not MISSING and entry[0] == generation:
+                self._count('shared_hits')
+                self.local.set(key, (generation, entry[1]))
+                return entry[1]
+
+        self._count('misses')
+        value = loader()
+        if value is not None:
+            self.local.set(key, (generation, value))
+            if self.shared is not None:
+                self.shared.set(key, [generation, value], self.shared_ttl)
+        return value
+
+    def invalidate(self, *keys):
+        for key in keys:
+            generation = secrets.token_hex(8)
+            self.generations.set(key, generation)
+            self.local.delete(key)
+            if self.shared is not None:
+                self.shared.set(generation_key(key), generation, self.generations.ttl)
+                self.shared.delete(key)
+        with self._lock:
+            self.invalidations += len(keys)
+
+    def clear(self):
+        self.local.clear()
+
+    def stats(self):
+        return {
+            'hits': self.hits,
+            'shared_hits': self.shared_hits,
+            'misses': self.misses,
+            'evictions': self.local.evictions,
+            'expirations': self.local.expirations,
+            'invalidations': self.invalidations,
+            'entries': len(self.local),
+        }
+
+
+# Shared cache instance, configured by cache.init_app(app)
+cache = Cache()
+
+
+# Cached lookups used across the blueprints. They return plain dicts, never ORM objects,
+# and load from the primary: a value read from a lagging replica would outlive the
+# invalidation of the write it missed.
+
+def generation_key(key):
+    return f'generation:{key}'
+
+
+def book_key(book_id):
+    return f'book:{book_id}'
+
+
+def user_key(user_id):
+    return f'user:{user_id}'
+
+
+def username_key(username):
+    return f'username:{username}'
+
+
+def get_book_data(book_id):
+    from db import primary
+    from models import Book
+
+    def load():
+        with primary():
+            book = Book.query.get(book_id)
+            return book.to_dict() if book else None
+
+    return cache.get_or_load(book_key(book_id), load)
+
+
+def get_user_data(user_id):
+    from db import primary
+    from models import User
+
+    def load():
+        with primary():
+            user = User.query.get(user_id)
+        return serializers.user(user) if user else None
+
+    return cache.get_or_load(user_key(user_id), load)
+
+
+def get_user_id_by_username(username):
+    from db import db, primary
+    from models import User
+
+    def load():
+        with primary():
+            return db.session.query(User.id).filter_by(username=username).scalar()
+
+    return cache.get_or_load(username_key(username), load)
+
+
+def invalidate_books(*book_ids):
+    cache.invalidate(*(book_key(book_id) for book_id in book_ids))
+
+
+def invalidate_user(user_id, *usernames):
+    cache.invalidate(user_key(user_id), *(username_key(username) for username in usernames))
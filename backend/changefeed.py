@@ -0,0 +1,226 @@
+import json
+import secrets
+import threading
+import time
+from sqlalchemy import select
+from db import db
+
+# Change feed behind GET /events. Write paths publish a compact event once
+# their transaction has committed: the entity, its id, the operation, the
+# changed fields and the table version the write produced. Events are kept in
+# a bounded ring buffer and numbered in order; each subscriber keeps a cursor
+# into it and reads without locking, so a slow reader never holds up a writer. Each event is encoded
+# once, at publish time, and the same frame is written to every stream.
+# Publishing is an append and a signal to a dispatcher thread, which wakes the
+# streams, so the cost of waking many subscribers is not paid by the request
+# that made the write.
+#
+# The feed lives in one process. Event ids are "<epoch>-<seq>", the epoch
+# being random per process: a Last-Event-ID from another process, from before
+# a restart or older than the buffer cannot be resumed, and the client gets a
+# `reset` event telling it to reload. Writes served by other processes are
+# not in this feed; the periodic `versions` event carries the table versions
+# so clients notice them and refetch.
+
+RESET = 'reset'
+EXPIRED = 'expired'  # Sent before a stream ends because its token expired or was revoked
+RETRY_MS = 3000  # How long an EventSource waits before reconnecting
+
+
+class ChangeFeed:
+    def __init__(self, size=1000):
+        self.epoch = secrets.token_hex(4)
+        # Event n is kept in slot n % size until event n + size replaces it
+        self._ring = [None] * size
+        self._seq = 0
+        self._publish_lock = threading.Lock()
+        self._changed = threading.Condition()
+        self._pending = threading.Event()
+        self._dispatcher = None
+        self._dispatcher_lock = threading.Lock()
+        self._versions = (0.0, None)
+        self._versions_lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(1)
+
+    def configure(self, size, max_subscribers):
+        with self._publish_lock:
+            ring = [None] * size
+            for event in self._ring:
+                if event is not None and event[0] > self._seq - size:
+                    ring[event[0] % size] = event
+            self._ring = ring
+        self._slots = threading.BoundedSemaphore(max_subscribers)
+
+    def join(self):
+        """Takes a subscriber slot; False when this process already serves as many streams as it may."""
+        return self._slots.acquire(blocking=False)
+
+    def leave(self):
+        self._slots.release()
+
+    @property
+    def last(self):
+        return self._seq
+
+    def event_id(self, seq):
+        return f'{self.epoch}-{seq}'
+
+    def parse_id(self, event_id):
+        """The sequence number of one of our event ids, or None for an id this feed did not issue."""
+        epoch, _, seq = (event_id or '').partition('-')
+        if epoch != self.epoch or not seq.isdigit() or int(seq) > self._seq:
+            return None
+        return int(seq)
+
+    def publish(self, entity, entity_id, op, fields=None, version=None, owner=None):
+        """
+        Appends an event. `owner` is the user the event concerns, if any:
+        members only receive loan and user events about themselves.
+        """
+        data = json.dumps({'entity': entity, 'id': entity_id, 'op': op, 'fields': fields or {}, 'version': version},
+                          default=str)
+        with self._publish_lock:
+            seq = self._seq + 1
+            frame = f'id: {self.event_id(seq)}\nevent: change\ndata: {data}\n\n'
+            self._ring[seq % len(self._ring)] = (seq, entity, owner, frame)
+            # Readers only look at slots up to _seq, so the event is complete before it is visible
+            self._seq = seq
+        self._pending.set()
+
+    def _dispatch(self):
+        while True:
+            self._pending.wait()
+            self._pending.clear()
+            with self._changed:
+                self._changed.notify_all()
+
+    def _ensure_dispatcher(self):
+        # Started by the first subscriber, in the process that serves it (threads do not survive a fork)
+        if self._dispatcher is None or not self._dispatcher.is_alive():
+            with self._dispatcher_lock:
+                if self._dispatcher is None or not self._dispatcher.is_alive():
+                    self._dispatcher = threading.Thread(target=self._dispatch, name='changefeed', daemon=True)
+                    self._dispatcher.start()
+
+    def after(self, seq):
+        """
+        Events published after `seq`, or None when some of them were already
+        replaced in the ring. Takes no lock: slots are read by sequence number
+        and a slot overwritten meanwhile shows a different one.
+        """
+        ring = self._ring
+        events = []
+        for n in range(seq + 1, self._seq + 1):
+            event = ring[n % len(ring)]
+            if event is None or event[0] != n:
+                return None
+            events.append(event)
+        return events
+
+    def wait(self, seq, timeout):
+        """Blocks until there are events after `seq` or `timeout` passes; see after()."""
+        self._ensure_dispatcher()
+        with self._changed:
+            self._changed.wait_for(lambda: self._seq != seq, timeout)
+        return self.after(seq)
+
+    def table_versions(self, app, tables, max_age):
+        """Current versions of `tables`, read at most once per `max_age` seconds for all streams."""
+        from versioning import current_versions
+
+        with self._versions_lock:
+            read_at, versions = self._versions
+            if versions is None or time.monotonic() - read_at >= max_age:
+                with app.app_context():
+                    versions = current_versions(tables)
+                    db.session.remove()
+                self._versions = (time.monotonic(), versions)
+            return versions
+
+
+feed = ChangeFeed()
+
+
+def visible(claims, entity, owner):
+    """Librarians see every event; members the catalog and their own loans and account."""
+    return claims.get('role') == 'librarian' or entity == 'book' or owner == claims.get('user_id')
+
+
+def changes(before, after):
+    """The fields of serialized row `after` that differ from `before`; all of them when there is no `before`."""
+    if before is None:
+        return after
+    return {key: value for key, value in after.items() if before.get(key) != value}
+
+
+def publish(entity, entity_id, op, fields=None, version=None, owner=None):
+    feed.publish(entity, entity_id, op, fields, version, owner)
+
+
+def publish_stock(book_ids, versions):
+    """Publishes the new stock of books whose copies moved, read with one query however many there are."""
+    from models import Book
+
+    books = Book.__table__
+    rows = db.session.execute(
+        select(books.c.id, books.c.quantity, books.c.available)
+        .where(books.c.id.in_(set(book_ids)))
+        .order_by(books.c.id)
+    )
+    for book_id, quantity, available in rows:
+        publish('book', book_id, 'update', {'quantity': quantity, 'available': available}, versions.get('books'))
+
+
+def token_revoked(app, claims):
+    from auth import is_revoked
+
+    with app.app_context():
+        try:
+            return is_revoked(claims)
+        finally:
+            db.session.remove()
+
+
+def stream(app, claims, seq, heartbeat, tables):
+    """
+    The body of an event stream after event `seq`, or a reset first when
+    `seq` is None (an id the feed cannot resume from). Every `heartbeat` seconds
+    without events it writes the table versions, which also lets the server
+    notice a closed connection. Ends when the process starts draining; the
+    client reconnects elsewhere. Also ends, after an `expired` event, when the
+    access token it was opened with expires or is revoked (checked every
+    `heartbeat` seconds); the client reconnects with a fresh token.
+    """
+    import health
+
+    yield f'retry: {RETRY_MS}\n\n'
+    if seq is None:
+        seq = feed.last
+        yield f'id: {feed.event_id(seq)}\nevent: {RESET}\ndata: {{}}\n\n'
+    check_at = time.monotonic() + heartbeat
+    while not health.is_draining():
+        remaining = claims['exp'] - time.time()
+        if time.monotonic() >= check_at:
+            check_at = time.monotonic() + heartbeat
+            if token_revoked(app, claims):
+                remaining = 0
+        if remaining <= 0:
+            yield f'event: {EXPIRED}\ndata: {{}}\n\n'
+            return
+        events = feed.wait(seq, min(heartbeat, remaining))
+        if events is None:
+            # Fell behind the ring buffer: the client must reload
+            seq = feed.last
+            yield f'id: {feed.event_id(seq)}\nevent: {RESET}\ndata: {{}}\n\n'
+            continue
+        if not events:
+            versions = feed.table_versions(app, tables, heartbeat)
+            yield f'event: versions\ndata: {json.dumps(versions, sort_keys=True)}\n\n'
+            continue
+        for seq, entity, owner, frame in events:
+            if visible(claims, entity, owner):
+                yield frame
+
+
+def init_app(app):
+    feed.configure(app.config.get('EVENTS_BUFFER_SIZE', 1000), app.config.get('EVENTS_MAX_SUBSCRIBERS', 1))
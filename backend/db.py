@@ -1,4 +1,35 @@
+from contextlib import contextmanager
+from flask import g, has_app_context
 from flask_sqlalchemy import SQLAlchemy
+from flask_sqlalchemy.session import Session
+from sqlalchemy.sql import Select
+
+
+class RoutingSession(Session):
+    """
+    Sends plain SELECTs to the read replica chosen for the current request
+    (g.db_replica, set by replicas.read_replica). Flushes, locking reads and
+    every other statement use the primary.
+    """
+
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        if bind is None and not self._flushing and has_app_context():
+            replica = g.get('db_replica')
+            if replica is not None and isinstance(clause, Select) and clause._for_update_arg is None:
+                return self._db.engines[replica]
+        return super().get_bind(mapper=mapper, clause=clause, bind=bind, **kwargs)
+
+
+@contextmanager
+def primary():
+    """Runs the block's reads on the primary, e.g. to load values that outlive the request."""
+    replica = g.pop('db_replica', None) if has_app_context() else None
+    try:
+        yield
+    finally:
+        if replica is not None:
+            g.db_replica = replica
+
 
 # Initialize SQLAlchemy
-db = SQLAlchemy()
+db = SQLAlchemy(session_options={'class_': RoutingSession})
@@ -0,0 +1,122 @@
+import time
+import weakref
+from sqlalchemy import event
+from sqlalchemy.engine import make_url
+from sqlalchemy.exc import TimeoutError as PoolTimeoutError
+from sqlalchemy.pool import QueuePool
+from db import db
+from metrics import Counter, Gauge, Histogram, registry
+
+# Database connection pool settings and instrumentation. engine_options()
+# turns the DB_* settings into SQLALCHEMY_ENGINE_OPTIONS: pool size and
+# overflow, how long a request may wait for a free connection (503 after
+# that instead of piling up threads), recycling below the server's idle
+# timeout, a pre-ping so connections the server dropped are replaced on
+# checkout instead of failing the request, and connect / statement timeouts.
+# Checkout times, timeouts, invalidated connections and pool saturation are
+# exported on /metrics.
+
+CHECKOUT_BUCKETS = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 30)
+
+_pools = weakref.WeakSet()
+
+
+def pool_samples(value):
+    return lambda: {(pool.label,): value(pool) for pool in list(_pools)}
+
+
+def saturation(pool):
+    capacity = pool.size() + max(pool._max_overflow, 0)
+    return round(pool.checkedout() / capacity, 4) if capacity else 0.0
+
+
+checkout_seconds = registry.add(Histogram(
+    'db_pool_checkout_seconds', 'Time to get a connection from the pool, including waiting for a free one.',
+    ('pool',), CHECKOUT_BUCKETS))
+checkout_timeouts = registry.add(Counter(
+    'db_pool_timeouts_total', 'Checkouts that gave up after DB_POOL_TIMEOUT.', ('pool',)))
+invalidations = registry.add(Counter(
+    'db_pool_invalidations_total', 'Connections discarded as disconnected, e.g. by the pre-ping.', ('pool',)))
+checked_out = registry.add(Gauge(
+    'db_pool_checked_out', 'Connections currently in use.', ('pool',), pool_samples(QueuePool.checkedout)))
+idle = registry.add(Gauge(
+    'db_pool_idle', 'Open connections waiting in the pool.', ('pool',), pool_samples(QueuePool.checkedin)))
+saturation_ratio = registry.add(Gauge(
+    'db_pool_saturation', 'Checked out connections over pool size plus max overflow.', ('pool',),
+    pool_samples(saturation)))
+
+
+class InstrumentedQueuePool(QueuePool):
+    """QueuePool that records checkout times in the metrics registry."""
+
+    label = 'default'
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        _pools.add(self)
+
+    def connect(self):
+        started = time.perf_counter()
+        try:
+            connection = super().connect()
+        except PoolTimeoutError:
+            registry.inc(checkout_timeouts, self.label)
+            raise
+        registry.observe(checkout_seconds, time.perf_counter() - started, self.label)
+        return connection
+
+    def recreate(self):
+        # engine.dispose() replaces the pool; keep reporting under the same name
+        pool = super().recreate()
+        pool.label = self.label
+        return pool
+
+
+def engine_options(config, uri=None):
+    """SQLALCHEMY_ENGINE_OPTIONS for `uri` (SQLALCHEMY_DATABASE_URI by default) from the DB_* settings."""
+    url = make_url(uri or config['SQLALCHEMY_DATABASE_URI'])
+    backend = url.get_backend_name()
+    if backend == 'sqlite' and url.database in (None, '', ':memory:'):
+        return {}  # In-memory SQLite shares a single connection, there is no pool to size
+
+    options = {
+        'poolclass': InstrumentedQueuePool,
+        'pool_size': config.get('DB_POOL_SIZE', 10),
+        'max_overflow': config.get('DB_MAX_OVERFLOW', 10),
+        'pool_timeout': config.get('DB_POOL_TIMEOUT', 5),
+        'pool_recycle': config.get('DB_POOL_RECYCLE', 1800),
+        'pool_pre_ping': config.get('DB_POOL_PRE_PING', True),
+    }
+
+    connect_timeout = config.get('DB_CONNECT_TIMEOUT', 0)
+    statement_timeout = config.get('DB_STATEMENT_TIMEOUT_MS', 0)
+    connect_args = {}
+    if backend == 'mysql':
+        if connect_timeout:
+            connect_args['connect_timeout'] = connect_timeout
+        if statement_timeout:
+            # MySQL only limits SELECT statements; writes are bounded by innodb_lock_wait_timeout
+            connect_args['init_command'] = f'SET SESSION max_execution_time = {int(statement_timeout)}'
+    elif backend == 'postgresql':
+        if connect_timeout:
+            connect_args['connect_timeout'] = connect_timeout
+        if statement_timeout:
+            connect_args['options'] = f'-c statement_timeout={int(statement_timeout)}'
+    if connect_args:
+        options['connect_args'] = connect_args
+    return options
+
+
+def init_app(app):
+    """Names the pools after their bind keys, counts invalidations and turns pool timeouts into 503s."""
+    with app.app_context():
+        for key, engine in db.engines.items():
+            label = key or 'default'
+            if isinstance(engine.pool, InstrumentedQueuePool):
+                engine.pool.label = label
+            # Listeners on the engine carry over to the pool that replaces this one on dispose()
+            event.listen(engine, 'invalidate', lambda *args, label=label: registry.inc(invalidations, label))
+
+    @app.errorhandler(PoolTimeoutError)
+    def pool_exhausted(e):
+        return {'message': 'The service is busy, please retry'}, 503, {'Retry-After': '1'}
@@ -0,0 +1,35 @@
+from flask import Blueprint, Response, current_app, request, jsonify
+from auth import current_claims
+from changefeed import feed, stream
+from flask_cors import CORS
+
+event_routes = Blueprint('events', __name__)
+CORS(event_routes)
+
+# Tables whose versions the heartbeat reports
+FEED_TABLES = ('books', 'loans', 'users')
+
+
+# Server-Sent Events: `change` events for book, loan and user writes, as
+# {"entity", "id", "op", "fields", "version"}. A reconnecting EventSource
+# sends Last-Event-ID and receives what it missed; when that is no longer
+# possible it gets a `reset` event and should reload. An `expired` event ends
+# the stream when its access token expires or is revoked. Each stream occupies
+# a request thread and holds no database connection between its checks.
+@event_routes.route('', methods=['GET'])
+def stream_events():
+    last_event_id = request.headers.get('Last-Event-ID', request.args.get('last_event_id'))
+    seq = feed.last if last_event_id is None else feed.parse_id(last_event_id)
+
+    if not feed.join():
+        response = jsonify({'message': 'Too many event streams; try again later'})
+        response.headers['Retry-After'] = '30'
+        return response, 503
+
+    app = current_app._get_current_object()
+    body = stream(app, current_claims(), seq, app.config['EVENTS_HEARTBEAT'], FEED_TABLES)
+    response = Response(body, mimetype='text/event-stream')
+    response.call_on_close(feed.leave)
+    response.headers['Cache-Control'] = 'no-cache'
+    response.headers['X-Accel-Buffering'] = 'no'  # Stops nginx from buffering the stream
+    return response
@@ -0,0 +1,67 @@
+import gc
+import multiprocessing
+import os
+import signal
+
+# gunicorn settings, read from the environment:
+#
+#   WEB_CONCURRENCY   worker processes (default 2 per CPU + 1)
+#   WEB_THREADS       threads per worker; above 1 uses the gthread worker. Also read by
+#                     config.py, which caps long polls and event streams by it
+#   WEB_PRELOAD       load the app once in the master and fork the workers from it,
+#                     so the code and the warmed indexes are shared copy-on-write
+#   DRAIN_SECONDS     on SIGTERM, how long a worker keeps serving with /readyz failing
+#                     before it stops accepting connections
+#
+# Size DB_POOL_SIZE + DB_MAX_OVERFLOW to at least WEB_THREADS: every thread may hold a
+# connection, and the pools are per worker.
+
+bind = os.getenv('BIND', f"0.0.0.0:{os.getenv('PORT', '5000')}")
+workers = int(os.getenv('WEB_CONCURRENCY', multiprocessing.cpu_count() * 2 + 1))
+threads = int(os.getenv('WEB_THREADS', 4))
+worker_class = 'gthread' if threads > 1 else 'sync'
+preload_app = os.getenv('WEB_PRELOAD', 'true').lower() == 'true'
+timeout = int(os.getenv('WEB_TIMEOUT', 30))
+keepalive = int(os.getenv('WEB_KEEPALIVE', 5))
+max_requests = int(os.getenv('WEB_MAX_REQUESTS', 0))  # Recycle workers after this many requests; 0 never
+max_requests_jitter = max_requests // 10
+accesslog = os.getenv('WEB_ACCESS_LOG') or None  # '-' for stdout
+
+DRAIN_SECONDS = float(os.getenv('DRAIN_SECONDS', 5))
+# Time after SIGTERM before the master kills workers: the drain plus the longest request
+graceful_timeout = int(DRAIN_SECONDS) + timeout
+
+
+def when_ready(server):
+    if not preload_app:
+        return
+    import health
+    import wsgi
+
+    # Connections must not be shared with the workers
+    health.dispose_engines(wsgi.app)
+    # Keep the collector from writing to the pages the workers share with the master
+    gc.freeze()
+
+
+def post_worker_init(worker):
+    import app
+    import health
+    import wsgi
+
+    if preload_app:
+        health.dispose_engines(wsgi.app, close=False)
+    app.start_background_tasks(wsgi.app)
+
+    def handle_term(sig, frame):
+        health.drain(DRAIN_SECONDS, lambda: worker.handle_exit(sig, frame))
+
+    signal.signal(signal.SIGTERM, handle_term)
+
+
+def worker_exit(server, worker):
+    import images
+    import passwords
+
+    passwords.passwords.shutdown(wait=False)
+    images.shutdown(wait=True)
@@ -0,0 +1,85 @@
+import logging
+import threading
+from flask import jsonify
+from sqlalchemy import text
+from sqlalchemy.exc import SQLAlchemyError
+from db import db
+
+logger = logging.getLogger(__name__)
+
+# Liveness and readiness. /healthz only says the process answers requests and
+# never touches the database, so a database outage does not get workers
+# restarted. /readyz says whether this process should receive traffic: it has
+# warmed up, is not draining and can reach the primary database. Draining
+# starts when the server is asked to stop: /readyz fails while requests are
+# still served, so the load balancer moves traffic away before the worker
+# stops accepting and finishes its in-flight requests.
+
+_ready = threading.Event()
+_draining = threading.Event()
+
+
+def ping(engine):
+    try:
+        with engine.connect() as connection:
+            connection.execute(text('SELECT 1'))
+        return 'ok'
+    except SQLAlchemyError:
+        return 'unreachable'
+
+
+def warm_up(app):
+    """Opens a connection to every database and builds the search index, then marks the process ready."""
+    from search_index import search_index
+    from versioning import table_version
+
+    with app.app_context():
+        for engine in db.engines.values():
+            ping(engine)
+        search_index.ensure_current(table_version('catalog'))
+    _ready.set()
+
+
+def dispose_engines(app, close=True):
+    """
+    Empties the connection pools. Before a fork with close=True; in the child
+    with close=False, so connections inherited from the parent are dropped
+    without closing the parent's sockets.
+    """
+    with app.app_context():
+        for engine in db.engines.values():
+            engine.dispose(close=close)
+
+
+def is_draining():
+    return _draining.is_set()
+
+
+def drain(seconds, stop):
+    """Fails readiness and keeps serving for `seconds`, then calls `stop` to end the worker."""
+    if _draining.is_set():
+        return
+    _draining.set()
+    logger.info('Draining for %.1f s before shutdown', seconds)
+    timer = threading.Timer(seconds, stop)
+    timer.daemon = True
+    timer.start()
+
+
+def init_app(app):
+    """Registers /healthz and /readyz."""
+
+    @app.route('/healthz', methods=['GET'])
+    def healthz():
+        return jsonify({'status': 'ok'})
+
+    @app.route('/readyz', methods=['GET'])
+    def readyz():
+        if _draining.is_set():
+            return jsonify({'status': 'draining'}), 503
+        if not _ready.is_set():
+            return jsonify({'status': 'starting'}), 503
+        # Replicas are reported but do not fail readiness; the primary does
+        databases = {key or 'primary': ping(engine) for key, engine in db.engines.items()}
+        ready = databases['primary'] == 'ok'
+        return jsonify({'status': 'ready' if ready else 'unavailable', 'databases': databases}), 200 if ready else 503
@@ -0,0 +1,114 @@
+from datetime import datetime
+from flask import Blueprint, current_app, request, jsonify
+from db import db
+from auth import current_claims
+from cache import get_book_data, get_user_data, invalidate_books
+from changefeed import publish_stock
+import holds
+from inventory import InventoryError, cancel_hold, run_with_retry
+import serializers
+from versioning import bump
+from flask_cors import CORS
+# Initialize Blueprint
+hold_routes = Blueprint('hold', __name__)
+CORS(hold_routes)
+
+
+def may_act_for(user_id):
+    """Members manage their own holds; librarians anyone's."""
+    claims = current_claims() or {}
+    return claims.get('role') == 'librarian' or claims.get('user_id') == user_id
+
+
+def hold_response(hold):
+    return {**serializers.hold(hold), 'position': holds.position(hold)}
+
+
+# Join the queue for a book with no copy on the shelf
+@hold_routes.route('/', methods=['POST'])
+def place_hold():
+    data = request.get_json() or {}
+    if 'book_id' not in data:
+        return jsonify({'message': 'book_id is required'}), 400
+    user_id = data.get('user_id', (current_claims() or {}).get('user_id'))
+    if not may_act_for(user_id):
+        return jsonify({'message': 'Insufficient permissions'}), 403
+
+    book = get_book_data(data['book_id'])
+    if not book:
+        return jsonify({'message': 'Book not found'}), 404
+    if not get_user_data(user_id):
+        return jsonify({'message': 'User not found'}), 404
+    if book['quantity'] > 0:
+        return jsonify({'message': 'Copies are available; borrow the book instead'}), 409
+
+    try:
+        hold_id = run_with_retry(lambda: holds.place(
+            user_id, data['book_id'], datetime.utcnow(), current_app.config['HOLD_LIMIT']
+        ))
+    except holds.HoldError as e:
+        db.session.rollback()
+        return jsonify({'message': e.message}), e.status
+    return jsonify({'message': 'Hold placed', 'hold': hold_response(holds.get(hold_id))}), 201
+
+
+# A member's open holds, with their place in each queue
+@hold_routes.route('/user/<int:user_id>', methods=['GET'])
+def get_holds_for_user(user_id):
+    if not may_act_for(user_id):
+        return jsonify({'message': 'Insufficient permissions'}), 403
+    return jsonify([hold_response(hold) for hold in holds.open_holds(user_id)])
+
+
+@hold_routes.route('/<int:hold_id>', methods=['GET'])
+def get_hold(hold_id):
+    hold = holds.get(hold_id)
+    if hold is None:
+        return jsonify({'message': 'Hold not found'}), 404
+    if not may_act_for(hold.user_id):
+        return jsonify({'message': 'Insufficient permissions'}), 403
+    return jsonify(hold_response(hold))
+
+
+# Long poll: answers as soon as the hold leaves ?status= (by default the status
+# it has now), e.g. when a copy is set aside for the member, or after ?timeout=
+# seconds with the unchanged hold. Clients call it again with the status they
+# last saw instead of polling the book.
+@hold_routes.route('/<int:hold_id>/wait', methods=['GET'])
+def wait_for_hold(hold_id):
+    hold = holds.get(hold_id)
+    if hold is None:
+        return jsonify({'message': 'Hold not found'}), 404
+    if not may_act_for(hold.user_id):
+        return jsonify({'message': 'Insufficient permissions'}), 403
+
+    max_timeout = current_app.config['HOLD_WAIT_TIMEOUT']
+    timeout = max(0, min(request.args.get('timeout', max_timeout, type=float), max_timeout))
+    try:
+        hold = holds.waiters.wait(hold_id, request.args.get('status', hold.status), timeout)
+    except holds.WaitersFull:
+        # Every long-poll slot of this process is busy: answer now and have the client come back later
+        response = jsonify(hold_response(hold))
+        response.headers['Retry-After'] = str(int(max_timeout))
+        return response
+    if hold is None:
+        return jsonify({'message': 'Hold not found'}), 404
+    return jsonify(hold_response(hold))
+
+
+# Leave the queue; a copy already kept for the hold goes to the next member
+@hold_routes.route('/<int:hold_id>', methods=['DELETE'])
+def delete_hold(hold_id):
+    hold = holds.get(hold_id)
+    if hold is None:
+        return jsonify({'message': 'Hold not found'}), 404
+    if not may_act_for(hold.user_id):
+        return jsonify({'message': 'Insufficient permissions'}), 403
+    try:
+        run_with_retry(lambda: cancel_hold(hold))
+    except InventoryError as e:
+        return jsonify({'message': e.message}), e.status
+    if hold.status == holds.READY:
+        invalidate_books(hold.book_id)
+        publish_stock([hold.book_id], bump('books'))
+    return jsonify({'message': 'Hold cancelled'}), 200
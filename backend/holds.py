@@ -0,0 +1,252 @@
+import threading
+import time
+from datetime import timedelta
+from sqlalchemy import event, func, insert, select, update
+from sqlalchemy.exc import IntegrityError
+from db import RoutingSession, db
+from models import Book, Hold
+
+# Hold queue for books with no copy on the shelf. Each book has a FIFO queue
+# of waiting holds, in id order. A copy coming back from a loan goes to the
+# first waiting hold instead of the shelf: the hold becomes ready and the copy
+# is kept for that member until its pickup deadline, and borrowing the book
+# claims it. Ready holds that are not picked up expire and their copy moves on
+# to the next member (see inventory.sweep_holds). Every status change is a
+# conditional UPDATE on the hold's current status, so concurrent returns,
+# borrows and sweeps never hand the same copy out twice. The stock side
+# (books.quantity and active_loans) is kept by inventory.py.
+#
+# Members wait for their hold with a long poll instead of polling the book.
+# Status changes are published after the transaction that made them commits
+# and wake the waiting requests of this process at once; requests waiting in
+# other processes see the change at their next recheck of the row.
+
+WAITING = 'waiting'
+READY = 'ready'
+FULFILLED = 'fulfilled'
+CANCELLED = 'cancelled'
+EXPIRED = 'expired'
+OPEN_STATUSES = (WAITING, READY)
+
+holds_table = Hold.__table__
+books_table = Book.__table__
+
+_pickup = timedelta(hours=48)
+
+
+class HoldError(Exception):
+    """A hold operation that cannot be applied, e.g. a second hold on the same book."""
+
+    def __init__(self, message, status=400):
+        super().__init__(message)
+        self.message = message
+        self.status = status
+
+
+class WaitersFull(Exception):
+    """Every long-poll slot of this process is taken; the client should retry later."""
+
+
+def changed(hold_id):
+    """Marks a hold as changed by the current transaction; waiters are woken once it commits."""
+    db.session.info.setdefault('changed_holds', set()).add(hold_id)
+
+
+def _after_commit(session):
+    hold_ids = session.info.pop('changed_holds', None)
+    if hold_ids:
+        waiters.wake(hold_ids)
+
+
+def _after_rollback(session):
+    session.info.pop('changed_holds', None)
+
+
+def get(hold_id):
+    return db.session.execute(select(holds_table).where(holds_table.c.id == hold_id)).first()
+
+
+def position(hold):
+    """1 for the head of the book's queue; None once the hold is no longer waiting."""
+    if hold.status != WAITING:
+        return None
+    return db.session.scalar(
+        select(func.count(holds_table.c.id))
+        .where(holds_table.c.book_id == hold.book_id, holds_table.c.status == WAITING, holds_table.c.id <= hold.id)
+    )
+
+
+def open_holds(user_id):
+    return db.session.execute(
+        select(holds_table)
+        .where(holds_table.c.user_id == user_id, holds_table.c.active_key == 1)
+        .order_by(holds_table.c.id)
+    ).all()
+
+
+def place(user_id, book_id, now, limit=None):
+    """Adds a waiting hold at the back of the book's queue and returns its id."""
+    if limit:
+        held = db.session.scalar(
+            select(func.count(holds_table.c.id)).where(holds_table.c.user_id == user_id, holds_table.c.active_key == 1)
+        )
+        if held >= limit:
+            raise HoldError(f'You can have at most {limit} holds at a time', 409)
+    try:
+        with db.session.begin_nested():
+            result = db.session.execute(insert(holds_table).values(
+                user_id=user_id, book_id=book_id, status=WAITING, active_key=1, created_at=now,
+            ))
+    except IntegrityError:
+        raise HoldError('You already have a hold on this book', 409)
+    hold_id = result.inserted_primary_key[0]
+    changed(hold_id)
+    return hold_id
+
+
+def transition(hold_id, from_status, to_status, now):
+    """Moves a hold from from_status to to_status; False if it was no longer in from_status."""
+    values = {'status': to_status}
+    if to_status == READY:
+        values.update(ready_at=now, expires_at=now + _pickup)
+    else:
+        values.update(active_key=None, closed_at=now)
+    result = db.session.execute(
+        update(holds_table).where(holds_table.c.id == hold_id, holds_table.c.status == from_status).values(**values)
+    )
+    if result.rowcount != 1:
+        return False
+    changed(hold_id)
+    return True
+
+
+def promote_next(book_id, now):
+    """Gives a copy to the first waiting hold on the book; returns its id, or None when nobody waits."""
+    while True:
+        hold_id = db.session.scalar(
+            select(holds_table.c.id)
+            .where(holds_table.c.book_id == book_id, holds_table.c.status == WAITING)
+            .order_by(holds_table.c.id)
+            .limit(1)
+        )
+        # A hold cancelled or promoted by a concurrent transaction is skipped
+        if hold_id is None or transition(hold_id, WAITING, READY, now):
+            return hold_id
+
+
+def claim(user_id, book_id, now):
+    """
+    Closes the member's open hold on the book as they borrow it. Returns True
+    when a copy was being kept for them, False when they must take one from the
+    shelf (no hold, or a hold still waiting).
+    """
+    while True:
+        hold = db.session.execute(
+            select(holds_table.c.id, holds_table.c.status)
+            .where(holds_table.c.user_id == user_id, holds_table.c.book_id == book_id, holds_table.c.active_key == 1)
+        ).first()
+        if hold is None:
+            return False
+        if transition(hold.id, hold.status, FULFILLED, now):
+            return hold.status == READY
+
+
+def open_for_books(user_id, book_ids):
+    """The member's open holds on any of the books: rows of book_id, status."""
+    return db.session.execute(
+        select(holds_table.c.book_id, holds_table.c.status)
+        .where(holds_table.c.user_id == user_id, holds_table.c.book_id.in_(book_ids), holds_table.c.active_key == 1)
+    ).all()
+
+
+def books_with_waiting(book_ids):
+    """The books among book_ids that have someone waiting for them."""
+    return set(db.session.scalars(
+        select(holds_table.c.book_id)
+        .where(holds_table.c.book_id.in_(book_ids), holds_table.c.status == WAITING)
+        .distinct()
+    ))
+
+
+def expired_ready(now, limit):
+    """Ready holds past their pickup deadline: rows of id, book_id."""
+    return db.session.execute(
+        select(holds_table.c.id, holds_table.c.book_id)
+        .where(holds_table.c.status == READY, holds_table.c.expires_at <= now)
+        .order_by(holds_table.c.expires_at)
+        .limit(limit)
+    ).all()
+
+
+def books_to_fill(limit):
+    """Books with waiting holds and copies on the shelf, e.g. after a librarian added copies."""
+    return db.session.scalars(
+        select(holds_table.c.book_id)
+        .join(books_table, books_table.c.id == holds_table.c.book_id)
+        .where(holds_table.c.status == WAITING, books_table.c.quantity > 0)
+        .distinct()
+        .limit(limit)
+    ).all()
+
+
+class Waiters:
+    """Requests blocked in a long poll, by hold id; at most max_waiters per process."""
+
+    def __init__(self, max_waiters=1, recheck=2.0):
+        self.max_waiters = max_waiters
+        self.recheck = recheck
+        self._slots = threading.BoundedSemaphore(max_waiters)
+        self._events = {}
+        self._lock = threading.Lock()
+
+    def configure(self, max_waiters, recheck):
+        self.max_waiters = max_waiters
+        self.recheck = recheck
+        self._slots = threading.BoundedSemaphore(max_waiters)
+
+    def wake(self, hold_ids):
+        with self._lock:
+            flags = [flag for hold_id in hold_ids for flag in self._events.get(hold_id, ())]
+        for flag in flags:
+            flag.set()
+
+    def wait(self, hold_id, seen_status, timeout):
+        """
+        Blocks until the hold's status is no longer seen_status, or timeout
+        seconds pass, and returns the hold row (None if it was deleted).
+        """
+        if not self._slots.acquire(blocking=False):
+            raise WaitersFull()
+        flag = threading.Event()
+        with self._lock:
+            self._events.setdefault(hold_id, []).append(flag)
+        try:
+            deadline = time.monotonic() + timeout
+            while True:
+                flag.clear()
+                hold = get(hold_id)
+                # Ends the read transaction: the next read sees new commits, and no
+                # pooled connection is held while the request sleeps
+                db.session.rollback()
+                remaining = deadline - time.monotonic()
+                if hold is None or hold.status != seen_status or remaining <= 0:
+                    return hold
+                flag.wait(min(self.recheck, remaining))
+        finally:
+            with self._lock:
+                self._events[hold_id].remove(flag)
+                if not self._events[hold_id]:
+                    del self._events[hold_id]
+            self._slots.release()
+
+
+waiters = Waiters()
+
+
+def init_app(app):
+    global _pickup
+    _pickup = timedelta(hours=app.config.get('HOLD_PICKUP_HOURS', 48))
+    waiters.configure(app.config.get('HOLD_MAX_WAITERS', 1), app.config.get('HOLD_WAIT_RECHECK', 2))
+    if not event.contains(RoutingSession, 'after_commit', _after_commit):
+        event.listen(RoutingSession, 'after_commit', _after_commit)
+        event.listen(RoutingSession, 'after_rollback', _after_rollback)
@@ -0,0 +1,132 @@
+import hashlib
+import logging
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+from sqlalchemy import update
+from db import db
+from models import Book
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:  # Pillow is optional; without it only the original file is stored
+    Image = None
+
+logger = logging.getLogger(__name__)
+
+COVERS_SUBDIR = 'covers'
+
+# Longest edge in pixels of each generated WebP variant
+COVER_VARIANTS = {
+    'thumb': 200,
+    'medium': 600,
+}
+# Variant whose URL is stored in books.image_url
+DISPLAY_VARIANT = 'medium'
+
+_executor = None
+_executor_lock = threading.Lock()
+
+# Latest upload per book, so a slow older job cannot overwrite a newer cover
+_pending = {}
+_pending_lock = threading.Lock()
+
+
+def get_executor(app):
+    """Creates the worker pool on first use, i.e. after any fork of the server process."""
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(
+                max_workers=app.config.get('IMAGE_WORKERS', 2),
+                thread_name_prefix='cover-images',
+            )
+        return _executor
+
+
+def write_once(path, data):
+    """Content-addressed write: existing files are identical, so they are left alone."""
+    if os.path.exists(path):
+        return
+    tmp_path = f'{path}.{threading.get_ident()}.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+
+
+def render_variant(image, max_edge):
+    variant = image.copy()
+    variant.thumbnail((max_edge, max_edge))
+    buffer = BytesIO()
+    variant.save(buffer, format='WEBP', quality=80, method=4)
+    return buffer.getvalue()
+
+
+def store_cover(folder, data, extension):
+    """
+    Writes the original and its WebP variants under <folder>/covers, named by
+    the SHA-256 of the upload. Returns the image_url to display.
+    """
+    digest = hashlib.sha256(data).hexdigest()
+    covers_dir = os.path.join(folder, COVERS_SUBDIR)
+    os.makedirs(covers_dir, exist_ok=True)
+
+    original_name = f'{digest}.{extension}'
+    write_once(os.path.join(covers_dir, original_name), data)
+    if Image is None:
+        return f'images/{COVERS_SUBDIR}/{original_name}'
+
+    with Image.open(BytesIO(data)) as image:
+        image = ImageOps.exif_transpose(image)
+        if image.mode not in ('RGB', 'RGBA'):
+            image = image.convert('RGBA' if 'transparency' in image.info else 'RGB')
+        for name, max_edge in COVER_VARIANTS.items():
+            path = os.path.join(covers_dir, f'{digest}-{name}.webp')
+            if not os.path.exists(path):
+                write_once(path, render_variant(image, max_edge))
+    return f'images/{COVERS_SUBDIR}/{digest}-{DISPLAY_VARIANT}.webp'
+
+
+def process_cover(app, book_id, data, extension, token):
+    try:
+        image_url = store_cover(app.config['UPLOAD_FOLDER'], data, extension)
+    except Exception:
+        logger.exception('Could not process cover image for book %s', book_id)
+        return
+
+    with _pending_lock:
+        if _pending.get(book_id) is not token:
+            return  # A newer upload for this book has been submitted
+        del _pending[book_id]
+
+    with app.app_context():
+        from cache import invalidate_books
+        from changefeed import publish
+        from versioning import bump
+
+        db.session.execute(update(Book.__table__).where(Book.__table__.c.id == book_id).values(image_url=image_url))
+        db.session.commit()
+        invalidate_books(book_id)
+        versions = bump('books')
+        publish('book', book_id, 'update', {'image_url': image_url}, versions.get('books'))
+
+
+def submit_cover(app, book_id, upload, extension):
+    """
+    Queues an uploaded cover for background processing and returns at once.
+    books.image_url is switched to the new cover when its variants are ready.
+    """
+    data = upload.read()
+    token = object()
+    with _pending_lock:
+        _pending[book_id] = token
+    return get_executor(app).submit(process_cover, app, book_id, data, extension.lower(), token)
+
+
+def shutdown(wait=True):
+    global _executor
+    with _executor_lock:
+        if _executor is not None:
+            _executor.shutdown(wait=wait)
+            _executor = None
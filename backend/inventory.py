@@ -0,0 +1,579 @@
+import json
+import logging
+import time
+from collections import Counter, defaultdict
+from datetime import datetime
+import click
+from flask.cli import with_appcontext
+from sqlalchemy import exists, func, insert, or_, select, update
+from sqlalchemy.exc import IntegrityError, OperationalError
+from db import db
+from models import Book, Loan, User
+from cache import invalidate_books
+from changefeed import publish_stock
+import analytics
+import holds
+import periodic
+from versioning import bump
+
+logger = logging.getLogger(__name__)
+
+# Inventory service: every change to books.quantity made by a loan goes through
+# here as a single conditional UPDATE, so concurrent borrows cannot oversell.
+# The same statements maintain the active loan counters on books and users
+# and loans.active_key, which backs the one-open-loan-per-(user, book) constraint,
+# and count the loan in the analytics rollups. Copies kept for a hold (see
+# holds.py) are neither on the shelf (quantity) nor on loan (active_loans).
+
+# MySQL deadlock and lock wait timeout error codes
+RETRYABLE_MYSQL_ERRORS = {1213, 1205}
+
+RETRY_ATTEMPTS = 3
+RETRY_BACKOFF = 0.05  # Seconds, doubled after each attempt
+
+books_table = Book.__table__
+loans_table = Loan.__table__
+users_table = User.__table__
+
+DUPLICATE_LOAN_MESSAGE = 'You need to return the first copy of the book before borrowing it again.'
+
+
+class InventoryError(Exception):
+    """A loan operation that cannot be applied, e.g. no copies left."""
+
+    def __init__(self, message, status=400):
+        super().__init__(message)
+        self.message = message
+        self.status = status
+
+
+class BatchError(InventoryError):
+    """An all-or-nothing batch with items that cannot be applied; `errors` maps each item to its InventoryError."""
+
+    def __init__(self, errors):
+        super().__init__(f'{len(errors)} item(s) cannot be applied; nothing was changed')
+        self.errors = errors
+
+
+class _Contended(Exception):
+    """A set-based step changed fewer rows than checked for: a concurrent write got there first."""
+
+
+def take_copy(book_id):
+    """
+    Atomically takes one copy of a book:
+    UPDATE books SET available = quantity > 1, quantity = quantity - 1,
+    active_loans = active_loans + 1 WHERE id = ? AND quantity > 0
+    Returns False when no copy was left. `available` is assigned first so it is
+    computed from the old quantity on every backend.
+    """
+    result = db.session.execute(
+        update(books_table)
+        .where(books_table.c.id == book_id, books_table.c.quantity > 0)
+        .ordered_values(
+            (books_table.c.available, books_table.c.quantity > 1),
+            (books_table.c.quantity, books_table.c.quantity - 1),
+            (books_table.c.active_loans, books_table.c.active_loans + 1),
+        )
+    )
+    return result.rowcount == 1
+
+
+def put_back_copy(book_id):
+    """Atomically returns one copy of a book to the shelf."""
+    db.session.execute(
+        update(books_table)
+        .where(books_table.c.id == book_id)
+        .ordered_values(
+            (books_table.c.available, books_table.c.quantity + 1 > 0),
+            (books_table.c.quantity, books_table.c.quantity + 1),
+            (books_table.c.active_loans, books_table.c.active_loans - 1),
+        )
+    )
+
+
+def set_aside_copy(book_id):
+    """A copy coming back from a loan that is kept for a hold instead of going on the shelf."""
+    db.session.execute(
+        update(books_table).where(books_table.c.id == book_id).values(active_loans=books_table.c.active_loans - 1)
+    )
+
+
+def return_copy(book_id, now):
+    """A copy coming back from a loan goes to the first member waiting for the book, or back on the shelf."""
+    if holds.promote_next(book_id, now):
+        set_aside_copy(book_id)
+    else:
+        put_back_copy(book_id)
+
+
+def lend_held_copy(book_id):
+    """Lends the copy that was kept for the borrower's hold."""
+    db.session.execute(
+        update(books_table).where(books_table.c.id == book_id).values(active_loans=books_table.c.active_loans + 1)
+    )
+
+
+def reserve_copy(book_id):
+    """Takes a copy off the shelf for a waiting hold; False when none is left."""
+    result = db.session.execute(
+        update(books_table)
+        .where(books_table.c.id == book_id, books_table.c.quantity > 0)
+        .ordered_values(
+            (books_table.c.available, books_table.c.quantity > 1),
+            (books_table.c.quantity, books_table.c.quantity - 1),
+        )
+    )
+    return result.rowcount == 1
+
+
+def shelve_held_copy(book_id):
+    """Puts a copy kept for a hold that nobody claimed back on the shelf."""
+    db.session.execute(
+        update(books_table)
+        .where(books_table.c.id == book_id)
+        .ordered_values(
+            (books_table.c.available, books_table.c.quantity + 1 > 0),
+            (books_table.c.quantity, books_table.c.quantity + 1),
+        )
+    )
+
+
+def take_copies(book_ids):
+    """take_copy for several distinct books in one UPDATE; returns how many of them had a copy left."""
+    result = db.session.execute(
+        update(books_table)
+        .where(books_table.c.id.in_(book_ids), books_table.c.quantity > 0)
+        .ordered_values(
+            (books_table.c.available, books_table.c.quantity > 1),
+            (books_table.c.quantity, books_table.c.quantity - 1),
+            (books_table.c.active_loans, books_table.c.active_loans + 1),
+        )
+    )
+    return result.rowcount
+
+
+def put_back_copies(counts):
+    """Returns copies to the shelf, counts mapping book id -> copies; one UPDATE per distinct count."""
+    by_count = defaultdict(list)
+    for book_id, copies in counts.items():
+        by_count[copies].append(book_id)
+    for copies, book_ids in by_count.items():
+        db.session.execute(
+            update(books_table)
+            .where(books_table.c.id.in_(book_ids))
+            .ordered_values(
+                (books_table.c.available, books_table.c.quantity + copies > 0),
+                (books_table.c.quantity, books_table.c.quantity + copies),
+                (books_table.c.active_loans, books_table.c.active_loans - copies),
+            )
+        )
+
+
+def adjust_user_loans(user_id, delta):
+    db.session.execute(
+        update(users_table)
+        .where(users_table.c.id == user_id)
+        .values(active_loans=users_table.c.active_loans + delta)
+    )
+
+
+def close_loan(loan_id, returned_at):
+    """Marks a loan returned only if it is still open; False if it was already returned."""
+    result = db.session.execute(
+        update(loans_table)
+        .where(loans_table.c.id == loan_id, loans_table.c.date_returned.is_(None))
+        .values(date_returned=returned_at, active_key=None)
+    )
+    return result.rowcount == 1
+
+
+def borrow(user_id, book_id, title, loan_date, return_date, date_returned=None):
+    """
+    Creates a loan, taking a copy of the book if the loan is still open: the
+    copy kept for the borrower's hold if they have a ready one, otherwise one
+    from the shelf. A second open loan of the same book by the same user is
+    rejected by the unique (user_id, book_id, active_key) constraint, not by a
+    prior SELECT.
+    """
+    is_open = date_returned is None
+    if is_open:
+        if holds.claim(user_id, book_id, datetime.utcnow()):
+            lend_held_copy(book_id)
+        elif not take_copy(book_id):
+            raise InventoryError('No copies available for borrowing')
+        adjust_user_loans(user_id, 1)
+    loan = Loan(
+        user_id=user_id,
+        book_id=book_id,
+        title=title,
+        loan_date=loan_date,
+        return_date=return_date,
+        date_returned=date_returned,
+        active_key=1 if is_open else None,
+    )
+    db.session.add(loan)
+    try:
+        db.session.flush()
+    except IntegrityError:
+        raise InventoryError(DUPLICATE_LOAN_MESSAGE)
+    analytics.count_loan(book_id, user_id, loan_date, date_returned)
+    return loan
+
+
+def give_back(loan_id, returned_at):
+    """Closes an open loan; its copy goes to the first member waiting for the book, or back on the shelf."""
+    loan = db.session.get(Loan, loan_id)
+    if loan is None:
+        raise InventoryError('Loan not found', 404)
+    if not close_loan(loan_id, returned_at):
+        raise InventoryError('Loan has already been returned')
+    return_copy(loan.book_id, returned_at)
+    adjust_user_loans(loan.user_id, -1)
+    analytics.count_return(loan.book_id, loan.user_id, returned_at)
+    return loan
+
+
+def discard_loan(loan):
+    """Deletes a loan, returning its copy if it was still open."""
+    if loan.date_returned is None:
+        return_copy(loan.book_id, datetime.utcnow())
+        adjust_user_loans(loan.user_id, -1)
+    analytics.count_loan(loan.book_id, loan.user_id, loan.loan_date, loan.date_returned, sign=-1)
+    db.session.delete(loan)
+
+
+def move_loan(loan, old_user_id, old_book_id, was_open):
+    """
+    Adjusts stock and counters after a loan has been edited in the session:
+    the old book gets its copy back if the loan was open (for the first member
+    waiting for it, as on a return) and the old user their loan, and the new
+    ones take it if the loan is open now. An open loan that stays open on the
+    same book keeps its copy; only the users' counters move.
+    """
+    is_open = loan.date_returned is None
+    loan.active_key = 1 if is_open else None
+    if was_open and is_open and old_book_id == loan.book_id:
+        if old_user_id != loan.user_id:
+            adjust_user_loans(old_user_id, -1)
+            adjust_user_loans(loan.user_id, 1)
+    else:
+        if was_open:
+            return_copy(old_book_id, datetime.utcnow())
+            adjust_user_loans(old_user_id, -1)
+        if is_open:
+            if not take_copy(loan.book_id):
+                raise InventoryError('Book not available for loan')
+            adjust_user_loans(loan.user_id, 1)
+    try:
+        db.session.flush()
+    except IntegrityError:
+        raise InventoryError(DUPLICATE_LOAN_MESSAGE)
+
+
+def borrow_many(user_id, titles, loan_date, return_date, atomic=True):
+    """
+    Lends several books to one member; `titles` maps each distinct book id to
+    its title. Open loans, holds and stock are checked for all the books with
+    one query each, then the copies are taken with one UPDATE and the loans
+    inserted with one INSERT, so the statements do not grow with the batch.
+    If a concurrent borrow gets in between the check and the UPDATE, the
+    batch falls back to borrow() one book at a time.
+
+    Returns (lent book ids, {book id: InventoryError}). With atomic=True any
+    error raises BatchError instead, for run_with_retry to roll back.
+    """
+    book_ids = list(titles)
+    on_loan = set(db.session.scalars(
+        select(loans_table.c.book_id)
+        .where(loans_table.c.user_id == user_id, loans_table.c.book_id.in_(book_ids), loans_table.c.active_key == 1)
+    ))
+    held = dict(holds.open_for_books(user_id, book_ids))
+    stock = dict(db.session.execute(
+        select(books_table.c.id, books_table.c.quantity).where(books_table.c.id.in_(book_ids))
+    ).all())
+    errors = {}
+    for book_id in book_ids:
+        if book_id in on_loan:
+            errors[book_id] = InventoryError(DUPLICATE_LOAN_MESSAGE)
+        elif held.get(book_id) != holds.READY and not stock.get(book_id):
+            errors[book_id] = InventoryError('No copies available for borrowing')
+    if errors and atomic:
+        raise BatchError(errors)
+    lend = [book_id for book_id in book_ids if book_id not in errors]
+    if not lend:
+        return [], errors
+
+    try:
+        with db.session.begin_nested():
+            now = datetime.utcnow()
+            from_shelf = [book_id for book_id in lend if book_id not in held]
+            # Books the member holds go through holds.claim like a single borrow; one statement each
+            for book_id in lend:
+                if book_id in held:
+                    if holds.claim(user_id, book_id, now):
+                        lend_held_copy(book_id)
+                    else:
+                        from_shelf.append(book_id)
+            if from_shelf and take_copies(from_shelf) != len(from_shelf):
+                raise _Contended()
+            adjust_user_loans(user_id, len(lend))
+            db.session.execute(insert(loans_table), [
+                {'user_id': user_id, 'book_id': book_id, 'title': titles[book_id], 'loan_date': loan_date,
+                 'return_date': return_date, 'date_returned': None, 'active_key': 1}
+                for book_id in lend
+            ])
+            analytics.count_many([(book_id, user_id, loan_date) for book_id in lend], 'borrows')
+    except (_Contended, IntegrityError):
+        lent = []
+        for book_id in lend:
+            try:
+                with db.session.begin_nested():
+                    borrow(user_id, book_id, titles[book_id], loan_date, return_date)
+                lent.append(book_id)
+            except InventoryError as e:
+                errors[book_id] = e
+        lend = lent
+        if errors and atomic:
+            raise BatchError(errors)
+    return lend, errors
+
+
+def give_back_many(loan_ids, returned_at, atomic=True):
+    """
+    Closes several open loans, of any members, with a few statements for the
+    whole batch: one SELECT, one UPDATE of the loans, one UPDATE per distinct
+    number of copies per book and one per member. Copies of books that
+    members are waiting for go to their holds, one statement each. Falls back
+    to give_back() one loan at a time if a concurrent return gets in between.
+
+    Returns (closed loan rows, {loan id: InventoryError}); with atomic=True
+    any error raises BatchError instead.
+    """
+    found = {row.id: row for row in db.session.execute(
+        select(loans_table.c.id, loans_table.c.user_id, loans_table.c.book_id, loans_table.c.date_returned)
+        .where(loans_table.c.id.in_(loan_ids))
+    )}
+    errors = {}
+    for loan_id in loan_ids:
+        if loan_id not in found:
+            errors[loan_id] = InventoryError('Loan not found', 404)
+        elif found[loan_id].date_returned is not None:
+            errors[loan_id] = InventoryError('Loan has already been returned')
+    if errors and atomic:
+        raise BatchError(errors)
+    closing = [found[loan_id] for loan_id in loan_ids if loan_id not in errors]
+    if not closing:
+        return [], errors
+
+    try:
+        with db.session.begin_nested():
+            result = db.session.execute(
+                update(loans_table)
+                .where(loans_table.c.id.in_([loan.id for loan in closing]), loans_table.c.date_returned.is_(None))
+                .values(date_returned=returned_at, active_key=None)
+            )
+            if result.rowcount != len(closing):
+                raise _Contended()
+            waited_for = holds.books_with_waiting({loan.book_id for loan in closing})
+            to_shelf = Counter()
+            for loan in closing:
+                if loan.book_id in waited_for and holds.promote_next(loan.book_id, returned_at):
+                    set_aside_copy(loan.book_id)
+                else:
+                    to_shelf[loan.book_id] += 1
+            put_back_copies(to_shelf)
+            for user_id, returned in Counter(loan.user_id for loan in closing).items():
+                adjust_user_loans(user_id, -returned)
+            analytics.count_many([(loan.book_id, loan.user_id, returned_at) for loan in closing], 'returns')
+    except _Contended:
+        closed = []
+        for loan in closing:
+            try:
+                with db.session.begin_nested():
+                    give_back(loan.id, returned_at)
+                closed.append(loan)
+            except InventoryError as e:
+                errors[loan.id] = e
+        closing = closed
+        if errors and atomic:
+            raise BatchError(errors)
+    return closing, errors
+
+
+def cancel_hold(hold):
+    """Cancels an open hold; a copy kept for it moves on to the next member or back on the shelf."""
+    now = datetime.utcnow()
+    if not holds.transition(hold.id, hold.status, holds.CANCELLED, now):
+        raise InventoryError('Hold is no longer open', 409)
+    if hold.status == holds.READY and not holds.promote_next(hold.book_id, now):
+        shelve_held_copy(hold.book_id)
+
+
+def sweep_holds(now=None, batch_size=500):
+    """
+    Expires ready holds past their pickup deadline, passing each copy to the
+    next member waiting for the book or back to the shelf, then gives copies on
+    the shelf to waiting holds. One batch per transaction. Returns the counts
+    and the ids of the books whose stock changed.
+    """
+    now = now or datetime.utcnow()
+    summary = {'expired': 0, 'filled': 0, 'books': set()}
+    while True:
+        rows = holds.expired_ready(now, batch_size)
+        for hold_id, book_id in rows:
+            if holds.transition(hold_id, holds.READY, holds.EXPIRED, now):
+                summary['expired'] += 1
+                if not holds.promote_next(book_id, now):
+                    shelve_held_copy(book_id)
+                    summary['books'].add(book_id)
+        db.session.commit()
+        if len(rows) < batch_size:
+            break
+
+    for book_id in holds.books_to_fill(batch_size):
+        while reserve_copy(book_id):
+            if holds.promote_next(book_id, now) is None:
+                shelve_held_copy(book_id)  # The queue emptied concurrently
+                break
+            summary['filled'] += 1
+            summary['books'].add(book_id)
+        db.session.commit()
+    return summary
+
+
+def is_retryable(error):
+    code = getattr(error.orig, 'args', (None,))[0]
+    return code in RETRYABLE_MYSQL_ERRORS or 'database is locked' in str(error.orig)
+
+
+def run_with_retry(operation, attempts=RETRY_ATTEMPTS):
+    """
+    Runs operation() and commits. Deadlocks and lock wait timeouts roll back
+    and retry with backoff; InventoryError rolls back and propagates.
+    """
+    delay = RETRY_BACKOFF
+    for attempt in range(1, attempts + 1):
+        try:
+            result = operation()
+            db.session.commit()
+            return result
+        except InventoryError:
+            db.session.rollback()
+            raise
+        except OperationalError as e:
+            db.session.rollback()
+            if attempt == attempts or not is_retryable(e):
+                raise
+            time.sleep(delay)
+            delay *= 2
+
+
+def reconcile_counters(batch_size=10000):
+    """
+    Recomputes books.active_loans, users.active_loans and loans.active_key
+    from the loans table, in id ranges so no lock is held for long. Returns
+    the number of rows corrected per table. Should report all zeros when
+    every write path has kept the counters in step.
+
+    active_key is cleared on returned loans and set again on open ones. Where
+    a user has several open loans of the same book, only the newest gets it,
+    as the unique index allows one; the others are left for a librarian.
+    """
+    fixed = {'loans': 0, 'books': 0, 'users': 0}
+
+    other = loans_table.alias('other')
+    max_id = db.session.scalar(select(func.max(loans_table.c.id))) or 0
+    for start in range(0, max_id + 1, batch_size):
+        in_range = (loans_table.c.id >= start, loans_table.c.id < start + batch_size)
+        result = db.session.execute(
+            update(loans_table)
+            .where(*in_range, loans_table.c.date_returned.isnot(None), loans_table.c.active_key.isnot(None))
+            .values(active_key=None)
+        )
+        fixed['loans'] += result.rowcount
+        # Open loans without a key that are the newest open loan of their user and book, which
+        # holds no key either. The derived table lets MySQL read from loans while updating it
+        keyless = (
+            select(loans_table.c.id)
+            .where(
+                *in_range,
+                loans_table.c.date_returned.is_(None),
+                loans_table.c.active_key.is_(None),
+                ~exists().where(
+                    other.c.user_id == loans_table.c.user_id,
+                    other.c.book_id == loans_table.c.book_id,
+                    other.c.date_returned.is_(None),
+                    or_(other.c.active_key.isnot(None), other.c.id > loans_table.c.id),
+                ),
+            )
+            .subquery('keyless')
+        )
+        result = db.session.execute(
+            update(loans_table).where(loans_table.c.id.in_(select(keyless.c.id))).values(active_key=1)
+        )
+        fixed['loans'] += result.rowcount
+        db.session.commit()
+
+    for table, key, counts in (
+        (books_table, 'books', loans_table.c.book_id),
+        (users_table, 'users', loans_table.c.user_id),
+    ):
+        max_id = db.session.scalar(select(func.max(table.c.id))) or 0
+        for start in range(0, max_id + 1, batch_size):
+            end = start + batch_size
+            active = (
+                select(func.count(loans_table.c.id))
+                .where(counts == table.c.id, loans_table.c.date_returned.is_(None))
+                .scalar_subquery()
+            )
+            result = db.session.execute(
+                update(table)
+                .where(table.c.id >= start, table.c.id < end, table.c.active_loans != active)
+                .values(active_loans=active)
+            )
+            fixed[key] += result.rowcount
+            db.session.commit()
+    return fixed
+
+
+@click.command('reconcile-loan-counters')
+@click.option('--batch-size', default=10000, show_default=True)
+@with_appcontext
+def reconcile_command(batch_size):
+    """Recomputes the denormalized active loan counters from the loans table."""
+    fixed = reconcile_counters(batch_size)
+    click.echo(f"Corrected {fixed['books']} books, {fixed['users']} users, {fixed['loans']} loans.")
+
+
+def run_hold_sweep(app):
+    with app.app_context():
+        try:
+            summary = sweep_holds()
+            if summary['books']:
+                invalidate_books(*summary['books'])
+                publish_stock(summary['books'], bump('books'))
+        except Exception:
+            db.session.rollback()
+            logger.exception('Hold sweep failed')
+
+
+def start_hold_sweeper(app):
+    """
+    Runs sweep_holds every HOLD_SWEEP_INTERVAL seconds in this process. Every
+    step is a conditional UPDATE, so sweepers in several processes can overlap;
+    `flask sweep-holds` from cron is the alternative.
+    """
+    return periodic.run_every(app, 'hold-sweep', app.config.get('HOLD_SWEEP_INTERVAL', 0), run_hold_sweep)
+
+
+@click.command('sweep-holds')
+@click.option('--batch-size', default=500, show_default=True)
+@with_appcontext
+def sweep_holds_command(batch_size):
+    """Expires holds that were not picked up and gives shelf copies to waiting holds."""
+    summary = sweep_holds(batch_size=batch_size)
+    if summary['books']:
+        invalidate_books(*summary['books'])
+        bump('books')
+    click.echo(json.dumps({'expired': summary['expired'], 'filled': summary['filled']}))
@@ -0,0 +1,49 @@
+from flask.json.provider import DefaultJSONProvider
+
+try:
+    import orjson
+except ImportError:  # orjson is optional; without it responses use the standard library encoder
+    orjson = None
+
+# JSON provider for jsonify and every dict a view returns. JSON_ENCODER picks
+# the encoder: 'orjson' (when installed) or 'stdlib' for Flask's default, and
+# 'auto' for orjson if available. Both produce the same documents: sorted
+# keys, dates as HTTP dates, compact output outside debug mode. orjson writes
+# non-ASCII text as UTF-8 instead of \u escapes.
+
+if orjson is not None:
+    ORJSON_OPTIONS = orjson.OPT_SORT_KEYS | orjson.OPT_NON_STR_KEYS | orjson.OPT_PASSTHROUGH_DATETIME
+
+
+class OrjsonProvider(DefaultJSONProvider):
+    """Encodes with orjson; falls back to the default provider for calls with json.dumps arguments."""
+
+    def _options(self):
+        options = ORJSON_OPTIONS | orjson.OPT_APPEND_NEWLINE
+        if (self.compact is None and self._app.debug) or self.compact is False:
+            options |= orjson.OPT_INDENT_2
+        return options
+
+    def dumps(self, obj, **kwargs):
+        if kwargs:
+            return super().dumps(obj, **kwargs)
+        # Dates, decimals and the like go through Flask's converter, like the default provider
+        return orjson.dumps(obj, default=self.default, option=ORJSON_OPTIONS).decode()
+
+    def loads(self, s, **kwargs):
+        if kwargs:
+            return super().loads(s, **kwargs)
+        return orjson.loads(s)
+
+    def response(self, *args, **kwargs):
+        obj = self._prepare_response_obj(args, kwargs)
+        body = orjson.dumps(obj, default=self.default, option=self._options())
+        return self._app.response_class(body, mimetype=self.mimetype)
+
+
+def init_app(app):
+    encoder = app.config.get('JSON_ENCODER', 'auto')
+    if encoder == 'orjson' and orjson is None:
+        raise RuntimeError('JSON_ENCODER=orjson requires the orjson package')
+    if encoder == 'orjson' or (encoder == 'auto' and orjson is not None):
+        app.json = OrjsonProvider(app)
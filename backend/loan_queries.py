@@ -0,0 +1,55 @@
+import math
+from sqlalchemy import func
+from db import db
+from models import Book, Loan
+
+# Query layer for loan listings and bulk loan deletes. Every function here
+# runs a fixed number of statements regardless of how many loans are involved:
+# listings project only the columns their endpoint returns, and relationship
+# access is replaced by joins.
+
+LOAN_LIST_COLUMNS = (
+    Loan.id,
+    Loan.title,
+    Loan.user_id,
+    Loan.book_id,
+    Loan.loan_date,
+    Loan.return_date,
+    Loan.date_returned,
+)
+
+
+def all_loans():
+    """Rows for GET /loans/, one SELECT with only the listed columns."""
+    return db.session.query(*LOAN_LIST_COLUMNS).all()
+
+
+def user_loans_page(user_id, page, per_page):
+    """
+    One page of a user's loans, newest first, with the book title joined in.
+    Returns (rows, total_pages) using one COUNT and one SELECT.
+    """
+    page = max(page, 1)
+    per_page = max(per_page, 1)
+    query = (
+        db.session.query(
+            Loan.id,
+            func.coalesce(Book.title, 'Unknown').label('title'),
+            Loan.loan_date,
+            Loan.date_returned,
+        )
+        .outerjoin(Book, Book.id == Loan.book_id)
+        .filter(Loan.user_id == user_id)
+    )
+    total = db.session.query(func.count(Loan.id)).filter(Loan.user_id == user_id).scalar()
+    rows = query.order_by(Loan.loan_date.desc(), Loan.id.desc()).offset((page - 1) * per_page).limit(per_page).all()
+    return rows, math.ceil(total / per_page)
+
+
+def delete_loans_for_book(book_id):
+    """Removes a book's loan history in one statement instead of loading the collection."""
+    Loan.query.filter(Loan.book_id == book_id).delete(synchronize_session=False)
+
+
+def delete_loans_for_user(user_id):
+    Loan.query.filter(Loan.user_id == user_id).delete(synchronize_session=False)
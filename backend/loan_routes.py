@@ -1,13 +1,68 @@
 import pytz
-from flask import Blueprint, request, jsonify
-from models import Loan, Book, User
+from flask import Blueprint, current_app, request, jsonify
+from sqlalchemy import select
+from models import Loan, Book
 from db import db
+from cache import get_book_data, get_user_data, invalidate_books
+from changefeed import changes, publish, publish_stock
+from inventory import (
+    BatchError, InventoryError, borrow, borrow_many, discard_loan, give_back, give_back_many, move_loan, run_with_retry,
+)
+from export import EXPORT_FORMATS, stream_export
+from loan_queries import LOAN_LIST_COLUMNS, all_loans, user_loans_page
+from suggest_index import suggest_index
+import analytics
+import serializers
+from replicas import read_replica, stick
+from versioning import bump, conditional
 from datetime import datetime, timedelta
 from flask_cors import CORS
 # Initialize Blueprint
 loan_routes = Blueprint('loan', __name__)
 CORS(loan_routes)
 
+# Called after a loan write commits: refresh cached stock and the ETag versions,
+# publish the books' new stock and return the new table versions
+def stock_changed(*book_ids):
+    invalidate_books(*book_ids)
+    versions = bump('books', 'loans')
+    publish_stock(book_ids, versions)
+    return versions
+
+# Publishes a written loan to the change feed, for its borrower and librarians;
+# with `before`, its serialized state before the write, only the changed fields
+def loan_written(loan, op, versions, before=None):
+    fields = changes(before, serializers.loan(loan))
+    publish('loan', loan.id, op, fields, versions.get('loans'), owner=loan.user_id)
+
+# Checks the id list of a batch request; returns an error message or None
+def batch_problem(ids, mode):
+    if not isinstance(ids, list) or not ids or not all(isinstance(item, int) for item in ids):
+        return 'A non-empty list of ids is required'
+    if len(set(ids)) != len(ids):
+        return 'Each id may be listed once'
+    if len(ids) > current_app.config['LOAN_BATCH_MAX']:
+        return f"At most {current_app.config['LOAN_BATCH_MAX']} items per batch"
+    if mode not in ('atomic', 'partial'):
+        return 'mode must be atomic or partial'
+    return None
+
+# Per-item outcome of a batch in request order: the error of each failed item, `done` fields for the others
+def batch_results(key, ids, errors, done):
+    return [
+        {key: item, 'status': errors[item].status, 'message': errors[item].message} if item in errors
+        else {key: item, **done[item]}
+        for item in ids
+    ]
+
+# An atomic batch that changed nothing, with the items that could not be applied
+def batch_rejected(key, ids, errors):
+    failed = [item for item in ids if item in errors]
+    return jsonify({
+        'message': 'Nothing was changed: some items cannot be applied',
+        'results': batch_results(key, failed, errors, {}),
+    }), 400
+
 @loan_routes.route('/<int:loan_id>', methods=['PUT'])
 def update_loan(loan_id):
     data = request.get_json()
@@ -17,14 +72,19 @@ def update_loan(loan_id):
     if not loan:
         return jsonify({"message": "Loan not found"}), 404
 
+    before = serializers.loan(loan)
+    old_book_id = loan.book_id
+    old_user_id = loan.user_id
+    was_open = loan.date_returned is None
+    counted_as = (loan.book_id, loan.user_id, loan.loan_date, loan.date_returned)
+
     # Update loan fields
     loan.book_id = data.get('book_id', loan.book_id)
     loan.user_id = data.get('user_id', loan.user_id)
     loan.loan_date = data.get('loan_date', loan.loan_date)
     loan.title = data.get('title', loan.title)
     loan.return_date = data.get('return_date', loan.return_date)
-    if loan.book_id:
-        book = Book.query.get(loan.book_id)
+    book = Book.query.get(loan.book_id) if loan.book_id else None
     if book:
         loan.title = book.title 
     # Handle clearing of the date_returned (marking the loan as ongoing)
@@ -39,18 +99,18 @@ def update_loan(loan_id):
     else:
         loan.date_returned = loan_date_returned  # If provided, set it as usual
 
-
-    # Handle increasing quantity based on date_returned
-    book = Book.query.get(loan.book_id)
-    if book:
-        if loan.date_returned:  # If date_returned is set (book returned)
-            book.quantity += 1  # Increase quantity when the book is returned
-        else:  # If date_returned is cleared or not set (book still loaned out)
-            book.quantity -= 1  # Decrease quantity when the book is loaned out
-
+    # Only move stock and counters when the loan changes book or user, or switches between open and returned
     try:
+        move_loan(loan, old_user_id, old_book_id, was_open)
+        # Move the loan's borrow and return in the analytics rollups to its edited dates
+        analytics.count_loan(*counted_as, sign=-1)
+        analytics.count_loan(loan.book_id, loan.user_id, loan.loan_date, loan.date_returned)
         db.session.commit()
+        loan_written(loan, 'update', stock_changed(old_book_id, loan.book_id), before)
         return jsonify({"message": "Loan updated successfully"}), 200
+    except InventoryError as e:
+        db.session.rollback()
+        return jsonify({'message': e.message}), e.status
     except Exception as e:
         db.session.rollback()
         return jsonify({'message': 'Error updating loan', 'error': str(e)}), 500
@@ -64,109 +124,120 @@ def borrow_book():
     if 'user_id' not in data or 'book_id' not in data:
         return jsonify({'message': 'user_id, book_id, and return_date are required'}), 400
     
-    # Ensure the book exists and is available
-    book = Book.query.get(data['book_id'])
+    # Ensure the book exists (availability is checked atomically when the copy is taken)
+    book = get_book_data(data['book_id'])
     if not book:
         return jsonify({'message': 'Book not found'}), 404
-    if book.quantity <= 0:  # Check if the book has any available copies left
-        return jsonify({'message': 'No copies available for borrowing'}), 400
     
     # Ensure the user exists
-    user = User.query.get(data['user_id'])
+    user = get_user_data(data['user_id'])
     if not user:
         return jsonify({'message': 'User not found'}), 404
     
-    # Check if the user has already borrowed the book and has not returned it
-    active_loan = Loan.query.filter_by(user_id=data['user_id'], book_id=data['book_id'], date_returned=None).first()
-    if active_loan:
-        return jsonify({
-        'success': False, 
-        'message': 'You need to return the first copy of the book before borrowing it again.'
-        }), 400
-    
     serbia_tz = pytz.timezone('Europe/Belgrade')
+    now = datetime.now(serbia_tz)
     
-    # Create new loan record
-    loan = Loan(
-        user_id=data['user_id'],
-        book_id=data['book_id'],
-        title=book.title,
-        loan_date=datetime.now(serbia_tz),
-        return_date=datetime.now(serbia_tz) + timedelta(days=30)
-    )
-    
-    # Update the book's quantity
-    book.quantity -= 1  # Decrease the quantity by 1
-
-    # If no copies are left, mark the book as unavailable
-    if book.quantity == 0:
-        book.available = False
-
+    # Take a copy and create the loan record in one transaction; a second open
+    # loan of the same book is rejected by the uq_loans_one_active constraint
     try:
-        db.session.add(loan)
-        db.session.commit()
+        loan = run_with_retry(lambda: borrow(
+            user_id=data['user_id'],
+            book_id=data['book_id'],
+            title=book['title'],
+            loan_date=now,
+            return_date=now + timedelta(days=30)
+        ))
+        loan_written(loan, 'create', stock_changed(loan.book_id))
+        suggest_index.record_loan(loan.book_id)
+        stick(loan.user_id)  # The borrower sees the loan even when a librarian made it
         return jsonify({"success": True, "message": "Book borrowed successfully!"}), 201
+    except InventoryError as e:
+        return jsonify({'success': False, 'message': e.message}), e.status
     except Exception as e:
         db.session.rollback()
         return jsonify({'message': 'Error borrowing book', 'error': str(e)}), 500
 
+# Checkout desk: lend several books to one member with a constant number of
+# statements. {"user_id", "book_ids": [...], "mode": "atomic" | "partial"};
+# atomic (the default) lends every book or none, partial lends what it can
+# and reports the rest per book id
+@loan_routes.route('/borrow/batch', methods=['POST'])
+def borrow_books():
+    data = request.get_json() or {}
+    book_ids = data.get('book_ids')
+    mode = data.get('mode', 'atomic')
+    if 'user_id' not in data:
+        return jsonify({'message': 'user_id is required'}), 400
+    problem = batch_problem(book_ids, mode)
+    if problem:
+        return jsonify({'message': problem}), 400
+    if not get_user_data(data['user_id']):
+        return jsonify({'message': 'User not found'}), 404
+
+    titles = dict(db.session.execute(select(Book.id, Book.title).where(Book.id.in_(book_ids))).all())
+    errors = {book_id: InventoryError('Book not found', 404) for book_id in book_ids if book_id not in titles}
+    if errors and mode == 'atomic':
+        return batch_rejected('book_id', book_ids, errors)
+
+    serbia_tz = pytz.timezone('Europe/Belgrade')
+    now = datetime.now(serbia_tz)
+    try:
+        lent, failed = run_with_retry(lambda: borrow_many(
+            data['user_id'], titles, now, now + timedelta(days=30), atomic=mode == 'atomic'
+        ))
+    except BatchError as e:
+        return batch_rejected('book_id', book_ids, e.errors)
+    errors.update(failed)
+
+    done = {}
+    if lent:
+        versions = stock_changed(*lent)
+        for loan in db.session.execute(select(Loan.__table__).where(
+            Loan.user_id == data['user_id'], Loan.book_id.in_(lent), Loan.active_key == 1
+        )):
+            loan_written(loan, 'create', versions)
+            done[loan.book_id] = {'status': 201, 'loan_id': loan.id}
+            suggest_index.record_loan(loan.book_id)
+        stick(data['user_id'])
+    return jsonify({
+        'results': batch_results('book_id', book_ids, errors, done),
+        'succeeded': len(lent),
+        'failed': len(errors),
+    }), 201 if not errors else 207
+
 # Get all loans
 @loan_routes.route('/', methods=['GET'])
+@read_replica
+@conditional('loans')
 def get_loans():
-    loans = Loan.query.all()
+    fmt = request.args.get('format')
+    if fmt:
+        if fmt not in EXPORT_FORMATS:
+            return jsonify({'message': f'Unsupported format: {fmt}'}), 400
+        return stream_export(db.session.query(*LOAN_LIST_COLUMNS).order_by(Loan.id), fmt, 'loans')
 
     # Return list of loans including the date_returned field
-    return jsonify([{
-        'id': loan.id,
-        'title': loan.title,
-        'user_id': loan.user_id,
-        'book_id': loan.book_id,
-        'loan_date': loan.loan_date.strftime('%Y-%m-%d'),
-        'return_date': loan.return_date.strftime('%Y-%m-%d'),
-        'date_returned': loan.date_returned.strftime('%Y-%m-%d') if loan.date_returned else None
-    } for loan in loans]), 200
+    return jsonify(serializers.loan.many(all_loans())), 200
 
 # Get a specific loan by ID
 @loan_routes.route('/<int:id>', methods=['GET'])
+@conditional('loans')
 def get_loan(id):
     loan = Loan.query.get(id)
 
     if loan:
-        return jsonify({
-            'id': loan.id,
-            'user_id': loan.user_id,
-            'book_id': loan.book_id,
-            'title': loan.title,
-            'loan_date': loan.loan_date.strftime('%Y-%m-%d'),
-            'return_date': loan.return_date.strftime('%Y-%m-%d'),
-            'date_returned': loan.date_returned.strftime('%Y-%m-%d') if loan.date_returned else None
-        }), 200
+        return jsonify(serializers.loan(loan)), 200
     else:
         return jsonify({'message': 'Loan not found'}), 404
 
 # Return a borrowed book
 @loan_routes.route('/return/<int:id>', methods=['PUT'])
 def return_book(id):
-    loan = Loan.query.get(id)
-    
-    if not loan:
-        return jsonify({'message': 'Loan not found'}), 404
-    
-    # Ensure the book is returned on or before the return date
-    loan.book.available = True  # Mark the book as available again
-    loan.date_returned = datetime.utcnow()
-    
-    # Increase the book's quantity by 1
-    loan.book.quantity += 1
-
-    # If the quantity is greater than 0, ensure the book is marked as available
-    if loan.book.quantity > 0:
-        loan.book.available = True
-    else:
-        loan.book.available = False  # If no copies left, mark as unavailable
-    
+    # Close the loan and put the copy back in one transaction; a second return is rejected
     try:
-        db.session.commit()
+        loan = run_with_retry(lambda: give_back(id, datetime.utcnow()))
+        loan_written(loan, 'update', stock_changed(loan.book_id))
+        stick(loan.user_id)
 
         # Return the updated loan data including the date_returned
         updated_loan = {
@@ -177,39 +248,69 @@ def return_book(id):
         }
 
         return jsonify(updated_loan), 200
+    except InventoryError as e:
+        return jsonify({'message': e.message}), e.status
     except Exception as e:
         db.session.rollback()
         return jsonify({'message': 'Error returning book', 'error': str(e)}), 500
 
+# Returns at the desk: closes several loans, of any members, with a constant
+# number of statements. {"loan_ids": [...], "mode": "atomic" | "partial"}
+@loan_routes.route('/return/batch', methods=['PUT'])
+def return_books():
+    data = request.get_json() or {}
+    loan_ids = data.get('loan_ids')
+    mode = data.get('mode', 'atomic')
+    problem = batch_problem(loan_ids, mode)
+    if problem:
+        return jsonify({'message': problem}), 400
+
+    try:
+        closed, errors = run_with_retry(lambda: give_back_many(loan_ids, datetime.utcnow(), atomic=mode == 'atomic'))
+    except BatchError as e:
+        return batch_rejected('loan_id', loan_ids, e.errors)
+
+    done = {}
+    if closed:
+        versions = stock_changed(*{loan.book_id for loan in closed})
+        for loan in db.session.execute(select(Loan.__table__).where(Loan.id.in_([loan.id for loan in closed]))):
+            loan_written(loan, 'update', versions)
+            done[loan.id] = {
+                'status': 200, 'book_id': loan.book_id, 'date_returned': serializers.day(loan.date_returned),
+            }
+        for user_id in {loan.user_id for loan in closed}:
+            stick(user_id)
+    return jsonify({
+        'results': batch_results('loan_id', loan_ids, errors, done),
+        'succeeded': len(closed),
+        'failed': len(errors),
+    }), 200 if not errors else 207
+
 # Get all loans for a specific user
 @loan_routes.route('/user/<int:user_id>', methods=['GET'])
+@read_replica
+@conditional('loans', 'books')
 def get_loans_for_user(user_id):
     page = request.args.get('page', 1, type=int)
     limit = request.args.get('limit', 10, type=int)
     
-    # Query for loans, sorted by loan_date in descending order (newest first)
-    loans_query = Loan.query.filter_by(user_id=user_id).order_by(Loan.loan_date.desc()).paginate(page=page, per_page=limit, error_out=False)
-    
-    loans = loans_query.items
-    total_pages = loans_query.pages
-
-    loan_data = [{
-        'id': loan.id,
-        'title': loan.book.title if loan.book else "Unknown",
-        'loan_date': loan.loan_date,
-        'date_returned': loan.date_returned,
-    } for loan in loans]
+    # Loans sorted by loan_date in descending order (newest first), with the book title joined in
+    loans, total_pages = user_loans_page(user_id, page, limit)
 
     return jsonify({
-        'loans': loan_data,
+        'loans': serializers.user_loan.many(loans),
         'totalPages': total_pages,
     })
 @loan_routes.route('/<int:loan_id>', methods=['DELETE'])
 def delete_loan(loan_id):
     loan = Loan.query.get(loan_id)
     if loan:
-        db.session.delete(loan)
+        book_id, user_id = loan.book_id, loan.user_id
+        # Deleting an open loan puts its copy back
+        discard_loan(loan)
         db.session.commit()
+        versions = stock_changed(book_id)
+        publish('loan', loan_id, 'delete', version=versions.get('loans'), owner=user_id)
         return jsonify({'message': 'Loan deleted successfully'}), 200
     return jsonify({'message': 'Loan not found'}), 404
 
@@ -225,16 +326,12 @@ def add_loan():
                 return jsonify({'error': f'Missing field: {field}'}), 400
 
         # Check if book exists
-        book = Book.query.get(data['book_id'])
+        book = get_book_data(data['book_id'])
         if not book:
             return jsonify({'error': 'Book not found'}), 404
 
-        # Check if the book is available
-        if book.quantity <= 0:
-            return jsonify({'error': 'Book not available for loan'}), 400
-
         # Check if user exists
-        user = User.query.get(data['user_id'])
+        user = get_user_data(data['user_id'])
         if not user:
             return jsonify({'error': 'User not found'}), 404
 
@@ -242,21 +339,21 @@ def add_loan():
         date_returned = data.get('date_returned', None)
         if date_returned == "":
             date_returned = None
-        # Create and save new loan
-        new_loan = Loan(
-            book_id=data['book_id'],
-            user_id=data['user_id'],
-            loan_date=data['loan_date'],
-            return_date=data['return_date'],
-            title=data['title'],
-            date_returned=date_returned
-        )
-
-        # Update book quantity
-        book.quantity -= 1
-
-        db.session.add(new_loan)
-        db.session.commit()
+        # Create and save new loan, taking a copy if the loan is still open
+        try:
+            new_loan = run_with_retry(lambda: borrow(
+                book_id=data['book_id'],
+                user_id=data['user_id'],
+                loan_date=data['loan_date'],
+                return_date=data['return_date'],
+                title=data['title'],
+                date_returned=date_returned
+            ))
+        except InventoryError as e:
+            return jsonify({'error': e.message}), e.status
+
+        loan_written(new_loan, 'create', stock_changed(new_loan.book_id))
+        suggest_index.record_loan(new_loan.book_id)
 
         return jsonify({
             'message': 'Loan added successfully',
@@ -0,0 +1,196 @@
+import logging
+import threading
+import time
+from contextlib import contextmanager
+from flask import Response, g, request
+
+logger = logging.getLogger(__name__)
+
+# Request instrumentation exported in the Prometheus text format on /metrics.
+# Values are kept per process: with several server workers each one reports
+# its own series, so scrape every worker (or sum them in the query).
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+STATEMENT_BUCKETS = (1, 2, 3, 5, 10, 20, 50, 100)
+SIZE_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304)
+AUTH_BUCKETS = (0.00001, 0.000025, 0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025)
+
+
+def escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def format_labels(names, values):
+    if not names:
+        return ''
+    return '{' + ','.join(f'{name}="{escape(value)}"' for name, value in zip(names, values)) + '}'
+
+
+def format_value(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    def __init__(self, name, documentation, labels=()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = labels
+        self.values = {}
+
+    def inc(self, *label_values, amount=1):
+        self.values[label_values] = self.values.get(label_values, 0) + amount
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} counter']
+        for label_values, value in sorted(self.values.items()):
+            lines.append(f'{self.name}{format_labels(self.labels, label_values)} {format_value(value)}')
+        return lines
+
+
+class Histogram:
+    def __init__(self, name, documentation, labels=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labels = labels
+        self.buckets = buckets
+        self.series = {}  # label values -> [bucket counts..., sum, count]
+
+    def observe(self, value, *label_values):
+        series = self.series.get(label_values)
+        if series is None:
+            series = self.series[label_values] = [0] * len(self.buckets) + [0.0, 0]
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                series[i] += 1
+        series[-2] += value
+        series[-1] += 1
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} histogram']
+        names = self.labels + ('le',)
+        for label_values, series in sorted(self.series.items()):
+            for bound, count in zip(self.buckets, series):
+                lines.append(f'{self.name}_bucket{format_labels(names, label_values + (bound,))} {count}')
+            lines.append(f'{self.name}_bucket{format_labels(names, label_values + ("+Inf",))} {series[-1]}')
+            labels = format_labels(self.labels, label_values)
+            lines.append(f'{self.name}_sum{labels} {format_value(series[-2])}')
+            lines.append(f'{self.name}_count{labels} {series[-1]}')
+        return lines
+
+
+class Gauge:
+    """Sampled when rendered: `collect` returns {label values: value}."""
+
+    def __init__(self, name, documentation, labels=(), collect=dict):
+        self.name = name
+        self.documentation = documentation
+        self.labels = labels
+        self.collect = collect
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} gauge']
+        for label_values, value in sorted(self.collect().items()):
+            lines.append(f'{self.name}{format_labels(self.labels, label_values)} {format_value(value)}')
+        return lines
+
+
+class Registry:
+    """All metrics of the process; observations and rendering share one lock."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.metrics = []
+
+    def add(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def observe(self, metric, value, *label_values):
+        with self.lock:
+            metric.observe(value, *label_values)
+
+    def inc(self, metric, *label_values, amount=1):
+        with self.lock:
+            metric.inc(*label_values, amount=amount)
+
+    def render(self):
+        with self.lock:
+            lines = []
+            for metric in self.metrics:
+                lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+
+registry = Registry()
+
+ENDPOINT_LABELS = ('endpoint', 'method')
+
+request_seconds = registry.add(Histogram(
+    'http_request_duration_seconds', 'Time spent handling the request.', ENDPOINT_LABELS + ('status',)))
+sql_statements = registry.add(Histogram(
+    'http_request_sql_statements', 'SQL statements executed per request.', ENDPOINT_LABELS, STATEMENT_BUCKETS))
+sql_seconds = registry.add(Histogram(
+    'http_request_sql_seconds', 'Time spent in SQL statements per request.', ENDPOINT_LABELS))
+response_bytes = registry.add(Histogram(
+    'http_response_size_bytes', 'Response body size; streamed responses are not counted.', ENDPOINT_LABELS,
+    SIZE_BUCKETS))
+jwt_seconds = registry.add(Histogram(
+    'jwt_verification_seconds', 'Time spent verifying the access token of a request.', buckets=AUTH_BUCKETS))
+slow_requests = registry.add(Counter(
+    'http_slow_requests_total', 'Requests slower than SLOW_REQUEST_MS.', ENDPOINT_LABELS))
+
+
+def endpoint_label():
+    # The URL rule rather than the path, so /books/1 and /books/2 share a series
+    return request.url_rule.rule if request.url_rule else 'unmatched'
+
+
+@contextmanager
+def jwt_timer():
+    """Times the access token check of the current request."""
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        registry.observe(jwt_seconds, time.perf_counter() - started)
+
+
+def log_slow_request(response, elapsed):
+    lines = [
+        f'Slow request {request.method} {request.full_path.rstrip("?")} -> {response.status_code} '
+        f"{elapsed * 1000:.1f} ms, {g.get('sql_count', 0)} statements in {g.get('sql_time', 0.0) * 1000:.1f} ms"
+    ]
+    for statement, seconds in g.get('sql_statements', []):
+        lines.append(f"  {seconds * 1000:8.2f} ms  {' '.join(statement.split())}")
+    logger.warning('\n'.join(lines))
+
+
+def init_app(app):
+    """Registers the timing hooks and the /metrics endpoint."""
+    slow_ms = app.config.get('SLOW_REQUEST_MS', 0)
+
+    @app.before_request
+    def start_timer():
+        g.request_started = time.perf_counter()
+        g.capture_sql = slow_ms > 0
+
+    @app.after_request
+    def record_request(response):
+        started = g.pop('request_started', None)
+        if started is None:
+            return response
+        elapsed = time.perf_counter() - started
+        labels = (endpoint_label(), request.method)
+        registry.observe(request_seconds, elapsed, *labels, response.status_code)
+        registry.observe(sql_statements, g.get('sql_count', 0), *labels)
+        registry.observe(sql_seconds, g.get('sql_time', 0.0), *labels)
+        if not response.is_streamed and response.content_length is not None:
+            registry.observe(response_bytes, response.content_length, *labels)
+        if slow_ms and elapsed * 1000 >= slow_ms:
+            registry.inc(slow_requests, *labels)
+            log_slow_request(response, elapsed)
+        return response
+
+    @app.route('/metrics', methods=['GET'])
+    def metrics():
+        return Response(registry.render(), mimetype='text/plain; version=0.0.4')
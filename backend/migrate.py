@@ -0,0 +1,125 @@
+import importlib.util
+import os
+import re
+from datetime import datetime
+import click
+from flask.cli import with_appcontext
+from sqlalchemy import inspect, text
+from db import db
+
+# Versioned schema migrations. Each file in migrations/ is named
+# NNNN_description.py and defines upgrade(conn). Applied versions are
+# recorded in schema_migrations, so `flask db-upgrade` only runs new files.
+# Migrations check the live schema before each change, which lets them run
+# against databases created from the old TablesCreation.sql as well as ones
+# created with db.create_all().
+
+MIGRATIONS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'migrations')
+MIGRATION_FILE_RE = re.compile(r'^(\d{4})_(\w+)\.py$')
+
+
+def discover():
+    """Returns [(version, name, path)] for every migration file, in order."""
+    migrations = []
+    for filename in sorted(os.listdir(MIGRATIONS_DIR)):
+        match = MIGRATION_FILE_RE.match(filename)
+        if match:
+            migrations.append((match.group(1), match.group(2), os.path.join(MIGRATIONS_DIR, filename)))
+    return migrations
+
+
+def load(path):
+    spec = importlib.util.spec_from_file_location(f'migration_{os.path.basename(path)[:-3]}', path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def ensure_version_table(conn):
+    conn.execute(text(
+        'CREATE TABLE IF NOT EXISTS schema_migrations ('
+        'version VARCHAR(20) PRIMARY KEY, '
+        'name VARCHAR(100) NOT NULL, '
+        'applied_at DATETIME NOT NULL)'
+    ))
+
+
+def applied_versions(conn):
+    ensure_version_table(conn)
+    return {row[0] for row in conn.execute(text('SELECT version FROM schema_migrations'))}
+
+
+def upgrade(engine, target=None, echo=print):
+    """Applies pending migrations up to `target` (inclusive), each in its own transaction."""
+    with engine.begin() as conn:
+        done = applied_versions(conn)
+    for version, name, path in discover():
+        if target is not None and version > target:
+            break
+        if version in done:
+            continue
+        echo(f'Applying {version}_{name}')
+        with engine.begin() as conn:
+            load(path).upgrade(conn)
+            conn.execute(
+                text('INSERT INTO schema_migrations (version, name, applied_at) VALUES (:v, :n, :t)'),
+                {'v': version, 'n': name, 't': datetime.utcnow()},
+            )
+
+
+def status(engine):
+    with engine.begin() as conn:
+        done = applied_versions(conn)
+    return [(version, name, version in done) for version, name, _ in discover()]
+
+
+# Helpers for migration files
+
+def has_table(conn, table):
+    return inspect(conn).has_table(table)
+
+
+def has_column(conn, table, column):
+    return any(c['name'] == column for c in inspect(conn).get_columns(table))
+
+
+def has_index(conn, table, name):
+    return any(i['name'] == name for i in inspect(conn).get_indexes(table))
+
+
+def add_column(conn, table, column, ddl):
+    """ALTER TABLE ... ADD COLUMN unless the column already exists."""
+    if not has_column(conn, table, column):
+        conn.execute(text(f'ALTER TABLE {table} ADD COLUMN {column} {ddl}'))
+
+
+def create_index(conn, table, name, columns, unique=False):
+    """CREATE INDEX unless an index with that name already exists on the table."""
+    if not has_index(conn, table, name):
+        kind = 'UNIQUE INDEX' if unique else 'INDEX'
+        conn.execute(text(f"CREATE {kind} {name} ON {table} ({', '.join(columns)})"))
+
+
+def drop_index(conn, table, name):
+    if has_index(conn, table, name):
+        if conn.dialect.name == 'mysql':
+            conn.execute(text(f'DROP INDEX {name} ON {table}'))
+        else:
+            conn.execute(text(f'DROP INDEX {name}'))
+
+
+@click.command('db-upgrade')
+@click.option('--to', 'target', help='Stop after this version, e.g. 0002.')
+@with_appcontext
+def upgrade_command(target):
+    """Applies pending schema migrations."""
+    upgrade(db.engine, target, echo=click.echo)
+    click.echo('Schema is up to date.')
+
+
+@click.command('db-status')
+@with_appcontext
+def status_command():
+    """Lists schema migrations and whether they have been applied."""
+    for version, name, applied in status(db.engine):
+        click.echo(f"{'applied' if applied else 'pending':8} {version}_{name}")
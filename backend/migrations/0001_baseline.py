@@ -0,0 +1,77 @@
+"""
+Baseline: creates missing tables and adds the columns the schema gained
+after the original TablesCreation.sql (emails and names on users, stock and
+covers on books, title and return timestamp on loans).
+
+The tables are defined here as they were at this version rather than taken
+from models.py, so later model changes never alter what this migration does;
+the migrations after it add the rest.
+"""
+from sqlalchemy import (
+    BigInteger, Boolean, Column, Date, DateTime, Enum, ForeignKey, Integer, MetaData, String, Table, text, true,
+)
+from migrate import add_column, has_column
+
+metadata = MetaData()
+
+users = Table(
+    'users', metadata,
+    Column('id', Integer, primary_key=True),
+    Column('username', String(50), nullable=False, unique=True),
+    Column('password', String(255), nullable=False),
+    Column('role', Enum('member', 'librarian'), nullable=False),
+    Column('email', String(120), unique=True, nullable=False),
+    Column('name', String(100)),
+    Column('last_name', String(100)),
+)
+
+books = Table(
+    'books', metadata,
+    Column('id', Integer, primary_key=True),
+    Column('title', String(100), nullable=False),
+    Column('author', String(100), nullable=False),
+    Column('available', Boolean, server_default=true()),
+    Column('quantity', Integer, server_default='0'),
+    Column('image_url', String(255), nullable=True),
+)
+
+loans = Table(
+    'loans', metadata,
+    Column('id', Integer, primary_key=True),
+    Column('user_id', Integer, ForeignKey('users.id', ondelete='CASCADE'), nullable=False),
+    Column('book_id', Integer, ForeignKey('books.id', ondelete='CASCADE'), nullable=False),
+    Column('loan_date', Date, nullable=False),
+    Column('title', String(100), nullable=False),
+    Column('return_date', Date, nullable=False),
+    Column('date_returned', DateTime, nullable=True),
+)
+
+table_versions = Table(
+    'table_versions', metadata,
+    Column('name', String(50), primary_key=True),
+    Column('version', BigInteger, nullable=False, server_default='0'),
+    Column('updated_at', DateTime, nullable=True),
+)
+
+
+def upgrade(conn):
+    metadata.create_all(conn, checkfirst=True)
+
+    if not has_column(conn, 'users', 'email'):
+        add_column(conn, 'users', 'email', 'VARCHAR(120) NULL')
+        # Existing accounts get a placeholder address so the column can become NOT NULL UNIQUE
+        # (the original schema only ever ran on MySQL)
+        if conn.dialect.name == 'mysql':
+            conn.execute(text("UPDATE users SET email = CONCAT(username, '@example.invalid') WHERE email IS NULL"))
+            conn.execute(text('ALTER TABLE users MODIFY email VARCHAR(120) NOT NULL'))
+        conn.execute(text('CREATE UNIQUE INDEX email ON users (email)'))
+    add_column(conn, 'users', 'name', 'VARCHAR(100) NULL')
+    add_column(conn, 'users', 'last_name', 'VARCHAR(100) NULL')
+
+    add_column(conn, 'books', 'quantity', 'INT DEFAULT 0')
+    add_column(conn, 'books', 'image_url', 'VARCHAR(255) NULL')
+
+    if not has_column(conn, 'loans', 'title'):
+        add_column(conn, 'loans', 'title', "VARCHAR(100) NOT NULL DEFAULT ''")
+        conn.execute(text('UPDATE loans SET title = (SELECT title FROM books WHERE books.id = loans.book_id)'))
+    add_column(conn, 'loans', 'date_returned', 'DATETIME NULL')
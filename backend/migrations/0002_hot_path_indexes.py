@@ -0,0 +1,18 @@
+"""
+Secondary indexes for the hot loan and catalog queries:
+
+- loans (user_id, book_id, date_returned): duplicate active loan check in borrow
+- loans (user_id, loan_date, id): a user's loan history, newest first, and its COUNT
+- loans (book_id, date_returned): active loan check and bulk delete for a book
+- books (title): title prefix search and keyset pages sorted by (title, id)
+- books (author): author prefix filter on the catalog listing
+"""
+from migrate import create_index
+
+
+def upgrade(conn):
+    create_index(conn, 'loans', 'ix_loans_user_book_returned', ['user_id', 'book_id', 'date_returned'])
+    create_index(conn, 'loans', 'ix_loans_user_loan_date', ['user_id', 'loan_date', 'id'])
+    create_index(conn, 'loans', 'ix_loans_book_returned', ['book_id', 'date_returned'])
+    create_index(conn, 'books', 'ix_books_title', ['title'])
+    create_index(conn, 'books', 'ix_books_author', ['author'])
@@ -0,0 +1,26 @@
+"""
+Installs the availability triggers from AvailabiltyTrigger.sql (MySQL only),
+so books.available follows books.quantity on INSERT as well as UPDATE, also
+for writes made outside the application.
+"""
+from sqlalchemy import text
+
+TRIGGER_BODY = """
+FOR EACH ROW
+BEGIN
+    IF NEW.quantity > 0 THEN
+        SET NEW.available = TRUE;
+    ELSE
+        SET NEW.available = FALSE;
+    END IF;
+END
+"""
+
+
+def upgrade(conn):
+    if conn.dialect.name != 'mysql':
+        return
+    for timing in ('insert', 'update'):
+        name = f'update_availability_before_{timing}'
+        conn.execute(text(f'DROP TRIGGER IF EXISTS {name}'))
+        conn.execute(text(f'CREATE TRIGGER {name} BEFORE {timing.upper()} ON books {TRIGGER_BODY}'))
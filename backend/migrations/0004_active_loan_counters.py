@@ -0,0 +1,35 @@
+"""
+Denormalized active loan counters and the one-open-loan-per-(user, book) rule:
+
+- books.active_loans, users.active_loans: open loans, kept by inventory.py
+- loans.active_key: 1 while a loan is open, NULL once returned
+- uq_loans_one_active (user_id, book_id, active_key): NULLs never collide, so
+  only open loans are constrained
+
+Existing duplicate open loans keep active_key only on the newest one, so the
+index can be created; `flask reconcile-loan-counters` can be rerun at any time.
+"""
+from sqlalchemy import text
+from migrate import add_column, create_index
+
+
+def upgrade(conn):
+    add_column(conn, 'books', 'active_loans', 'INTEGER NOT NULL DEFAULT 0')
+    add_column(conn, 'users', 'active_loans', 'INTEGER NOT NULL DEFAULT 0')
+    add_column(conn, 'loans', 'active_key', 'SMALLINT NULL')
+
+    # The derived table lets MySQL read from loans while updating it
+    conn.execute(text(
+        'UPDATE loans SET active_key = 1 WHERE id IN ('
+        'SELECT id FROM (SELECT MAX(id) AS id FROM loans WHERE date_returned IS NULL '
+        'GROUP BY user_id, book_id) AS newest)'
+    ))
+    conn.execute(text(
+        'UPDATE books SET active_loans = ('
+        'SELECT COUNT(*) FROM loans WHERE loans.book_id = books.id AND loans.date_returned IS NULL)'
+    ))
+    conn.execute(text(
+        'UPDATE users SET active_loans = ('
+        'SELECT COUNT(*) FROM loans WHERE loans.user_id = users.id AND loans.date_returned IS NULL)'
+    ))
+    create_index(conn, 'loans', 'uq_loans_one_active', ['user_id', 'book_id', 'active_key'], unique=True)
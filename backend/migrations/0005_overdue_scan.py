@@ -0,0 +1,45 @@
+"""
+Overdue scan: loans.fine_cents, the (date_returned, return_date, id) index the
+scan walks, the notifications outbox and the job_checkpoints table.
+"""
+from sqlalchemy import (
+    BigInteger, Column, Date, DateTime, ForeignKey, Index, Integer, MetaData, String, Table, Text, UniqueConstraint,
+)
+from migrate import add_column, create_index
+
+metadata = MetaData()
+
+# Only the keys the foreign keys point at; these tables exist already
+Table('users', metadata, Column('id', Integer, primary_key=True))
+Table('loans', metadata, Column('id', Integer, primary_key=True))
+
+notifications = Table(
+    'notifications', metadata,
+    Column('id', Integer, primary_key=True),
+    Column('user_id', Integer, ForeignKey('users.id', ondelete='CASCADE'), nullable=False),
+    Column('loan_id', Integer, ForeignKey('loans.id', ondelete='CASCADE'), nullable=True),
+    Column('kind', String(50), nullable=False),
+    Column('payload', Text, nullable=False),
+    Column('created_at', DateTime, nullable=False),
+    Column('sent_at', DateTime, nullable=True),
+    UniqueConstraint('loan_id', 'kind', name='uq_notifications_loan_kind'),
+    Index('ix_notifications_unsent', 'sent_at', 'id'),
+)
+
+job_checkpoints = Table(
+    'job_checkpoints', metadata,
+    Column('name', String(50), primary_key=True),
+    Column('status', String(20), nullable=False, server_default='done'),
+    Column('as_of', Date, nullable=True),
+    Column('position', String(255), nullable=True),
+    Column('processed', BigInteger, nullable=False, server_default='0'),
+    Column('locked_until', DateTime, nullable=True),
+    Column('updated_at', DateTime, nullable=True),
+)
+
+
+def upgrade(conn):
+    add_column(conn, 'loans', 'fine_cents', 'INTEGER NOT NULL DEFAULT 0')
+    create_index(conn, 'loans', 'ix_loans_open_due', ['date_returned', 'return_date', 'id'])
+    for table in (notifications, job_checkpoints):
+        table.create(conn, checkfirst=True)
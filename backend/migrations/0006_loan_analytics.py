@@ -0,0 +1,47 @@
+"""
+Loan analytics: the book_daily_loans and user_daily_loans rollups, filled
+from the existing loans history, and the loans (loan_date) index the
+rollup rebuild walks.
+
+The backfill is plain SQL kept here, not analytics.rebuild_days, so this
+migration keeps doing the same thing whatever analytics.py becomes.
+"""
+from sqlalchemy import Column, Date, Integer, MetaData, Table, text
+from migrate import create_index
+
+metadata = MetaData()
+
+book_daily_loans = Table(
+    'book_daily_loans', metadata,
+    Column('day', Date, primary_key=True),
+    Column('book_id', Integer, primary_key=True),  # No foreign key: a deleted book's rows go with the next rebuild of their days
+    Column('borrows', Integer, nullable=False, server_default='0'),
+    Column('returns', Integer, nullable=False, server_default='0'),
+)
+
+user_daily_loans = Table(
+    'user_daily_loans', metadata,
+    Column('day', Date, primary_key=True),
+    Column('user_id', Integer, primary_key=True),
+    Column('borrows', Integer, nullable=False, server_default='0'),
+    Column('returns', Integer, nullable=False, server_default='0'),
+)
+
+
+def upgrade(conn):
+    create_index(conn, 'loans', 'ix_loans_loan_date', ['loan_date'])
+    for table in (book_daily_loans, user_daily_loans):
+        table.create(conn, checkfirst=True)
+
+    # A borrow counts on its loan_date, a return on the day of date_returned
+    for table, key in ((book_daily_loans, 'book_id'), (user_daily_loans, 'user_id')):
+        conn.execute(text(f'DELETE FROM {table.name}'))
+        conn.execute(text(
+            f'INSERT INTO {table.name} (day, {key}, borrows, returns) '
+            f'SELECT day, {key}, SUM(borrows), SUM(returns) FROM ('
+            f'SELECT loan_date AS day, {key}, 1 AS borrows, 0 AS returns FROM loans '
+            f'UNION ALL '
+            f'SELECT DATE(date_returned) AS day, {key}, 0 AS borrows, 1 AS returns FROM loans '
+            f'WHERE date_returned IS NOT NULL'
+            f') AS events GROUP BY day, {key}'
+        ))
@@ -0,0 +1,31 @@
+"""
+Hold queue: the holds table, with its per-book queue index, the expiry sweep
+index and the one-open-hold-per-(user, book) unique index.
+"""
+from sqlalchemy import Column, DateTime, ForeignKey, Index, Integer, MetaData, SmallInteger, String, Table
+
+metadata = MetaData()
+
+# Only the keys the foreign keys point at; these tables exist already
+Table('users', metadata, Column('id', Integer, primary_key=True))
+Table('books', metadata, Column('id', Integer, primary_key=True))
+
+holds = Table(
+    'holds', metadata,
+    Column('id', Integer, primary_key=True),
+    Column('user_id', Integer, ForeignKey('users.id', ondelete='CASCADE'), nullable=False),
+    Column('book_id', Integer, ForeignKey('books.id', ondelete='CASCADE'), nullable=False),
+    Column('status', String(20), nullable=False, server_default='waiting'),
+    Column('active_key', SmallInteger, nullable=True),
+    Column('created_at', DateTime, nullable=False),
+    Column('ready_at', DateTime, nullable=True),
+    Column('expires_at', DateTime, nullable=True),
+    Column('closed_at', DateTime, nullable=True),
+    Index('ix_holds_book_queue', 'book_id', 'status', 'id'),
+    Index('ix_holds_status_expires', 'status', 'expires_at'),
+    Index('uq_holds_one_active', 'user_id', 'book_id', 'active_key', unique=True),
+)
+
+
+def upgrade(conn):
+    holds.create(conn, checkfirst=True)
@@ -0,0 +1,19 @@
+"""
+Revoked tokens: the jti of every token revoked by logout until its expiry,
+so that every server process refuses it, and the index the purge of expired
+entries uses.
+"""
+from sqlalchemy import Column, DateTime, Index, MetaData, String, Table
+
+metadata = MetaData()
+
+revoked_tokens = Table(
+    'revoked_tokens', metadata,
+    Column('jti', String(64), primary_key=True),
+    Column('expires_at', DateTime, nullable=False),
+    Index('ix_revoked_tokens_expires_at', 'expires_at'),
+)
+
+
+def upgrade(conn):
+    revoked_tokens.create(conn, checkfirst=True)
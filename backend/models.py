@@ -1,4 +1,5 @@
 from db import db
+import serializers
 
 # Users Table Model
 class User(db.Model):
@@ -11,9 +12,11 @@ class User(db.Model):
     email = db.Column(db.String(120), unique=True, nullable=False)  # Ensure email is defined
     name = db.Column(db.String(100))
     last_name = db.Column(db.String(100))
+    active_loans = db.Column(db.Integer, nullable=False, default=0, server_default='0')  # Maintained by inventory.py
 
     # Relationships
-    loans = db.relationship('Loan', backref='user', lazy=True,cascade='all, delete-orphan')
+    # passive_deletes: loans are removed in bulk (or by ON DELETE CASCADE) instead of being loaded first
+    loans = db.relationship('Loan', backref='user', lazy=True,cascade='all, delete-orphan', passive_deletes=True)
 
     def __repr__(self):
         return f'<User {self.username}>'
@@ -21,6 +24,10 @@ class User(db.Model):
 # Books Table Model
 class Book(db.Model):
     __tablename__ = 'books'
+    __table_args__ = (
+        db.Index('ix_books_title', 'title'),  # Title prefix search, (title, id) keyset pages
+        db.Index('ix_books_author', 'author'),  # Author prefix filter
+    )
     
     id = db.Column(db.Integer, primary_key=True)
     title = db.Column(db.String(100), nullable=False)
@@ -28,19 +35,13 @@ class Book(db.Model):
     available = db.Column(db.Boolean, default=True)
     quantity = db.Column(db.Integer, default=0)  # Add quantity field
     image_url = db.Column(db.String(255), nullable=True)  # Add image_url field
+    active_loans = db.Column(db.Integer, nullable=False, default=0, server_default='0')  # Maintained by inventory.py
 
     # Relationships
-    loans = db.relationship('Loan', backref='book', cascade='all, delete-orphan')
+    loans = db.relationship('Loan', backref='book', cascade='all, delete-orphan', passive_deletes=True)
     def to_dict(self):
         """Converts the Book object to a dictionary for JSON response."""
-        return {
-            'id': self.id,
-            'title': self.title,
-            'author': self.author,
-            'available': self.available,
-            'quantity':self.quantity,
-            'image_url': self.image_url
-        }
+        return serializers.book(self)
 
     def __repr__(self):
         return f'<Book {self.title}>'
@@ -48,25 +49,130 @@ class Book(db.Model):
 # Loans Table Model
 class Loan(db.Model):
     __tablename__ = 'loans'
+    __table_args__ = (
+        db.Index('ix_loans_user_book_returned', 'user_id', 'book_id', 'date_returned'),  # Active loan check in borrow
+        db.Index('ix_loans_user_loan_date', 'user_id', 'loan_date', 'id'),  # User loan history, newest first
+        db.Index('ix_loans_book_returned', 'book_id', 'date_returned'),  # Active loans of a book
+        db.Index('ix_loans_open_due', 'date_returned', 'return_date', 'id'),  # Overdue scan, (return_date, id) keyset
+        db.Index('ix_loans_loan_date', 'loan_date'),  # Analytics rebuild by day range
+        # At most one open loan per (user, book): active_key is 1 while open and NULL once returned
+        db.Index('uq_loans_one_active', 'user_id', 'book_id', 'active_key', unique=True),
+    )
     
     id = db.Column(db.Integer, primary_key=True)
-    user_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False)
-    book_id = db.Column(db.Integer, db.ForeignKey('books.id'), nullable=False)
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id', ondelete='CASCADE'), nullable=False)
+    book_id = db.Column(db.Integer, db.ForeignKey('books.id', ondelete='CASCADE'), nullable=False)
     loan_date = db.Column(db.Date, nullable=False)
     title = db.Column(db.String(100), nullable=False)
     return_date = db.Column(db.Date, nullable=False)
     date_returned = db.Column(db.DateTime,nullable=True)
+    active_key = db.Column(db.SmallInteger, nullable=True)
+    fine_cents = db.Column(db.Integer, nullable=False, default=0, server_default='0')  # As of the last overdue scan
 
     def to_dict(self):
-        return {
-            'id': self.id,
-            'book_id': self.book_id,
-            'user_id': self.user_id,
-            'loan_date': self.loan_date.isoformat() if self.loan_date else None,
-            'return_date': self.return_date.isoformat() if self.return_date else None,
-            'date_returned': self.date_returned.isoformat() if self.date_returned else None,
-            'book': self.book.title if self.book else None,  # Assuming Book has a 'title' attribute
-            'user': self.user.username if self.user else None,  # Assuming User has a 'username' attribute
-        }
+        """Touches book and user, one SELECT each unless they are already loaded."""
+        return serializers.loan_with_relations(self)
     def __repr__(self):
         return f'<Loan User {self.user_id} - Book {self.book_id}>'
+
+# Per-table version counters for HTTP conditional requests
+class TableVersion(db.Model):
+    __tablename__ = 'table_versions'
+
+    name = db.Column(db.String(50), primary_key=True)
+    version = db.Column(db.BigInteger, nullable=False, default=0)
+    updated_at = db.Column(db.DateTime, nullable=True)
+
+    def __repr__(self):
+        return f'<TableVersion {self.name} {self.version}>'
+
+# Token ids revoked by logout, kept until the token would have expired anyway
+class RevokedToken(db.Model):
+    __tablename__ = 'revoked_tokens'
+    __table_args__ = (db.Index('ix_revoked_tokens_expires_at', 'expires_at'),)
+
+    jti = db.Column(db.String(64), primary_key=True)
+    expires_at = db.Column(db.DateTime, nullable=False)
+
+    def __repr__(self):
+        return f'<RevokedToken {self.jti}>'
+
+# Outbox of notifications for users, written by batch jobs and drained by a mailer
+class Notification(db.Model):
+    __tablename__ = 'notifications'
+    __table_args__ = (
+        db.UniqueConstraint('loan_id', 'kind', name='uq_notifications_loan_kind'),  # One reminder per loan and level
+        db.Index('ix_notifications_unsent', 'sent_at', 'id'),
+    )
+
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id', ondelete='CASCADE'), nullable=False)
+    loan_id = db.Column(db.Integer, db.ForeignKey('loans.id', ondelete='CASCADE'), nullable=True)
+    kind = db.Column(db.String(50), nullable=False)  # e.g. overdue_7
+    payload = db.Column(db.Text, nullable=False)  # JSON
+    created_at = db.Column(db.DateTime, nullable=False)
+    sent_at = db.Column(db.DateTime, nullable=True)
+
+    def __repr__(self):
+        return f'<Notification {self.kind} User {self.user_id}>'
+
+# Resume point and lease of a batch job
+class JobCheckpoint(db.Model):
+    __tablename__ = 'job_checkpoints'
+
+    name = db.Column(db.String(50), primary_key=True)
+    status = db.Column(db.String(20), nullable=False, default='done')  # running or done
+    as_of = db.Column(db.Date, nullable=True)
+    position = db.Column(db.String(255), nullable=True)  # JSON sort key of the last processed row
+    processed = db.Column(db.BigInteger, nullable=False, default=0)
+    locked_until = db.Column(db.DateTime, nullable=True)
+    updated_at = db.Column(db.DateTime, nullable=True)
+
+    def __repr__(self):
+        return f'<JobCheckpoint {self.name} {self.status}>'
+
+# Daily loan rollups behind the analytics endpoints, kept by analytics.py
+class BookDailyLoans(db.Model):
+    __tablename__ = 'book_daily_loans'
+
+    day = db.Column(db.Date, primary_key=True)
+    book_id = db.Column(db.Integer, primary_key=True)  # No foreign key: a deleted book's rows go with the next rebuild of their days
+    borrows = db.Column(db.Integer, nullable=False, default=0)
+    returns = db.Column(db.Integer, nullable=False, default=0)
+
+    def __repr__(self):
+        return f'<BookDailyLoans {self.day} Book {self.book_id}>'
+
+class UserDailyLoans(db.Model):
+    __tablename__ = 'user_daily_loans'
+
+    day = db.Column(db.Date, primary_key=True)
+    user_id = db.Column(db.Integer, primary_key=True)
+    borrows = db.Column(db.Integer, nullable=False, default=0)
+    returns = db.Column(db.Integer, nullable=False, default=0)
+
+    def __repr__(self):
+        return f'<UserDailyLoans {self.day} User {self.user_id}>'
+
+# Queue of members waiting for a book with no copy on the shelf, kept by holds.py
+class Hold(db.Model):
+    __tablename__ = 'holds'
+    __table_args__ = (
+        db.Index('ix_holds_book_queue', 'book_id', 'status', 'id'),  # Head of a book's queue and queue positions
+        db.Index('ix_holds_status_expires', 'status', 'expires_at'),  # Expiry sweep
+        # At most one open hold per (user, book): active_key is 1 while waiting or ready, NULL once closed
+        db.Index('uq_holds_one_active', 'user_id', 'book_id', 'active_key', unique=True),
+    )
+
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id', ondelete='CASCADE'), nullable=False)
+    book_id = db.Column(db.Integer, db.ForeignKey('books.id', ondelete='CASCADE'), nullable=False)
+    status = db.Column(db.String(20), nullable=False, default='waiting')  # waiting, ready, fulfilled, cancelled, expired
+    active_key = db.Column(db.SmallInteger, nullable=True)
+    created_at = db.Column(db.DateTime, nullable=False)
+    ready_at = db.Column(db.DateTime, nullable=True)  # A copy was set aside for the member
+    expires_at = db.Column(db.DateTime, nullable=True)  # Pickup deadline of a ready hold
+    closed_at = db.Column(db.DateTime, nullable=True)
+
+    def __repr__(self):
+        return f'<Hold User {self.user_id} - Book {self.book_id} {self.status}>'
@@ -0,0 +1,255 @@
+import json
+import logging
+import time
+from datetime import date, datetime, timedelta
+import click
+from flask import current_app
+from flask.cli import with_appcontext
+from sqlalchemy import bindparam, insert, select, update
+from sqlalchemy.exc import IntegrityError
+from db import db
+from models import JobCheckpoint, Loan, Notification, User
+from pagination import keyset_filter
+import periodic
+
+logger = logging.getLogger(__name__)
+
+# Overdue loan scanner. Walks open loans whose return_date has passed in
+# (return_date, id) order, one chunk per transaction: each chunk updates
+# loans.fine_cents, writes reminder rows to the notifications outbox and moves
+# the job checkpoint, so an interrupted run resumes after the last committed
+# chunk and memory use is bounded by the chunk size.
+
+JOB_NAME = 'overdue_scan'
+LEASE_SECONDS = 300  # A run that stops renewing its lease for this long can be taken over
+
+loans_table = Loan.__table__
+users_table = User.__table__
+notifications_table = Notification.__table__
+checkpoints_table = JobCheckpoint.__table__
+
+SCAN_KEY = (loans_table.c.return_date, loans_table.c.id)
+
+
+def parse_reminder_days(value):
+    return sorted({int(day) for day in str(value).split(',') if day.strip()})
+
+
+def fine_for(days_overdue, per_day, cap):
+    fine = days_overdue * per_day
+    return min(fine, cap) if cap else fine
+
+
+def reminder_level(days_overdue, reminder_days):
+    """The highest reminder threshold reached, or None before the first one."""
+    reached = [day for day in reminder_days if day <= days_overdue]
+    return reached[-1] if reached else None
+
+
+def acquire(as_of, restart):
+    """
+    Takes the job lease and returns (as_of, position, processed) to continue
+    from, or None if another process holds an unexpired lease. An unfinished
+    run is resumed with its original as_of date unless restart is set.
+    """
+    now = datetime.utcnow()
+    try:
+        with db.session.begin_nested():
+            db.session.execute(insert(checkpoints_table).values(name=JOB_NAME, status='done', processed=0))
+    except IntegrityError:
+        pass
+    result = db.session.execute(
+        update(checkpoints_table)
+        .where(
+            checkpoints_table.c.name == JOB_NAME,
+            (checkpoints_table.c.locked_until.is_(None)) | (checkpoints_table.c.locked_until < now),
+        )
+        .values(locked_until=now + timedelta(seconds=LEASE_SECONDS), updated_at=now)
+    )
+    if result.rowcount != 1:
+        db.session.rollback()
+        return None
+
+    checkpoint = db.session.execute(select(checkpoints_table).where(checkpoints_table.c.name == JOB_NAME)).one()
+    if checkpoint.status == 'running' and not restart:
+        position = json.loads(checkpoint.position) if checkpoint.position else None
+        start = (checkpoint.as_of, position, checkpoint.processed)
+    else:
+        start = (as_of, None, 0)
+        db.session.execute(
+            update(checkpoints_table)
+            .where(checkpoints_table.c.name == JOB_NAME)
+            .values(status='running', as_of=as_of, position=None, processed=0)
+        )
+    db.session.commit()
+    return start
+
+
+def save_checkpoint(position, processed, done=False, release=False):
+    """Records progress and renews the lease; release hands it back so the next run can resume."""
+    now = datetime.utcnow()
+    db.session.execute(
+        update(checkpoints_table)
+        .where(checkpoints_table.c.name == JOB_NAME)
+        .values(
+            status='done' if done else 'running',
+            position=json.dumps(position) if position else None,
+            processed=processed,
+            locked_until=None if done or release else now + timedelta(seconds=LEASE_SECONDS),
+            updated_at=now,
+        )
+    )
+
+
+def fetch_chunk(as_of, position, chunk_size):
+    query = (
+        select(
+            loans_table.c.id, loans_table.c.user_id, loans_table.c.title,
+            loans_table.c.return_date, loans_table.c.fine_cents, users_table.c.email,
+        )
+        .join(users_table, users_table.c.id == loans_table.c.user_id)
+        .where(loans_table.c.date_returned.is_(None), loans_table.c.return_date < as_of)
+        .order_by(*SCAN_KEY)
+        .limit(chunk_size)
+    )
+    if position is not None:
+        query = query.where(keyset_filter(SCAN_KEY, [date.fromisoformat(position[0]), position[1]]))
+    return db.session.execute(query).all()
+
+
+def process_chunk(rows, as_of, settings):
+    """Updates fines and queues reminders for one chunk; returns (fines changed, reminders queued)."""
+    fines = []
+    reminders = {}
+    for row in rows:
+        days_overdue = (as_of - row.return_date).days
+        fine = fine_for(days_overdue, settings['per_day'], settings['cap'])
+        if fine != row.fine_cents:
+            fines.append({'loan_id': row.id, 'fine': fine})
+        level = reminder_level(days_overdue, settings['reminder_days'])
+        if level is not None:
+            reminders[(row.id, f'overdue_{level}')] = {
+                'user_id': row.user_id,
+                'loan_id': row.id,
+                'email': row.email,
+                'title': row.title,
+                'return_date': row.return_date.isoformat(),
+                'days_overdue': days_overdue,
+                'fine_cents': fine,
+            }
+
+    if fines:
+        db.session.execute(
+            update(loans_table).where(loans_table.c.id == bindparam('loan_id')).values(fine_cents=bindparam('fine')),
+            fines,
+        )
+
+    if reminders:
+        # Reminders already queued by an earlier day's run are skipped
+        sent = set(db.session.execute(
+            select(notifications_table.c.loan_id, notifications_table.c.kind)
+            .where(notifications_table.c.loan_id.in_({loan_id for loan_id, _ in reminders}))
+        ).all())
+        now = datetime.utcnow()
+        rows = [
+            {'user_id': payload['user_id'], 'loan_id': loan_id, 'kind': kind,
+             'payload': json.dumps(payload), 'created_at': now}
+            for (loan_id, kind), payload in reminders.items() if (loan_id, kind) not in sent
+        ]
+        if rows:
+            db.session.execute(insert(notifications_table), rows)
+        return len(fines), len(rows)
+    return len(fines), 0
+
+
+def scan(as_of=None, chunk_size=None, max_chunks=None, restart=False):
+    """
+    Runs (or resumes) the overdue scan. Returns a summary dict, or None when
+    another process is already running it. max_chunks stops early, leaving a
+    checkpoint the next run continues from.
+    """
+    config = current_app.config
+    settings = {
+        'per_day': config['OVERDUE_FINE_PER_DAY'],
+        'cap': config['OVERDUE_FINE_CAP'],
+        'reminder_days': parse_reminder_days(config['OVERDUE_REMINDER_DAYS']),
+    }
+    chunk_size = chunk_size or config['OVERDUE_CHUNK_SIZE']
+
+    start = acquire(as_of or date.today(), restart)
+    if start is None:
+        return None
+    as_of, position, processed = start
+
+    started = time.perf_counter()
+    summary = {'as_of': as_of.isoformat(), 'resumed_at': processed, 'loans': 0, 'fines': 0, 'reminders': 0}
+    chunks = 0
+    try:
+        while True:
+            rows = fetch_chunk(as_of, position, chunk_size)
+            if not rows:
+                save_checkpoint(None, processed, done=True)
+                db.session.commit()
+                summary['done'] = True
+                break
+
+            fines, reminders = process_chunk(rows, as_of, settings)
+            last = rows[-1]
+            position = [last.return_date.isoformat(), last.id]
+            processed += len(rows)
+            chunks += 1
+            stopping = bool(max_chunks) and chunks >= max_chunks
+            save_checkpoint(position, processed, release=stopping)
+            db.session.commit()
+
+            summary['loans'] += len(rows)
+            summary['fines'] += fines
+            summary['reminders'] += reminders
+            if stopping:
+                summary['done'] = False
+                break
+    except Exception:
+        # Hand the lease back; the checkpoint still points after the last committed chunk
+        db.session.rollback()
+        db.session.execute(
+            update(checkpoints_table).where(checkpoints_table.c.name == JOB_NAME).values(locked_until=None)
+        )
+        db.session.commit()
+        raise
+
+    summary['seconds'] = round(time.perf_counter() - started, 2)
+    return summary
+
+
+def run_scheduled(app):
+    with app.app_context():
+        try:
+            summary = scan()
+            if summary:
+                logger.info('Overdue scan: %s', summary)
+        except Exception:
+            db.session.rollback()
+            logger.exception('Overdue scan failed')
+
+
+def start_scheduler(app):
+    """
+    Runs the scan every OVERDUE_SCAN_INTERVAL seconds in this process. Off by
+    default; with several server processes the job lease lets only one scan at
+    a time, and `flask overdue-scan` from cron is the usual alternative.
+    """
+    return periodic.run_every(app, 'overdue-scan', app.config.get('OVERDUE_SCAN_INTERVAL', 0), run_scheduled)
+
+
+@click.command('overdue-scan')
+@click.option('--as-of', type=click.DateTime(formats=['%Y-%m-%d']), help='Scan date, default today.')
+@click.option('--chunk-size', type=int, help='Loans per transaction.')
+@click.option('--max-chunks', type=int, help='Stop after this many chunks; the next run resumes.')
+@click.option('--restart', is_flag=True, help='Ignore an unfinished run and start over.')
+@with_appcontext
+def scan_command(as_of, chunk_size, max_chunks, restart):
+    """Computes fines for overdue loans and queues reminder notifications."""
+    summary = scan(as_of.date() if as_of else None, chunk_size, max_chunks, restart)
+    if summary is None:
+        raise click.ClickException('Another overdue scan holds the lease.')
+    click.echo(json.dumps(summary))
@@ -0,0 +1,73 @@
+import base64
+import json
+from sqlalchemy import and_, or_
+
+DEFAULT_PAGE_LIMIT = 50
+MAX_PAGE_LIMIT = 500
+
+
+class CursorError(ValueError):
+    """Raised when a client sends a cursor we cannot decode."""
+
+
+def encode_cursor(values):
+    """Encodes the sort key of the last row of a page into an opaque cursor string."""
+    raw = json.dumps(values, separators=(',', ':')).encode('utf-8')
+    return base64.urlsafe_b64encode(raw).decode('ascii').rstrip('=')
+
+
+def decode_cursor(cursor):
+    """Decodes a cursor created by encode_cursor back into its list of key values."""
+    try:
+        padded = cursor + '=' * (-len(cursor) % 4)
+        values = json.loads(base64.urlsafe_b64decode(padded.encode('ascii')))
+    except (ValueError, TypeError):
+        raise CursorError('Invalid cursor')
+    if not isinstance(values, list):
+        raise CursorError('Invalid cursor')
+    return values
+
+
+def parse_limit(value):
+    """Clamps the requested page size to [1, MAX_PAGE_LIMIT]."""
+    if value is None:
+        return DEFAULT_PAGE_LIMIT
+    return max(1, min(value, MAX_PAGE_LIMIT))
+
+
+def keyset_filter(columns, values, descending=False):
+    """
+    Builds the WHERE clause that selects rows strictly after `values` in the
+    (columns...) ordering, e.g. title > :t OR (title = :t AND id > :id).
+    Written out as OR/AND instead of a row constructor so MySQL can use a range scan.
+    """
+    clauses = []
+    for i, column in enumerate(columns):
+        equal = [columns[j] == values[j] for j in range(i)]
+        step = column < values[i] if descending else column > values[i]
+        clauses.append(and_(*equal, step))
+    return or_(*clauses)
+
+
+def keyset_page(query, columns, limit, after=None, descending=False):
+    """
+    Runs one page of a keyset-paginated query.
+
+    Returns (rows, next_values) where next_values is the sort key of the last
+    row, or None when there are no more rows. One extra row is fetched to know
+    whether another page exists, so the cost is independent of page depth.
+    """
+    if after is not None:
+        if len(after) != len(columns):
+            raise CursorError('Invalid cursor')
+        query = query.filter(keyset_filter(columns, after, descending))
+
+    order = [column.desc() if descending else column.asc() for column in columns]
+    rows = query.order_by(*order).limit(limit + 1).all()
+
+    next_values = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        last = rows[-1]
+        next_values = [getattr(last, column.key) for column in columns]
+    return rows, next_values
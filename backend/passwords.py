@@ -0,0 +1,171 @@
+import multiprocessing
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from werkzeug.security import check_password_hash, generate_password_hash
+
+try:
+    from argon2 import PasswordHasher
+    from argon2.exceptions import InvalidHashError, VerificationError
+except ImportError:  # argon2-cffi is optional; without it only the werkzeug methods are available
+    PasswordHasher = None
+
+# Password hashing service. Hashing and verification run on a small process
+# pool so a burst of logins cannot take every request thread's CPU; at most
+# PASSWORD_HASH_QUEUE jobs are admitted at once and callers beyond that get
+# PasswordServiceBusy (503) after PASSWORD_HASH_TIMEOUT seconds. The method
+# and cost come from PASSWORD_HASH_METHOD, either a werkzeug method such as
+# scrypt:32768:8:1 or pbkdf2:sha256:600000, or argon2[:time:memory:parallelism]
+# with argon2-cffi installed. Hashes made with other parameters are upgraded
+# on the next successful login.
+
+ARGON2_PREFIX = '$argon2'
+
+
+def process_context():
+    # Fresh interpreters rather than forks of the server, so the hashing processes
+    # hold none of its listening sockets or database connections
+    methods = multiprocessing.get_all_start_methods()
+    return multiprocessing.get_context('forkserver' if 'forkserver' in methods else 'spawn')
+
+
+class PasswordServiceBusy(Exception):
+    """Every hashing slot is taken; the client should retry shortly."""
+
+
+def argon2_hasher(method):
+    if PasswordHasher is None:
+        raise RuntimeError('PASSWORD_HASH_METHOD=argon2 requires the argon2-cffi package')
+    params = [int(value) for value in method.split(':')[1:]]
+    names = ('time_cost', 'memory_cost', 'parallelism')
+    return PasswordHasher(**dict(zip(names, params)))
+
+
+# Run in the worker processes; module-level so they can be pickled
+
+def _hash(password, method):
+    if method.startswith('argon2'):
+        return argon2_hasher(method).hash(password)
+    return generate_password_hash(password, method=method)
+
+
+def _verify(stored_hash, password):
+    if stored_hash.startswith(ARGON2_PREFIX):
+        if PasswordHasher is None:
+            return False
+        try:
+            return PasswordHasher().verify(stored_hash, password)
+        except (VerificationError, InvalidHashError):
+            return False
+    return check_password_hash(stored_hash, password)
+
+
+class PasswordService:
+    def __init__(self):
+        self.method = 'scrypt'
+        self.workers = 2
+        self.timeout = 5
+        self._slots = threading.BoundedSemaphore(8)
+        self._executor = None
+        self._lock = threading.Lock()
+        self._prefix = None
+
+    def configure(self, config):
+        self.shutdown()
+        self.method = config.get('PASSWORD_HASH_METHOD', 'scrypt')
+        self.workers = config.get('PASSWORD_HASH_WORKERS', 2)
+        self.timeout = config.get('PASSWORD_HASH_TIMEOUT', 5)
+        self._slots = threading.BoundedSemaphore(config.get('PASSWORD_HASH_QUEUE') or max(1, self.workers) * 4)
+        self._prefix = None
+
+    def init_app(self, app):
+        self.configure(app.config)
+
+        @app.errorhandler(PasswordServiceBusy)
+        def password_service_busy(e):
+            return {'message': 'Too many sign-in attempts right now, please retry'}, 503, {'Retry-After': '1'}
+
+    def _pool(self):
+        with self._lock:
+            # Created on first use, i.e. after any fork of the server process
+            if self._executor is None:
+                self._executor = ProcessPoolExecutor(max_workers=self.workers, mp_context=process_context())
+            return self._executor
+
+    def _run(self, function, *args):
+        if not self._slots.acquire(timeout=self.timeout):
+            raise PasswordServiceBusy()
+        try:
+            if self.workers <= 0:
+                return function(*args)
+            return self._pool().submit(function, *args).result()
+        finally:
+            self._slots.release()
+
+    def hash(self, password):
+        return self._run(_hash, password, self.method)
+
+    def hash_many(self, passwords):
+        """
+        Hashes a list of passwords in parallel, for bulk imports. They go to the
+        pool one round of a password per worker process at a time, each round
+        taking a slot like a single hash, so sign-ins still get their turn in
+        between. Waits for a slot rather than giving up.
+        """
+        if self.workers <= 0:
+            return [_hash(password, self.method) for password in passwords]
+        hashes = []
+        for start in range(0, len(passwords), self.workers):
+            chunk = passwords[start:start + self.workers]
+            self._slots.acquire()
+            try:
+                hashes.extend(self._pool().map(_hash, chunk, [self.method] * len(chunk)))
+            finally:
+                self._slots.release()
+        return hashes
+
+    def verify(self, stored_hash, password):
+        return bool(stored_hash) and self._run(_verify, stored_hash, password)
+
+    def needs_rehash(self, stored_hash):
+        """True if the hash was made with a different method or cost than the configured one."""
+        if self.method.startswith('argon2'):
+            if not stored_hash.startswith(ARGON2_PREFIX):
+                return True
+            return argon2_hasher(self.method).check_needs_rehash(stored_hash)
+        if self._prefix is None:
+            # werkzeug expands defaults (scrypt -> scrypt:32768:8:1), so take the prefix of a real hash
+            self._prefix = generate_password_hash('', method=self.method).split('$', 1)[0]
+        return stored_hash.split('$', 1)[0] != self._prefix
+
+    def verify_and_update(self, stored_hash, password):
+        """
+        Returns (valid, new_hash). new_hash is set when the password is valid but
+        its hash uses outdated parameters, and should replace the stored one.
+        """
+        if not self.verify(stored_hash, password):
+            return False, None
+        if self.needs_rehash(stored_hash):
+            return True, self.hash(password)
+        return True, None
+
+    def shutdown(self, wait=True):
+        with self._lock:
+            if self._executor is not None:
+                self._executor.shutdown(wait=wait)
+                self._executor = None
+
+
+# Shared instance, configured by passwords.init_app(app)
+passwords = PasswordService()
+
+
+def init_app(app):
+    passwords.init_app(app)
+
+
+def hash_password(password):
+    return passwords.hash(password)
+
+
+def verify_password(stored_hash, password):
+    return passwords.verify(stored_hash, password)
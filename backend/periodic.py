@@ -0,0 +1,35 @@
+import threading
+
+try:
+    from apscheduler.schedulers.background import BackgroundScheduler
+except ImportError:  # APScheduler is optional; a plain timer thread is used without it
+    BackgroundScheduler = None
+
+# In-process periodic jobs (overdue scan, analytics rebuild). Each server
+# process that calls run_every runs its own copy, so jobs must tolerate
+# running in several processes at once; cron running the matching flask
+# command is the usual alternative.
+
+
+def run_every(app, name, interval, job):
+    """
+    Calls job(app) every `interval` seconds. Returns the scheduler (or the
+    Event that stops the timer thread), or None when interval is 0 or less.
+    """
+    if interval <= 0:
+        return None
+    if BackgroundScheduler is not None:
+        scheduler = BackgroundScheduler(daemon=True)
+        scheduler.add_job(job, 'interval', seconds=interval, args=[app], id=name,
+                          max_instances=1, coalesce=True)
+        scheduler.start()
+        return scheduler
+
+    stop = threading.Event()
+
+    def loop():
+        while not stop.wait(interval):
+            job(app)
+
+    threading.Thread(target=loop, name=name, daemon=True).start()
+    return stop
@@ -0,0 +1,94 @@
+import random
+import time
+from functools import wraps
+from flask import g, request
+from cache import LRUCache, cache
+from db_pool import engine_options
+
+# Read replicas. Each URL in DATABASE_REPLICA_URLS becomes a SQLAlchemy bind
+# (replica1, replica2, ...) and views decorated with @read_replica run their
+# SELECTs on one of them, picked per request (see db.RoutingSession). A user
+# who has just written, e.g. borrowed or returned a book, reads from the
+# primary for REPLICA_STICKY_SECONDS so replication lag never hides their own
+# change. The response to a write carries the mark in the X-Read-Primary-Until
+# header, which the SPA sends back with its requests until it passes, so
+# whichever worker serves the next read honours it. A write made for someone else (a
+# librarian lending to a member) marks that user locally and in the shared
+# cache; without CACHE_SHARED_URL only the worker that made the write knows.
+
+WRITE_METHODS = {'POST', 'PUT', 'PATCH', 'DELETE'}
+STICKY_HEADER = 'X-Read-Primary-Until'
+
+_replicas = []
+_sticky = LRUCache(max_entries=100000, ttl=5)
+
+
+def binds(config):
+    """SQLALCHEMY_BINDS entries for the replicas, with the same pool settings as the primary."""
+    urls = [url.strip() for url in config.get('DATABASE_REPLICA_URLS', '').split(',') if url.strip()]
+    return {f'replica{i}': {'url': url, **engine_options(config, url)} for i, url in enumerate(urls, 1)}
+
+
+def sticky_key(user_id):
+    return f'primary:{user_id}'
+
+
+def stick(*user_ids):
+    """Sends these users' reads to the primary for REPLICA_STICKY_SECONDS."""
+    if not _replicas:
+        return
+    for user_id in user_ids:
+        _sticky.set(user_id, True)
+        if cache.shared is not None:
+            cache.shared.set(sticky_key(user_id), True, _sticky.ttl)
+
+
+def is_sticky(user_id):
+    if _sticky.get(user_id) is True:
+        return True
+    return cache.shared is not None and cache.shared.get(sticky_key(user_id)) is True
+
+
+def has_sticky_header():
+    try:
+        return float(request.headers.get(STICKY_HEADER, 0)) > time.time()
+    except ValueError:
+        return False
+
+
+def choose_replica():
+    """Bind key of the replica for this request, or None to read from the primary."""
+    if not _replicas:
+        return None
+    if has_sticky_header():
+        return None
+    claims = g.get('jwt_claims')
+    if claims is not None and is_sticky(claims.get('user_id')):
+        return None
+    return random.choice(_replicas)
+
+
+def read_replica(view):
+    """Runs the view's SELECTs on a read replica, unless the caller has just written."""
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        g.db_replica = choose_replica()
+        return view(*args, **kwargs)
+    return wrapper
+
+
+def init_app(app):
+    """Picks up the replica binds created from DATABASE_REPLICA_URLS and marks writers as sticky."""
+    global _sticky
+    _replicas[:] = sorted(key for key in app.config.get('SQLALCHEMY_BINDS', {}) if key.startswith('replica'))
+    _sticky = LRUCache(_sticky.max_entries, app.config.get('REPLICA_STICKY_SECONDS', 5))
+
+    @app.after_request
+    def stick_writer(response):
+        claims = g.get('jwt_claims')
+        if _replicas and claims is not None and request.method in WRITE_METHODS and response.status_code < 400:
+            stick(claims.get('user_id'))
+            response.headers[STICKY_HEADER] = f'{time.time() + _sticky.ttl:.3f}'
+            # The SPA is served from another origin and may only read the headers listed here
+            response.headers.add('Access-Control-Expose-Headers', STICKY_HEADER)
+        return response
@@ -0,0 +1,246 @@
+import heapq
+import re
+import threading
+import unicodedata
+from bisect import bisect_left, insort
+
+TOKEN_RE = re.compile(r'\w+')
+
+# Field weights: a hit in the title counts more than a hit in the author
+TITLE_WEIGHT = 2
+AUTHOR_WEIGHT = 1
+
+# Score multipliers per kind of match
+EXACT_SCORE = 3
+PREFIX_SCORE = 2
+FUZZY_SCORE = 1
+
+# Upper bound on how many index tokens a single prefix may expand to
+MAX_PREFIX_EXPANSIONS = 200
+
+
+def normalize(text):
+    """Lowercases and strips accents so 'Émile' and 'emile' index the same way."""
+    if text is None or text.isascii():
+        return (text or '').lower()
+    decomposed = unicodedata.normalize('NFKD', text)
+    return ''.join(ch for ch in decomposed if not unicodedata.combining(ch)).lower()
+
+
+def tokenize(text):
+    return TOKEN_RE.findall(normalize(text))
+
+
+def within_distance(a, b, max_distance):
+    """Bounded Levenshtein check; bails out as soon as a row exceeds max_distance."""
+    if abs(len(a) - len(b)) > max_distance:
+        return False
+    previous = list(range(len(b) + 1))
+    for i, ca in enumerate(a, 1):
+        current = [i]
+        for j, cb in enumerate(b, 1):
+            current.append(min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + (ca != cb)))
+        if min(current) > max_distance:
+            return False
+        previous = current
+    return previous[-1] <= max_distance
+
+
+def allowed_typos(term):
+    if len(term) >= 8:
+        return 2
+    if len(term) >= 4:
+        return 1
+    return 0
+
+
+def document_weights(title, author):
+    """{token: field weight} for one book."""
+    weights = {}
+    for token in tokenize(title):
+        weights[token] = weights.get(token, 0) + TITLE_WEIGHT
+    for token in tokenize(author):
+        weights[token] = weights.get(token, 0) + AUTHOR_WEIGHT
+    return weights
+
+
+class SearchIndex:
+    """
+    In-process inverted index over book titles and authors.
+
+    Maps each token to a posting list {book_id: field weight}. Tokens are also
+    kept in a sorted list so prefix lookups are a bisect instead of a scan.
+    Each worker process holds its own copy, labelled with the 'catalog' table
+    version it was built from. Readers pass the current version to
+    ensure_current(), which rebuilds the index when another process has changed
+    the catalog since; writes served by this process apply their delta with
+    add() and remove() and move the label on, so they need no rebuild. A
+    rebuild runs beside the index it replaces, which keeps serving searches
+    until the new one is swapped in.
+    """
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._build_lock = threading.Lock()
+        self._postings = {}
+        self._tokens = []
+        self._documents = {}
+        self._loaded = False
+        self._version = None
+
+    @property
+    def loaded(self):
+        return self._loaded
+
+    def load(self, rows, version=None):
+        """(Re)builds the index from an iterable of (id, title, author) tuples."""
+        postings = {}
+        documents = {}
+        for book_id, title, author in rows:
+            weights = document_weights(title, author)
+            for token, weight in weights.items():
+                posting = postings.get(token)
+                if posting is None:
+                    posting = postings[token] = {}
+                posting[book_id] = weight
+            documents[book_id] = tuple(weights)
+        tokens = sorted(postings)
+        with self._lock:
+            self._postings, self._tokens, self._documents = postings, tokens, documents
+            self._loaded = True
+            self._version = version
+
+    def ensure_current(self, version):
+        """
+        Builds the index from the books table unless it is already at catalog
+        `version`. While another thread rebuilds, a loaded index is served as
+        it is rather than waited for.
+        """
+        if self._loaded and self._version == version:
+            return
+        from db import db, primary
+        from models import Book
+
+        if not self._build_lock.acquire(blocking=not self._loaded):
+            return
+        try:
+            if not self._loaded or self._version != version:
+                with primary():
+                    rows = db.session.query(Book.id, Book.title, Book.author).yield_per(5000)
+                    self.load(rows, version)
+        finally:
+            self._build_lock.release()
+
+    def add(self, book_id, title, author, version=None):
+        """
+        Indexes a book, replacing any previous entry for the same id. `version`
+        is the catalog version the write produced; see _advance().
+        """
+        with self._lock:
+            if not self._loaded:
+                return
+            self._remove(book_id)
+            self._add(book_id, title, author)
+            self._advance(version)
+
+    def remove(self, book_id, version=None):
+        with self._lock:
+            if not self._loaded:
+                return
+            self._remove(book_id)
+            self._advance(version)
+
+    def _advance(self, version):
+        # Only when no other write came in between: otherwise the label stays
+        # behind and the next reader rebuilds
+        if version is not None and self._version == version - 1:
+            self._version = version
+
+    def _add(self, book_id, title, author):
+        weights = document_weights(title, author)
+        for token, weight in weights.items():
+            posting = self._postings.get(token)
+            if posting is None:
+                posting = self._postings[token] = {}
+                insort(self._tokens, token)
+            posting[book_id] = weight
+        self._documents[book_id] = tuple(weights)
+
+    def _remove(self, book_id):
+        for token in self._documents.pop(book_id, ()):
+            posting = self._postings.get(token)
+            if posting is None:
+                continue
+            posting.pop(book_id, None)
+            if not posting:
+                del self._postings[token]
+                i = bisect_left(self._tokens, token)
+                if i < len(self._tokens) and self._tokens[i] == token:
+                    del self._tokens[i]
+
+    def _prefix_tokens(self, prefix):
+        start = bisect_left(self._tokens, prefix)
+        end = min(len(self._tokens), start + MAX_PREFIX_EXPANSIONS)
+        for token in self._tokens[start:end]:
+            if not token.startswith(prefix):
+                break
+            yield token
+
+    def _fuzzy_tokens(self, term):
+        # Only tokens sharing the first letter are considered, which keeps the
+        # candidate set small without an n-gram side index
+        max_distance = allowed_typos(term)
+        start = bisect_left(self._tokens, term[0])
+        end = bisect_left(self._tokens, chr(ord(term[0]) + 1))
+        for token in self._tokens[start:end]:
+            if token != term and within_distance(term, token, max_distance):
+                yield token
+
+    def _match_term(self, term):
+        """Returns {book_id: score} for a single query term."""
+        scores = {}
+
+        def collect(tokens, multiplier):
+            for token in tokens:
+                for book_id, weight in self._postings[token].items():
+                    score = weight * multiplier
+                    if score > scores.get(book_id, 0):
+                        scores[book_id] = score
+
+        if term in self._postings:
+            collect([term], EXACT_SCORE)
+        collect((t for t in self._prefix_tokens(term) if t != term), PREFIX_SCORE)
+        # Typo tolerance is only a fallback when the term matched nothing
+        if not scores and allowed_typos(term):
+            collect(list(self._fuzzy_tokens(term)), FUZZY_SCORE)
+        return scores
+
+    def search(self, query, limit=20):
+        """
+        Returns up to `limit` book ids matching every term of `query`
+        (exact, prefix or typo-tolerant), best matches first.
+        """
+        terms = list(dict.fromkeys(tokenize(query)))
+        if not terms:
+            return []
+
+        with self._lock:
+            # Match the rarest terms first so the AND intersection shrinks quickly
+            terms.sort(key=lambda t: len(self._postings.get(t, ())))
+            totals = None
+            for term in terms:
+                scores = self._match_term(term)
+                if totals is None:
+                    totals = scores
+                else:
+                    totals = {book_id: totals[book_id] + score
+                              for book_id, score in scores.items() if book_id in totals}
+                if not totals:
+                    return []
+
+        best = heapq.nsmallest(limit, totals.items(), key=lambda item: (-item[1], item[0]))
+        return [book_id for book_id, _ in best]
+
+
+# Shared index instance for the process
+search_index = SearchIndex()
@@ -0,0 +1,82 @@
+import operator
+
+# Response shapes shared by the routes. A Serializer is compiled once into a
+# plain function that builds the dict with direct attribute reads, so it works
+# the same on ORM objects and on Row tuples from column queries, and costs one
+# call per row. Fields are names, or name=formatter for a value that needs
+# converting, or name=(attribute, formatter) to read a different attribute.
+
+
+def day(value):
+    """YYYY-MM-DD for a date or datetime."""
+    return None if value is None else value.isoformat()[:10]
+
+
+def iso(value):
+    return None if value is None else value.isoformat()
+
+
+def ratio(value):
+    """A fraction rounded to three places, for Decimal or float values."""
+    return None if value is None else round(float(value), 3)
+
+
+def related(attribute):
+    """Reads `attribute` of a related object that may be missing, e.g. related('title') on loan.book."""
+    getter = operator.attrgetter(attribute)
+    return lambda value: None if value is None else getter(value)
+
+
+class Serializer:
+    def __init__(self, name, *fields, **formatted):
+        self.name = name
+        self.fields = [(field, field, None) for field in fields]
+        for field, spec in formatted.items():
+            attribute, formatter = spec if isinstance(spec, tuple) else (field, spec)
+            self.fields.append((field, attribute, formatter))
+        self.keys = [field for field, _, _ in self.fields]
+        self.one, self.many = self._compile()
+
+    def _compile(self):
+        namespace = {}
+        parts = []
+        for i, (field, attribute, formatter) in enumerate(self.fields):
+            if not attribute.isidentifier():
+                raise ValueError(f'{self.name}: {attribute!r} is not an attribute name')
+            value = f'row.{attribute}'
+            if formatter is not None:
+                namespace[f'format_{i}'] = formatter
+                value = f'format_{i}({value})'
+            parts.append(f'{field!r}: {value}')
+        body = '{' + ', '.join(parts) + '}'
+        # The list version inlines the dict so a page of rows costs no call per row
+        source = (f'def one(row):\n    return {body}\n'
+                  f'def many(rows):\n    return [{body} for row in rows]\n')
+        exec(compile(source, f'<serializer {self.name}>', 'exec'), namespace)
+        return namespace['one'], namespace['many']
+
+    def __call__(self, row):
+        return self.one(row)
+
+
+book = Serializer('book', 'id', 'title', 'author', 'available', 'quantity', 'image_url')
+user = Serializer('user', 'id', 'username', 'email', 'name', 'last_name', 'role')
+
+# GET /loans/ and GET /loans/<id>
+loan = Serializer('loan', 'id', 'title', 'user_id', 'book_id', loan_date=day, return_date=day, date_returned=day)
+# Loan.to_dict, with the related book title and username
+loan_with_relations = Serializer(
+    'loan_with_relations', 'id', 'book_id', 'user_id',
+    loan_date=iso, return_date=iso, date_returned=iso,
+    book=('book', related('title')), user=('user', related('username')),
+)
+# GET /loans/user/<id>; the dates are left to the JSON provider (HTTP dates)
+user_loan = Serializer('user_loan', 'id', 'title', 'loan_date', 'date_returned')
+
+# /holds
+hold = Serializer('hold', 'id', 'user_id', 'book_id', 'status', created_at=iso, ready_at=iso, expires_at=iso)
+
+# /analytics; sums come back as Decimal from MySQL
+popular_book = Serializer('popular_book', 'book_id', 'title', 'author', borrows=int)
+top_borrower = Serializer('top_borrower', 'user_id', 'username', borrows=int)
+copies_on_loan = Serializer('copies_on_loan', 'book_id', 'title', 'author', 'on_loan', 'on_shelf', utilization=ratio)
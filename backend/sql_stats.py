@@ -0,0 +1,44 @@
+import time
+from flask import g, has_app_context
+from sqlalchemy import event
+from db import db
+
+# Per-request SQL statistics: statement count and time in g.sql_count and
+# g.sql_time, and with g.capture_sql set, the statements themselves (for the
+# slow-request log in metrics.py).
+
+MAX_CAPTURED_STATEMENTS = 50
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if has_app_context():
+        g.sql_count = g.get('sql_count', 0) + 1
+        conn.info['query_started'] = time.perf_counter()
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    started = conn.info.pop('query_started', None)
+    if started is None or not has_app_context():
+        return
+    elapsed = time.perf_counter() - started
+    g.sql_time = g.get('sql_time', 0.0) + elapsed
+    if g.get('capture_sql'):
+        captured = g.setdefault('sql_statements', [])
+        if len(captured) < MAX_CAPTURED_STATEMENTS:
+            captured.append((statement, elapsed))
+
+
+def init_app(app):
+    """Hooks statement counting into the app's engine(s)."""
+    with app.app_context():
+        for engine in db.engines.values():
+            if not event.contains(engine, 'before_cursor_execute', _before_cursor_execute):
+                event.listen(engine, 'before_cursor_execute', _before_cursor_execute)
+                event.listen(engine, 'after_cursor_execute', _after_cursor_execute)
+
+    # Opt-in response header so load tests and scripts can assert statement counts per request
+    @app.after_request
+    def add_sql_count_header(response):
+        if app.config.get('SQL_COUNT_HEADER'):
+            response.headers['X-SQL-Count'] = str(g.get('sql_count', 0))
+        return response
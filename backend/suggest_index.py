@@ -0,0 +1,265 @@
+import heapq
+import json
+import os
+import threading
+import time
+from bisect import bisect_left, insort
+
+from search_index import normalize
+
+try:
+    import fcntl
+except ImportError:  # Windows: snapshots are saved without the lock file
+    fcntl = None
+
+SNAPSHOT_FORMAT = 2
+
+# Prefixes matching more keys than this are answered from a ranked list kept
+# per prefix instead of a scan
+MAX_SCAN = 5000
+# Length of those lists: the largest `limit` the /suggest endpoint accepts
+TOP_K = 50
+
+
+class SuggestIndex:
+    """
+    Typeahead completions over normalized book titles and authors.
+
+    Completions live in a sorted list of normalized keys, so a prefix lookup
+    is a bisect followed by a short scan. Each key remembers the books it
+    came from and is ranked by how often those books have been loaned.
+    Loaded from a JSON snapshot at startup when one is available, otherwise
+    built from the database on first use.
+
+    Short prefixes match too many keys to scan on every keystroke. Their best
+    TOP_K keys are ranked once, on first use, and kept until loans are
+    recounted or a book under the prefix changes; a loan recorded here only
+    moves its own keys up those lists.
+
+    Like the search index, each process labels its copy with the 'catalog'
+    version its books were read at and rebuilds when the catalog moves on.
+    Loan counts are labelled with the 'loans' version they were counted at;
+    loans served by other processes are picked up by a recount, at most once
+    per `max_age` seconds since every borrow moves that version.
+    """
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._keys = []
+        self._completions = {}
+        self._books = {}
+        self._popularity = {}
+        self._top = {}
+        self._loaded = False
+        self._catalog_version = None
+        self._loans_version = None
+        self._counted_at = 0.0
+
+    @property
+    def loaded(self):
+        return self._loaded
+
+    def load(self, books, popularity, catalog_version=None, loans_version=None):
+        """Builds the index from (id, title, author) rows and a {book_id: loan_count} map."""
+        with self._lock:
+            self._keys = []
+            self._completions = {}
+            self._books = {}
+            for book_id, title, author in books:
+                self._add_book(book_id, title, author, keep_sorted=False)
+            self._keys = sorted(self._completions)
+            self._catalog_version = catalog_version
+            self._set_popularity(popularity, loans_version)
+            self._loaded = True
+
+    def _set_popularity(self, popularity, loans_version):
+        self._popularity = dict(popularity)
+        self._top = {}
+        self._loans_version = loans_version
+        self._counted_at = time.monotonic()
+
+    def ensure_current(self, catalog_version, loans_version, max_age):
+        """
+        Rebuilds the index unless it is at `catalog_version`, and recounts loans
+        when they are not at `loans_version` and were counted over `max_age` seconds ago.
+        """
+        if self._loaded and self._catalog_version == catalog_version and not self._recount_due(loans_version, max_age):
+            return
+        from db import db, primary
+        from models import Book, Loan
+
+        with self._lock, primary():
+            popularity = db.session.query(Loan.book_id, db.func.count(Loan.id)).group_by(Loan.book_id)
+            if not self._loaded or self._catalog_version != catalog_version:
+                books = db.session.query(Book.id, Book.title, Book.author).yield_per(5000)
+                self.load(books, popularity, catalog_version, loans_version)
+            elif self._recount_due(loans_version, max_age):
+                self._set_popularity(popularity, loans_version)
+
+    def _recount_due(self, loans_version, max_age):
+        return self._loans_version != loans_version and time.monotonic() - self._counted_at >= max_age
+
+    def add_book(self, book_id, title, author, version=None):
+        """Indexes a book written by this process; `version` is the catalog version the write produced."""
+        with self._lock:
+            if not self._loaded:
+                return
+            self._remove_book(book_id)
+            self._add_book(book_id, title, author)
+            for text in (title, author):
+                self._forget_prefixes(completion_key(text))
+            self._advance(version)
+
+    def remove_book(self, book_id, version=None):
+        with self._lock:
+            if not self._loaded:
+                return
+            self._remove_book(book_id)
+            self._popularity.pop(book_id, None)
+            self._advance(version)
+
+    def _advance(self, version):
+        # See SearchIndex._advance
+        if version is not None and self._catalog_version == version - 1:
+            self._catalog_version = version
+
+    def record_loan(self, book_id):
+        with self._lock:
+            self._popularity[book_id] = self._popularity.get(book_id, 0) + 1
+            book = self._books.get(book_id)
+            if book is None:
+                return
+            # Weights only grow here, so a key can only climb the ranked lists
+            for key in {completion_key(text) for text in book} - {''}:
+                rank = self._rank(key)
+                for end in range(1, len(key) + 1):
+                    top = self._top.get(key[:end])
+                    if top is None:
+                        continue
+                    top[:] = [entry for entry in top if entry[1] != key]
+                    insort(top, (rank, key))
+                    del top[TOP_K:]
+
+    def _rank(self, key):
+        # Most loaned first, shorter completions break ties
+        weight = sum(self._popularity.get(book_id, 0) for book_id in self._completions[key]['book_ids'])
+        return -weight, len(key)
+
+    def _forget_prefixes(self, key):
+        for end in range(1, len(key) + 1):
+            self._top.pop(key[:end], None)
+
+    def _add_book(self, book_id, title, author, keep_sorted=True):
+        # load() sorts the keys once at the end instead
+        self._books[book_id] = (title, author)
+        for text, kind in ((title, 'title'), (author, 'author')):
+            key = completion_key(text)
+            if not key:
+                continue
+            completion = self._completions.get(key)
+            if completion is None:
+                completion = self._completions[key] = {'text': text, 'kind': kind, 'book_ids': set()}
+                if keep_sorted:
+                    insort(self._keys, key)
+            completion['book_ids'].add(book_id)
+
+    def _remove_book(self, book_id):
+        previous = self._books.pop(book_id, None)
+        if previous is None:
+            return
+        for text in previous:
+            key = completion_key(text)
+            completion = self._completions.get(key)
+            if completion is None:
+                continue
+            self._forget_prefixes(key)
+            completion['book_ids'].discard(book_id)
+            if not completion['book_ids']:
+                del self._completions[key]
+                i = bisect_left(self._keys, key)
+                if i < len(self._keys) and self._keys[i] == key:
+                    del self._keys[i]
+
+    def suggest(self, prefix, limit=10):
+        """Returns the `limit` most loaned completions starting with `prefix`."""
+        prefix = completion_key(prefix)
+        if not prefix:
+            return []
+
+        with self._lock:
+            start = bisect_left(self._keys, prefix)
+            end = bisect_left(self._keys, prefix + '\U0010ffff', start)
+            if end - start <= MAX_SCAN or limit > TOP_K:
+                best = heapq.nsmallest(limit, ((self._rank(key), key) for key in self._keys[start:end]))
+            else:
+                top = self._top.get(prefix)
+                if top is None:
+                    top = self._top[prefix] = heapq.nsmallest(
+                        TOP_K, ((self._rank(key), key) for key in self._keys[start:end])
+                    )
+                best = top[:limit]
+            return [{'text': self._completions[key]['text'], 'type': self._completions[key]['kind'], 'loans': -rank[0]}
+                    for rank, key in best]
+
+    def save_snapshot(self, path):
+        """
+        Writes the index to `path` atomically so the next start can skip the table scan.
+
+        Every worker process saves at exit. They take turns on a lock file, and
+        a process only replaces a snapshot taken at older table versions than its own.
+        """
+        with self._lock:
+            if not self._loaded or self._catalog_version is None:
+                return
+            data = {
+                'format': SNAPSHOT_FORMAT,
+                'created_at': time.time(),
+                'catalog_version': self._catalog_version,
+                'loans_version': self._loans_version,
+                'books': [[book_id, title, author] for book_id, (title, author) in self._books.items()],
+                'popularity': [[book_id, count] for book_id, count in self._popularity.items()],
+            }
+        with open(f'{path}.lock', 'a') as lock:
+            if fcntl is not None:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+            saved = self._read_snapshot(path)
+            if saved and (saved['catalog_version'], saved['loans_version'] or 0) >= \
+                    (data['catalog_version'], data['loans_version'] or 0):
+                return
+            tmp_path = f'{path}.{os.getpid()}.tmp'
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump(data, f, separators=(',', ':'))
+            os.replace(tmp_path, path)
+
+    @staticmethod
+    def _read_snapshot(path):
+        try:
+            with open(path, encoding='utf-8') as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return None
+        return data if data.get('format') == SNAPSHOT_FORMAT else None
+
+    def load_snapshot(self, path, max_age=None):
+        """
+        Loads a snapshot written by save_snapshot; returns False if it is missing,
+        unreadable or too old. The first ensure_current() catches up with any
+        writes made after the snapshot was taken.
+        """
+        data = self._read_snapshot(path)
+        if data is None:
+            return False
+        if max_age is not None and time.time() - data.get('created_at', 0) > max_age:
+            return False
+        self.load(data['books'], data['popularity'], data['catalog_version'], data['loans_version'])
+        # The counts were taken before the snapshot: recount on the first lookup if loans moved since
+        self._counted_at = 0.0
+        return True
+
+
+def completion_key(text):
+    return ' '.join(normalize(text).split())
+
+
+# Shared index instance for the process
+suggest_index = SuggestIndex()
@@ -1,29 +1,43 @@
 # user_routes.py
 
 from flask import Blueprint, request, jsonify
-from models import User,Loan
-from werkzeug.security import generate_password_hash, check_password_hash
+from models import User
 from sqlalchemy.exc import IntegrityError
 from db import db
+from passwords import hash_password, verify_password
+from auth import role_required
+from bulk_import import IMPORTED_TABLES, RowError, import_upload
+from cache import get_user_data, get_user_id_by_username, invalidate_books, invalidate_user
+from changefeed import changes, publish, publish_stock
+from export import EXPORT_FORMATS, stream_export
+import holds
+from inventory import cancel_hold
+from loan_queries import delete_loans_for_user
+from replicas import read_replica
+from versioning import bump
+import serializers
 
 user_routes = Blueprint('user', __name__)
 
+# Columns of serializers.user, queried as rows rather than whole User objects
+USER_LIST_COLUMNS = (User.id, User.username, User.email, User.name, User.last_name, User.role)
+
+# Publishes a written user to the change feed, for the user and librarians; with
+# `before`, only the changed fields. The password is not among serializers.user's
+def user_written(user, op, before=None):
+    versions = bump('users')
+    fields = changes(before, serializers.user(user))
+    if fields:
+        publish('user', user.id, op, fields, versions.get('users'), owner=user.id)
+
 # Route for getting user details
 @user_routes.route('/<int:user_id>', methods=['GET'])
+@read_replica
 def get_user(user_id):
-    user = User.query.get(user_id)
-    if not user:
-        return jsonify({"message": "User not found"}), 404
-    
     # Return user details, including email, name, and last_name
-    user_data = {
-        'id': user.id,
-        'username': user.username,
-        'email': user.email,       # Adding email
-        'name': user.name,         # Adding name
-        'last_name': user.last_name, # Adding last name
-        'role': user.role
-    }
+    user_data = get_user_data(user_id)
+    if not user_data:
+        return jsonify({"message": "User not found"}), 404
     return jsonify(user_data)
 
 
@@ -35,6 +49,10 @@ def update_user(user_id):
     if not user:
         return jsonify({"message": "User not found"}), 404
     
+    previous_username = user.username
+    before = serializers.user(user)
+    # Hashed before the try block so a busy hashing service answers 503, not 500
+    new_password_hash = hash_password(data['password']) if 'password' in data else None
     try:
         # Update user information
         user.email = data.get('email', user.email)
@@ -43,14 +61,16 @@ def update_user(user_id):
         user.username = data.get('username', user.username)
 
         # If password is provided, hash it and update
-        if 'password' in data:
-            user.password = generate_password_hash(data['password'], method='sha256')
+        if new_password_hash:
+            user.password = new_password_hash
         
         # Update role if provided
         if 'role' in data:
             user.role = data['role']
         
         db.session.commit()
+        invalidate_user(user_id, previous_username, user.username)
+        user_written(user, 'update', before)
         return jsonify({"message": "User updated successfully"})
     except Exception as e:
         return jsonify({"message": str(e)}), 500
@@ -61,16 +81,31 @@ def delete_user(user_id):
     # Find the user
     user = User.query.get_or_404(user_id)
 
-    # Check for outstanding loans
-    outstanding_loans = Loan.query.filter_by(user_id=user_id, date_returned=None).all()
-    
-    if outstanding_loans:
+    # Check for outstanding loans, counted on the user row itself
+    if user.active_loans > 0:
         return jsonify({"message": "User cannot be deleted due to outstanding loans"}), 400
 
     # Proceed to delete the user
     try:
+        username = user.username
+        # Copies kept for the user's holds go on to the next member in each queue
+        open_holds = holds.open_holds(user_id)
+        for hold in open_holds:
+            cancel_hold(hold)
+        held_books = [hold.book_id for hold in open_holds if hold.status == holds.READY]
+        delete_loans_for_user(user_id)
         db.session.delete(user)
         db.session.commit()
+        invalidate_user(user_id, username)
+        if held_books:
+            invalidate_books(*held_books)
+            versions = bump('loans', 'books', 'users')
+            publish_stock(held_books, versions)
+        else:
+            versions = bump('loans', 'users')
+        publish('user', user_id, 'delete', version=versions.get('users'), owner=user_id)
+        # The user's loan history went with them
+        publish('loan', None, 'reload', {'user_id': user_id}, versions.get('loans'))
         return jsonify({"message": "User deleted successfully"}), 200
     except Exception as e:
         db.session.rollback()
@@ -78,16 +113,16 @@ def delete_user(user_id):
 
 # Route for getting all users (admin only)
 @user_routes.route('/', methods=['GET'])
+@read_replica
 def get_all_users():
-    users = User.query.all()
-    users_list = [{
-        'id': user.id,
-        'username': user.username,
-        'email': user.email,  # Add email
-        'name': user.name,  # Add name
-        'last_name': user.last_name,  # Add last_name
-        'role': user.role
-    } for user in users]
+    fmt = request.args.get('format')
+    if fmt:
+        if fmt not in EXPORT_FORMATS:
+            return jsonify({'message': f'Unsupported format: {fmt}'}), 400
+        query = db.session.query(*USER_LIST_COLUMNS).order_by(User.id)
+        return stream_export(query, fmt, 'users')
+
+    users_list = serializers.user.many(db.session.query(*USER_LIST_COLUMNS))
     
     return jsonify(users_list)
 
@@ -109,12 +144,11 @@ def add_user():
         return jsonify({'message': 'Missing required fields'}), 400
     
     # Check if the user already exists
-    existing_user = User.query.filter_by(username=username).first()
-    if existing_user:
+    if get_user_id_by_username(username):
         return jsonify({'message': 'User already exists'}), 400
     
     # Hash the password before saving it
-    hashed_password = generate_password_hash(password)
+    hashed_password = hash_password(password)
 
     # Create a new user
     new_user = User(
@@ -129,16 +163,25 @@ def add_user():
     # Add user to the database
     db.session.add(new_user)
     db.session.commit()
+    user_written(new_user, 'create')
     
     # Return success message
-    return jsonify({'message': 'User added successfully', 'user': {
-        'id': new_user.id,
-        'username': new_user.username,
-        'email': new_user.email,
-        'name': new_user.name,
-        'last_name': new_user.last_name,
-        'role': new_user.role
-    }}), 201
+    return jsonify({'message': 'User added successfully', 'user': serializers.user(new_user)}), 201
+
+
+# Route for bulk importing users from an uploaded CSV or NDJSON file
+@user_routes.route('/import', methods=['POST'])
+@role_required('librarian')
+def import_users():
+    try:
+        summary = import_upload(User, request)
+    except RowError as e:
+        return jsonify({'message': str(e)}), 400
+    if summary['inserted']:
+        versions = bump(*IMPORTED_TABLES[User])
+        # Too many rows for one event each: librarians reload the user list
+        publish('user', None, 'reload', {'inserted': summary['inserted']}, versions.get('users'))
+    return jsonify(summary), 200 if not summary['failed'] else 207
 
 
 # Route for changing user password
@@ -157,15 +200,16 @@ def change_password(user_id):
         return jsonify({"message": "Current password is required"}), 400
 
     # Check if the current password matches the one stored in the database
-    if not check_password_hash(user.password, current_password):
+    if not verify_password(user.password, current_password):
         return jsonify({"message": "Current password is incorrect"}), 400
     
     if not new_password:
         return jsonify({"message": "New password is required"}), 400
 
+    new_password_hash = hash_password(new_password)
     try:
         # Update the password after hashing it
-        user.password = generate_password_hash(new_password)
+        user.password = new_password_hash
         db.session.commit()
         return jsonify({"message": "Password changed successfully"})
     except Exception as e:
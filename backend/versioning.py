@@ -0,0 +1,171 @@
+import hashlib
+import threading
+import time
+from datetime import datetime
+from functools import wraps
+from flask import current_app, g, has_request_context, make_response, request
+from sqlalchemy import insert, select, update
+from sqlalchemy.exc import IntegrityError, SQLAlchemyError
+from db import db, primary
+from models import TableVersion
+
+# Per-table version counters behind the ETag headers of the read endpoints.
+# Write paths call bump() after their commit; readers compare the client's
+# validators against one primary-key lookup on table_versions and answer 304
+# without running the endpoint at all.
+#
+# Besides table names, 'catalog' counts changes to book titles and authors.
+# The in-process search indexes are built from those and compare it to know
+# when to rebuild; stock changes move 'books' but not 'catalog'.
+
+versions_table = TableVersion.__table__
+
+
+# Tables whose bump failed in this process, retried with the next bump or conditional read
+_owed = set()
+_owed_lock = threading.Lock()
+BUMP_ATTEMPTS = 3
+
+
+def bump(*tables):
+    """
+    Increments the version of each table in its own short transaction.
+
+    Called after the data commit so the hot version rows are never locked for
+    the length of a write transaction. A failed bump is retried; if it still
+    fails, the request whose write already succeeded is not failed, but the
+    tables stay owed: the next bump in this process includes them, and until
+    then conditional() sends no validators for them, so no client is told its
+    stale copy is current. Returns the new {table: version}, empty when the
+    bump failed.
+    """
+    return _bump(tables, BUMP_ATTEMPTS)
+
+
+def _bump(tables, attempts):
+    with _owed_lock:
+        tables = tuple(sorted(set(tables) | _owed))
+        _owed.clear()
+    if not tables:
+        return {}
+    for attempt in range(attempts):
+        try:
+            versions = _increment(tables)
+            db.session.commit()
+            break
+        except SQLAlchemyError as e:
+            db.session.rollback()
+            error = e
+            if attempt + 1 < attempts:
+                time.sleep(0.05 * (attempt + 1))
+    else:
+        with _owed_lock:
+            _owed.update(tables)
+        current_app.logger.warning('Could not bump table versions %s, will retry: %s', tables, error)
+        return {}
+    if has_request_context():
+        g.setdefault('table_versions', {}).update(versions)
+    return versions
+
+
+def _increment(tables):
+    now = datetime.utcnow()
+    result = db.session.execute(
+        update(versions_table)
+        .where(versions_table.c.name.in_(tables))
+        .values(version=versions_table.c.version + 1, updated_at=now)
+    )
+    if result.rowcount < len(tables):
+        existing = set(db.session.scalars(select(versions_table.c.name).where(versions_table.c.name.in_(tables))))
+        for table in set(tables) - existing:
+            try:
+                with db.session.begin_nested():
+                    db.session.execute(insert(versions_table).values(name=table, version=1, updated_at=now))
+            except IntegrityError:
+                pass  # Created concurrently; that bump counts as ours
+    return dict(db.session.execute(
+        select(versions_table.c.name, versions_table.c.version).where(versions_table.c.name.in_(tables))
+    ).all())
+
+
+def owed(tables):
+    """The tables among `tables` whose bump has not gone through yet, after one more try."""
+    if not _owed:
+        return set()
+    with primary():
+        _bump((), 1)
+    with _owed_lock:
+        return _owed & set(tables)
+
+
+def current_versions(tables):
+    """Returns {table: version} for the given tables."""
+    versions = {name: 0 for name in tables}
+    versions.update(db.session.execute(
+        select(versions_table.c.name, versions_table.c.version).where(versions_table.c.name.in_(tables))
+    ).all())
+    return versions
+
+
+def table_version(name):
+    """
+    The version of one table as the current request sees it: read at most once
+    per request, shared with conditional() and moved on by bump().
+    """
+    if not has_request_context():
+        return current_versions((name,))[name]
+    seen = g.setdefault('table_versions', {})
+    if name not in seen:
+        seen.update(current_versions((name,)))
+    return seen[name]
+
+
+def make_etag(versions, extra=''):
+    # The path and query string are part of the tag: /books/?limit=10 and /books/ differ
+    key = ','.join(f'{name}={versions[name]}' for name in sorted(versions))
+    if extra:
+        key = f'{key}|{extra}'
+    digest = hashlib.sha1(f'{request.full_path}|{key}'.encode('utf-8')).hexdigest()[:20]
+    return digest
+
+
+def not_modified(etag):
+    return bool(request.if_none_match) and request.if_none_match.contains(etag)
+
+
+def conditional(*tables, key=None):
+    """
+    Decorator for GET endpoints whose response depends only on `tables` and the URL.
+
+    Emits a strong ETag derived from the table versions and answers
+    If-None-Match with 304 before calling the view. For a response that also
+    depends on something else, such as today's date, `key` is a function
+    returning it as a string; it goes into the ETag.
+
+    No Last-Modified is sent: HTTP dates have one-second resolution, so a
+    client revalidating with If-Modified-Since would be told its copy is
+    current after a second write within the same second.
+    """
+    def decorator(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            if owed(tables):
+                # The versions do not show a committed write yet: answer in full and without validators
+                response = make_response(view(*args, **kwargs))
+                response.headers['Cache-Control'] = 'no-store'
+                return response
+            versions = current_versions(tables)
+            g.setdefault('table_versions', {}).update(versions)
+            etag = make_etag(versions) if key is None else make_etag(versions, key())
+            if not_modified(etag):
+                response = make_response('', 304)
+            else:
+                response = make_response(view(*args, **kwargs))
+                if response.status_code != 200:
+                    return response
+            response.set_etag(etag)
+            # Clients may keep the body but must revalidate before using it
+            response.headers['Cache-Control'] = 'no-cache'
+            return response
+        return wrapper
+    return decorator
@@ -0,0 +1,16 @@
+"""
+Production entry point.
+
+    gunicorn -c gunicorn.conf.py wsgi:app
+
+Worker count, threads, preloading and draining are configured through the
+environment, see gunicorn.conf.py. Any WSGI server can serve `app`, e.g.
+`uvicorn --interface wsgi wsgi:app`; only gunicorn gets the fork handling
+and graceful draining.
+"""
+from app import create_app
+import health
+
+# Background threads are started per worker by gunicorn.conf.py, after the fork
+app = create_app(start_background=False)
+health.warm_up(app)
@@ -0,0 +1,41 @@
+"""Shared helpers for the benchmark scripts: a throwaway SQLite database and a seeded app."""
+import os
+import sys
+import tempfile
+
+BACKEND_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'backend')
+
+
+def make_app(database_url=None, **config):
+    """
+    Imports the backend against `database_url` (a temporary SQLite file by default)
+    and creates the schema. Must be called before anything else imports the backend.
+    """
+    if database_url is None:
+        fd, path = tempfile.mkstemp(suffix='.db', prefix='library-bench-')
+        os.close(fd)
+        database_url = f'sqlite:///{path}'
+    os.environ['DATABASE_URL'] = database_url
+    os.environ.setdefault('SUGGEST_SNAPSHOT_PATH', os.path.join(tempfile.gettempdir(), 'library-bench-suggest.json'))
+    sys.path.insert(0, os.path.abspath(BACKEND_DIR))
+
+    from app import create_app
+    from db import db
+
+    app = create_app()
+
+    app.config.update(config)
+    with app.app_context():
+        db.create_all()
+    return app
+
+
+def authed_client(app, user_id=1, role='librarian'):
+    """A test client that sends an access token for `user_id` with every request."""
+    from auth import issue_access_token
+
+    with app.app_context():
+        token = issue_access_token(user_id, role)
+    client = app.test_client()
+    client.environ_base['HTTP_AUTHORIZATION'] = f'Bearer {token}'
+    return client
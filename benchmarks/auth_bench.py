@@ -0,0 +1,60 @@
+"""
+Measures the cost of request authentication and checks it against auth.VERIFY_BUDGET_US.
+
+    python benchmarks/auth_bench.py [--iterations 20000] [--budget-us 50]
+
+Reports microseconds per call for verifying a token seen for the first time
+(signature check), verifying an already seen token (cached claims, the path
+almost every request takes) and the whole before_request hook, which adds
+reading the Authorization header. Exits non-zero if the hook exceeds the
+budget for an already seen token. Results are printed as JSON.
+"""
+import argparse
+import json
+import sys
+import time
+
+from _support import make_app
+
+
+def per_call_us(function, iterations):
+    started = time.perf_counter()
+    for _ in range(iterations):
+        function()
+    return round((time.perf_counter() - started) / iterations * 1e6, 2)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--iterations', type=int, default=20000)
+    parser.add_argument('--budget-us', type=float)
+    args = parser.parse_args()
+
+    app = make_app()
+
+    import auth
+
+    budget = args.budget_us or auth.VERIFY_BUDGET_US
+    cold_iterations = max(1, args.iterations // 20)
+    with app.app_context():
+        fresh_tokens = iter([auth.issue_access_token(i, 'member') for i in range(cold_iterations)])
+        token = auth.issue_access_token(1, 'member')
+        auth.verify(token)
+
+        report = {
+            'iterations': args.iterations,
+            'budget_us': budget,
+            'verify_first_seen_us': per_call_us(lambda: auth.verify(next(fresh_tokens)), cold_iterations),
+            'verify_cached_us': per_call_us(lambda: auth.verify(token), args.iterations),
+        }
+
+    with app.test_request_context('/books/', headers={'Authorization': f'Bearer {token}'}):
+        report['request_hook_us'] = per_call_us(auth.authenticate, args.iterations)
+
+    report['within_budget'] = report['request_hook_us'] <= budget
+    print(json.dumps(report, indent=2))
+    sys.exit(0 if report['within_budget'] else 1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,167 @@
+"""
+Checkout desk: one batch request against a request per book.
+
+    python benchmarks/batch_bench.py [--sizes 1,5,10,15] [--repeat 5]
+
+For each batch size n, a member borrows n books and returns them, first
+with n calls to POST /loans/borrow and PUT /loans/return/<id>, then with one
+call to POST /loans/borrow/batch and PUT /loans/return/batch. Reports the
+SQL statements (X-SQL-Count) and the time per checkout and per return.
+
+Then checks the batch semantics: an atomic batch with one unavailable book
+lends nothing, a partial one lends the others and reports that book, a
+batch that holds a copy kept for the member lends that copy, and a batch
+return hands a copy to the member waiting for it. Exits 1 if any check fails,
+the stock counters disagree with the loans, or the statements of a batch
+request grow with its size.
+"""
+import argparse
+import json
+import statistics
+import sys
+import time
+
+from _support import authed_client, make_app
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', default='1,5,10,15')
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+    sizes = [int(size) for size in args.sizes.split(',')]
+
+    app = make_app(SQL_COUNT_HEADER=True)
+
+    from sqlalchemy import delete, func, insert, select
+    from db import db
+    from models import Book, BookDailyLoans, Hold, Loan, User, UserDailyLoans
+
+    books = max(sizes)
+    with app.app_context():
+        db.session.execute(insert(User.__table__), [
+            {'id': i, 'username': f'member{i}', 'password': 'x', 'role': 'member', 'email': f'm{i}@example.com'}
+            for i in (1, 2, 3)
+        ])
+        db.session.execute(insert(Book.__table__), [
+            {'id': i, 'title': f'Book {i}', 'author': 'Author', 'quantity': 2, 'available': True}
+            for i in range(1, books + 1)
+        ])
+        db.session.commit()
+
+    client = authed_client(app)
+
+    def call(method, url, **kwargs):
+        started = time.perf_counter()
+        response = client.open(url, method=method, **kwargs)
+        return response, time.perf_counter() - started, int(response.headers.get('X-SQL-Count', 0))
+
+    def open_loans(user_id):
+        with app.app_context():
+            return db.session.scalars(
+                select(Loan.id).where(Loan.user_id == user_id, Loan.date_returned.is_(None)).order_by(Loan.id)
+            ).all()
+
+    results = {}
+    checks = {}
+    for size in sizes:
+        book_ids = list(range(1, size + 1))
+        runs = {'single': {'borrow': [], 'return': []}, 'batch': {'borrow': [], 'return': []}}
+        statements = {'single': {}, 'batch': {}}
+        ok = True
+        for _ in range(args.repeat):
+            # A request per book
+            seconds, count = 0, 0
+            for book_id in book_ids:
+                response, elapsed, sql = call('POST', '/loans/borrow', json={'user_id': 1, 'book_id': book_id})
+                ok &= response.status_code == 201
+                seconds, count = seconds + elapsed, count + sql
+            runs['single']['borrow'].append(seconds)
+            statements['single']['borrow'] = count
+            seconds, count = 0, 0
+            for loan_id in open_loans(1):
+                response, elapsed, sql = call('PUT', f'/loans/return/{loan_id}')
+                ok &= response.status_code == 200
+                seconds, count = seconds + elapsed, count + sql
+            runs['single']['return'].append(seconds)
+            statements['single']['return'] = count
+
+            # One batch request
+            response, elapsed, sql = call('POST', '/loans/borrow/batch', json={'user_id': 1, 'book_ids': book_ids})
+            ok &= response.status_code == 201 and response.json['succeeded'] == size
+            runs['batch']['borrow'].append(elapsed)
+            statements['batch']['borrow'] = sql
+            response, elapsed, sql = call('PUT', '/loans/return/batch', json={'loan_ids': open_loans(1)})
+            ok &= response.status_code == 200 and response.json['succeeded'] == size
+            runs['batch']['return'].append(elapsed)
+            statements['batch']['return'] = sql
+
+        results[size] = {
+            mode: {
+                f'{step}_ms': round(statistics.median(timings) * 1000, 2)
+                for step, timings in runs[mode].items()
+            } | {f'{step}_statements': count for step, count in statements[mode].items()}
+            for mode in runs
+        }
+        checks[f'size_{size}_ok'] = ok
+    batch_counts = [(results[size]['batch']['borrow_statements'], results[size]['batch']['return_statements'])
+                    for size in sizes if size > 1]
+    checks['batch_statements_constant'] = len(set(batch_counts)) <= 1
+
+    # Semantics: book 1 has no copy left for member 2 once member 3 took the last two
+    with app.app_context():
+        db.session.execute(Book.__table__.update().where(Book.id == 1).values(quantity=1))
+        db.session.commit()
+    call('POST', '/loans/borrow', json={'user_id': 3, 'book_id': 1})
+    response, _, _ = call('POST', '/loans/borrow/batch', json={'user_id': 2, 'book_ids': [2, 1, 3]})
+    checks['atomic_lends_nothing'] = response.status_code == 400 and open_loans(2) == [] and \
+        [item['book_id'] for item in response.json['results']] == [1]
+    response, _, _ = call('POST', '/loans/borrow/batch', json={'user_id': 2, 'book_ids': [2, 1, 3], 'mode': 'partial'})
+    statuses = {item['book_id']: item['status'] for item in response.json['results']}
+    checks['partial_lends_the_rest'] = response.status_code == 207 and statuses == {2: 201, 1: 400, 3: 201}
+
+    # Member 2 holds book 1; member 3's batch return gives them the copy, and their batch borrow takes it
+    member2 = authed_client(app, 2, 'member')
+    hold = member2.post('/holds/', json={'book_id': 1}).json['hold']
+    member3_loans = open_loans(3)
+    response, _, _ = call('PUT', '/loans/return/batch', json={'loan_ids': member3_loans})
+    with app.app_context():
+        status = db.session.scalar(select(Hold.status).where(Hold.id == hold['id']))
+    checks['return_hands_copy_to_hold'] = response.status_code == 200 and status == 'ready'
+    response, _, _ = call('POST', '/loans/borrow/batch', json={'user_id': 2, 'book_ids': [1, 4]})
+    with app.app_context():
+        status = db.session.scalar(select(Hold.status).where(Hold.id == hold['id']))
+    checks['borrow_claims_held_copy'] = response.status_code == 201 and status == 'fulfilled'
+    response, _, _ = call('PUT', '/loans/return/batch', json={'loan_ids': open_loans(2) + [10 ** 6],
+                                                              'mode': 'partial'})
+    checks['partial_return_reports_missing'] = response.status_code == 207 and response.json['failed'] == 1
+
+    with app.app_context():
+        book_rows = db.session.execute(select(Book.id, Book.quantity, Book.active_loans)).all()
+        open_by_book = dict(db.session.execute(
+            select(Loan.book_id, func.count(Loan.id)).where(Loan.date_returned.is_(None)).group_by(Loan.book_id)
+        ).all())
+        user_rows = db.session.execute(select(User.id, User.active_loans)).all()
+        open_by_user = dict(db.session.execute(
+            select(Loan.user_id, func.count(Loan.id)).where(Loan.date_returned.is_(None)).group_by(Loan.user_id)
+        ).all())
+        total = 2 * books - 1
+        checks['stock_ok'] = (
+            all(active == open_by_book.get(book_id, 0) for book_id, _, active in book_rows)
+            and all(active == open_by_user.get(user_id, 0) for user_id, active in user_rows)
+            and sum(quantity + active for _, quantity, active in book_rows) == total
+        )
+        borrows = db.session.scalar(select(func.sum(UserDailyLoans.borrows)))
+        returns = db.session.scalar(select(func.sum(BookDailyLoans.returns)))
+        loans = db.session.scalar(select(func.count(Loan.id)))
+        returned = db.session.scalar(select(func.count(Loan.id)).where(Loan.date_returned.isnot(None)))
+        checks['analytics_ok'] = borrows == loans and returns == returned
+        db.session.execute(delete(Hold.__table__))
+        db.session.commit()
+
+    print(json.dumps({'repeat': args.repeat, 'sizes': results, 'checks': checks}, indent=2))
+    sys.exit(0 if all(checks.values()) else 1)
+
+
+if __name__ == '__main__':
+    main()
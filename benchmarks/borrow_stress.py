@@ -0,0 +1,84 @@
+"""
+Concurrent borrow stress test for the inventory service.
+
+    python benchmarks/borrow_stress.py --threads 16 --copies 200 [--database-url mysql+pymysql://...]
+
+Many threads borrow the same title at once through POST /loans/borrow. The
+run fails if more loans were created than there were copies, or if the final
+quantity or active loan counters do not match, and reports successful borrows
+per second.
+"""
+import argparse
+import sys
+import threading
+import time
+
+from _support import authed_client, make_app
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--threads', type=int, default=16)
+    parser.add_argument('--copies', type=int, default=200)
+    parser.add_argument('--attempts-per-thread', type=int, default=50)
+    parser.add_argument('--database-url')
+    args = parser.parse_args()
+
+    app = make_app(args.database_url)
+
+    from db import db
+    from models import Book, Loan, User
+
+    members = args.threads * args.attempts_per_thread
+    with app.app_context():
+        book = Book(title='Popular Title', author='Someone', quantity=args.copies, available=True)
+        db.session.add(book)
+        db.session.add_all([
+            User(username=f'member{i}', password='x', role='member', email=f'member{i}@example.com')
+            for i in range(members)
+        ])
+        db.session.commit()
+        book_id = book.id
+        user_ids = [user.id for user in User.query.order_by(User.id)]
+
+    results = {'ok': 0, 'rejected': 0, 'error': 0}
+    lock = threading.Lock()
+    start_barrier = threading.Barrier(args.threads)
+
+    def worker(offset):
+        client = authed_client(app)
+        start_barrier.wait()
+        for i in range(args.attempts_per_thread):
+            user_id = user_ids[offset * args.attempts_per_thread + i]
+            response = client.post('/loans/borrow', json={'user_id': user_id, 'book_id': book_id})
+            key = 'ok' if response.status_code == 201 else 'rejected' if response.status_code == 400 else 'error'
+            with lock:
+                results[key] += 1
+
+    threads = [threading.Thread(target=worker, args=(i,)) for i in range(args.threads)]
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - started
+
+    with app.app_context():
+        loans = Loan.query.filter_by(book_id=book_id).count()
+        book = db.session.get(Book, book_id)
+        quantity = book.quantity
+        counted = book.active_loans
+        user_counted = db.session.query(db.func.sum(User.active_loans)).scalar() or 0
+
+    oversold = loans > args.copies or quantity < 0 or quantity != args.copies - loans
+    counters_ok = counted == loans and user_counted == loans
+    print(f'threads={args.threads} attempts={members} copies={args.copies}')
+    print(f"borrowed={results['ok']} rejected={results['rejected']} errors={results['error']}")
+    print(f'loans_in_db={loans} final_quantity={quantity} oversold={oversold}')
+    print(f'book_active_loans={counted} user_active_loans={user_counted} counters_ok={counters_ok}')
+    print(f"borrows/s={results['ok'] / elapsed:.1f} requests/s={members / elapsed:.1f}")
+    sys.exit(1 if oversold or not counters_ok else 0)
+
+
+if __name__ == '__main__':
+    main()
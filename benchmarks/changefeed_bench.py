@@ -0,0 +1,230 @@
+"""
+Change feed fan-out to idle subscribers of GET /events.
+
+    python benchmarks/changefeed_bench.py [--threads 4000] [--events 50] [--interval 0.05]
+
+Every stream holds one request thread for its whole length, and a process
+serves at most EVENTS_MAX_SUBSCRIBERS of them, a quarter of its WEB_THREADS
+by default (see config.py). The benchmark configures the app for --threads
+request threads and opens as many streams as that allows through the real
+endpoint, each read from its own thread the way a gthread worker serves it,
+half of them as librarians and half as members; the default of 4000 threads
+is what one process needs to serve 1000 streams. It checks that one stream
+more is refused with a 503. With every subscriber idle, it publishes
+--events change events --interval seconds apart, alternating book events
+that everyone receives and loan events for one member, and measures:
+
+- the time a write path spends in publish()
+- the delay from publish() until each subscriber has the event's frame
+- the memory the idle subscribers take, thread stacks included
+
+For comparison the same events are published to one queue per subscriber,
+the usual alternative to a shared ring buffer, where publishing costs one
+put per subscriber. Then a subscriber resumes from an event id the way a
+reconnecting EventSource does. Exits 1 if the cap is not enforced, any
+subscriber misses an event it should see or receives one it should not, or
+the resume does not replay exactly the events after the id.
+"""
+import argparse
+import json
+import os
+import queue
+import statistics
+import sys
+import threading
+import time
+
+from _support import authed_client, make_app
+
+
+def rss_kib():
+    with open('/proc/self/status') as status:
+        for line in status:
+            if line.startswith('VmRSS:'):
+                return int(line.split()[1])
+    return 0
+
+
+def percentiles(samples, scale=1000):
+    """p50, p99 and max, in milliseconds by default."""
+    samples = sorted(samples)
+    return {
+        'p50': round(statistics.median(samples) * scale, 3),
+        'p99': round(samples[int(len(samples) * 0.99) - 1] * scale, 3),
+        'max': round(samples[-1] * scale, 3),
+    }
+
+
+def event_seq(frame):
+    return int(frame.split('\n', 1)[0].rsplit('-', 1)[1])
+
+
+def frames(response):
+    """The SSE frames of a streamed response, as they arrive."""
+    for chunk in response.response:
+        yield chunk.decode() if isinstance(chunk, bytes) else chunk
+
+
+def open_stream(client, last_event_id=None):
+    headers = {} if last_event_id is None else {'Last-Event-ID': last_event_id}
+    return client.get('/events', headers=headers, buffered=False)
+
+
+def run_feed(app, args):
+    import changefeed
+
+    feed = changefeed.feed
+    subscribers = app.config['EVENTS_MAX_SUBSCRIBERS']
+    first = feed.last + 1
+
+    def wanted(i):
+        # Librarians and the member whose loans change see every event, other members the book events
+        seqs = range(first, first + args.events)
+        return list(seqs) if i % 2 == 0 or i == 1 else [seq for seq in seqs if (seq - first) % 2 == 0]
+
+    clients = [authed_client(app, 1000 + i, 'librarian' if i % 2 == 0 else 'member') for i in range(subscribers)]
+    expected = [len(wanted(i)) for i in range(subscribers)]
+    received = [[] for _ in range(subscribers)]
+    ready = threading.Barrier(subscribers + 1)
+    done = threading.Semaphore(0)
+
+    def subscriber(i):
+        response = open_stream(clients[i])
+        try:
+            body = frames(response)
+            next(body)  # retry:
+            ready.wait()
+            for frame in body:
+                received[i].append((time.perf_counter(), event_seq(frame)))
+                if len(received[i]) == expected[i]:
+                    done.release()
+                    return
+        finally:
+            response.close()
+
+    before = rss_kib()
+    threads = [threading.Thread(target=subscriber, args=(i,), daemon=True) for i in range(subscribers)]
+    for thread in threads:
+        thread.start()
+    ready.wait()
+    idle_kib = rss_kib() - before
+    over_cap = open_stream(authed_client(app, 1, 'librarian'))
+    refused = over_cap.status_code == 503
+    over_cap.close()
+
+    published_at = {}
+    publish_seconds = []
+    for n in range(args.events):
+        time.sleep(args.interval)
+        started = time.perf_counter()
+        if n % 2 == 0:
+            changefeed.publish('book', n, 'update', {'quantity': n}, n)
+        else:
+            changefeed.publish('loan', n, 'update', {'date_returned': None}, n, owner=1000 + 1)
+        publish_seconds.append(time.perf_counter() - started)
+        published_at[feed.last] = started
+
+    finished = all(done.acquire(timeout=30) for _ in range(subscribers))
+    for thread in threads:
+        thread.join(timeout=5)
+    delays = [at - published_at[seq] for frames in received for at, seq in frames]
+    correct = all([seq for _, seq in frames] == wanted(i) for i, frames in enumerate(received))
+
+    return {
+        'subscribers': subscribers,
+        'idle_rss_kib_per_subscriber': round(idle_kib / subscribers, 1),
+        'publish_us': percentiles(publish_seconds, 1e6),
+        'delivery_ms': percentiles(delays),
+        'deliveries': len(delays),
+    }, {'over_cap_refused': refused, 'deliveries_correct': finished and correct}
+
+
+def run_queues(args, subscribers):
+    """One queue per subscriber: publish puts the frame on every queue."""
+    queues = [queue.Queue() for _ in range(subscribers)]
+    delays = []
+    lock = threading.Lock()
+    ready = threading.Barrier(subscribers + 1)
+
+    def subscriber(q):
+        ready.wait()
+        mine = []
+        for _ in range(args.events):
+            published, _frame = q.get()
+            mine.append(time.perf_counter() - published)
+        with lock:
+            delays.extend(mine)
+
+    threads = [threading.Thread(target=subscriber, args=(q,), daemon=True) for q in queues]
+    for thread in threads:
+        thread.start()
+    ready.wait()
+
+    publish_seconds = []
+    for n in range(args.events):
+        time.sleep(args.interval)
+        started = time.perf_counter()
+        frame = f'id: {n}\nevent: change\ndata: {json.dumps({"entity": "book", "id": n})}\n\n'
+        for q in queues:
+            q.put((started, frame))
+        publish_seconds.append(time.perf_counter() - started)
+    for thread in threads:
+        thread.join(timeout=30)
+
+    return {
+        'publish_us': percentiles(publish_seconds, 1e6),
+        'delivery_ms': percentiles(delays),
+        'deliveries': len(delays),
+    }
+
+
+def check_resume(app):
+    """A librarian resuming from the second of five events gets the last three; an unknown id gets a reset."""
+    import changefeed
+
+    feed = changefeed.feed
+    client = authed_client(app, 1, 'librarian')
+    start = feed.last
+    for n in range(5):
+        changefeed.publish('book', n, 'update', {'quantity': n})
+    response = open_stream(client, feed.event_id(start + 2))
+    body = frames(response)
+    next(body)
+    replayed = [event_seq(next(body)) for _ in range(3)]
+    response.close()
+    response = open_stream(client, 'elsewhere-3')
+    body = frames(response)
+    next(body)
+    reset = 'event: reset' in next(body)
+    response.close()
+    return replayed == [start + 3, start + 4, start + 5] and reset
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--threads', type=int, default=4000, help='WEB_THREADS of the process under test.')
+    parser.add_argument('--events', type=int, default=50)
+    parser.add_argument('--interval', type=float, default=0.05, help='Seconds between published events.')
+    args = parser.parse_args()
+
+    # Read by config.py, which derives the stream cap from it
+    os.environ['WEB_THREADS'] = str(args.threads)
+    # Threads for every subscriber, on small stacks as a server's would be
+    threading.stack_size(256 * 1024)
+    app = make_app(EVENTS_HEARTBEAT=60)
+
+    feed_results, checks = run_feed(app, args)
+    queue_results = run_queues(args, feed_results['subscribers'])
+    checks['resume_ok'] = check_resume(app)
+    print(json.dumps({
+        'web_threads': args.threads,
+        'events': args.events,
+        'ring_buffer': feed_results,
+        'queue_per_subscriber': queue_results,
+        'checks': checks,
+    }, indent=2))
+    sys.exit(0 if all(checks.values()) else 1)
+
+
+if __name__ == '__main__':
+    main()
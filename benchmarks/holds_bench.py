@@ -0,0 +1,153 @@
+"""
+Hold queue against polling: requests spent waiting for a book, and who gets it.
+
+    python benchmarks/holds_bench.py [--members 8] [--hold-seconds 0.3] [--poll-interval 0.25]
+
+One book with a single copy circulates: whoever has it returns it after
+--hold-seconds, and a waiting member takes it. In each mode --members
+members join the wait one after another while the copy is out, and the run
+ends when every one of them has had it once:
+
+- poll: members GET /books/<id> every --poll-interval seconds and try to
+  borrow when a copy shows up, as clients do without holds
+- hold: members place a hold and long-poll GET /holds/<id>/wait; the returned
+  copy is set aside for the head of the queue, who then borrows it
+
+Reports the requests made while waiting, the delay between a return and the
+next borrow, and whether members were served in the order they joined.
+Exits 1 if the hold mode serves anyone out of order or the book's stock
+does not add up at the end.
+"""
+import argparse
+import json
+import statistics
+import sys
+import threading
+import time
+
+from _support import authed_client, make_app
+
+
+def run_mode(app, mode, args):
+    from sqlalchemy import delete, insert, select
+    from db import db
+    from models import Book, Hold, Loan, User
+
+    with app.app_context():
+        for model in (Hold, Loan, Book, User):
+            db.session.execute(delete(model.__table__))
+        db.session.execute(insert(User.__table__), [
+            {'id': i, 'username': f'member{i}', 'password': 'x', 'role': 'member', 'email': f'member{i}@example.com'}
+            for i in range(1, args.members + 2)
+        ])
+        db.session.execute(insert(Book.__table__).values(id=1, title='Popular', author='Author', quantity=1,
+                                                         available=True))
+        db.session.commit()
+
+    clients = {i: authed_client(app, i, 'member') for i in range(1, args.members + 2)}
+    lock = threading.Lock()
+    requests = {'waiting': 0}
+    served = []  # (member, seconds from the previous return to this borrow)
+    returned_at = [None]
+
+    def count():
+        with lock:
+            requests['waiting'] += 1
+
+    def borrow_and_return(member):
+        client = clients[member]
+        response = client.post('/loans/borrow', json={'user_id': member, 'book_id': 1})
+        if response.status_code != 201:
+            return False
+        with lock:
+            delay = time.perf_counter() - returned_at[0] if returned_at[0] else 0.0
+            served.append((member, delay))
+        time.sleep(args.hold_seconds)
+        with app.app_context():
+            loan_id = db.session.scalar(
+                select(Loan.id).where(Loan.user_id == member, Loan.date_returned.is_(None))
+            )
+        with lock:
+            returned_at[0] = time.perf_counter()
+        client.put(f'/loans/return/{loan_id}')
+        return True
+
+    def poller(member):
+        client = clients[member]
+        while True:
+            count()
+            if client.get('/books/1').json['quantity'] > 0:
+                count()
+                if borrow_and_return(member):
+                    return
+            time.sleep(args.poll_interval)
+
+    def holder(member):
+        client = clients[member]
+        count()
+        hold = client.post('/holds/', json={'book_id': 1}).json['hold']
+        status = hold['status']
+        while status != 'ready':
+            count()
+            status = client.get(f"/holds/{hold['id']}/wait?status={status}&timeout=30").json['status']
+        count()
+        borrow_and_return(member)
+
+    # An extra member has the copy; the others start waiting one after another
+    threads = []
+    first = threading.Thread(target=borrow_and_return, args=(args.members + 1,))
+    first.start()
+    time.sleep(0.05)
+    for member in range(1, args.members + 1):
+        thread = threading.Thread(target=poller if mode == 'poll' else holder, args=(member,))
+        thread.start()
+        threads.append(thread)
+        time.sleep(0.02)
+    first.join()
+    for thread in threads:
+        thread.join()
+
+    with app.app_context():
+        book = db.session.get(Book, 1)
+        open_loans = Loan.query.filter(Loan.date_returned.is_(None)).count()
+        ready = Hold.query.filter(Hold.status == 'ready').count()
+        stock_ok = book.quantity + book.active_loans + ready == 1 and book.active_loans == open_loans
+
+    order = [member for member, _ in served[1:]]
+    delays = [delay for _, delay in served[1:]]
+    return {
+        'requests_while_waiting': requests['waiting'],
+        'requests_per_member': round(requests['waiting'] / args.members, 1),
+        'handover_ms': {
+            'median': round(statistics.median(delays) * 1000, 1),
+            'max': round(max(delays) * 1000, 1),
+        },
+        'served_in_join_order': order == sorted(order),
+        'order': order,
+        'stock_ok': stock_ok,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--members', type=int, default=8)
+    parser.add_argument('--hold-seconds', type=float, default=0.3, help='How long each member keeps the copy.')
+    parser.add_argument('--poll-interval', type=float, default=0.25)
+    args = parser.parse_args()
+
+    app = make_app()
+
+    import holds
+
+    # Every member long-polls at once; recheck rarely so wake-ups come from the commits
+    holds.waiters.configure(args.members, 30)
+
+    results = {mode: run_mode(app, mode, args) for mode in ('poll', 'hold')}
+    print(json.dumps({'members': args.members, 'hold_seconds': args.hold_seconds,
+                      'poll_interval': args.poll_interval, 'modes': results}, indent=2))
+    hold = results['hold']
+    sys.exit(0 if hold['served_in_join_order'] and hold['stock_ok'] else 1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,102 @@
+"""
+Login throughput with the password hashing pool.
+
+    python benchmarks/password_bench.py --workers 0,1,2,4 --threads 16 --duration 10
+    python benchmarks/password_bench.py --method pbkdf2:sha256:600000
+
+For each pool size, --threads clients call POST /auth/login for --duration
+seconds. Pool size 0 hashes on the request threads, as before the pool.
+Reports logins per second overall and per hashing core, latency percentiles
+and how many logins were turned away with 503 by the admission limit.
+Results are printed as JSON.
+"""
+import argparse
+import json
+import os
+import threading
+import time
+
+from _support import make_app
+
+PASSWORD = 'bench-password'
+
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return None
+    return round(sorted_values[min(len(sorted_values) - 1, int(fraction * len(sorted_values)))] * 1000, 1)
+
+
+def run(app, threads, duration):
+    results = {'ok': 0, 'busy': 0, 'error': 0}
+    timings = []
+    lock = threading.Lock()
+    stop = time.perf_counter() + duration
+
+    def worker():
+        client = app.test_client()
+        while time.perf_counter() < stop:
+            started = time.perf_counter()
+            response = client.post('/auth/login', json={'username': 'reader', 'password': PASSWORD})
+            elapsed = time.perf_counter() - started
+            key = 'ok' if response.status_code == 200 else 'busy' if response.status_code == 503 else 'error'
+            with lock:
+                results[key] += 1
+                if key == 'ok':
+                    timings.append(elapsed)
+
+    started = time.perf_counter()
+    pool = [threading.Thread(target=worker) for _ in range(threads)]
+    for thread in pool:
+        thread.start()
+    for thread in pool:
+        thread.join()
+    return results, sorted(timings), time.perf_counter() - started
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--workers', default='0,1,2,4', help='Comma-separated pool sizes to try.')
+    parser.add_argument('--threads', type=int, default=16)
+    parser.add_argument('--duration', type=float, default=10)
+    parser.add_argument('--method', help='PASSWORD_HASH_METHOD to benchmark.')
+    args = parser.parse_args()
+
+    app = make_app()
+
+    from db import db
+    from models import User
+    import passwords
+
+    if args.method:
+        app.config['PASSWORD_HASH_METHOD'] = args.method
+        passwords.passwords.configure(app.config)
+    with app.app_context():
+        db.session.add(User(username='reader', password=passwords.hash_password(PASSWORD), role='member',
+                            email='reader@example.com'))
+        db.session.commit()
+
+    report = {'method': app.config['PASSWORD_HASH_METHOD'], 'threads': args.threads, 'cpus': os.cpu_count(),
+              'runs': []}
+    for workers in [int(value) for value in args.workers.split(',')]:
+        app.config['PASSWORD_HASH_WORKERS'] = workers
+        passwords.passwords.configure(app.config)
+        results, timings, elapsed = run(app, args.threads, args.duration)
+        logins_per_second = results['ok'] / elapsed
+        report['runs'].append({
+            'workers': workers,
+            'logins': results['ok'],
+            'rejected_busy': results['busy'],
+            'errors': results['error'],
+            'logins_per_second': round(logins_per_second, 1),
+            'logins_per_second_per_core': round(logins_per_second / max(workers, 1), 1),
+            'p50_ms': percentile(timings, 0.50),
+            'p95_ms': percentile(timings, 0.95),
+            'p99_ms': percentile(timings, 0.99),
+        })
+    passwords.passwords.shutdown()
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == '__main__':
+    main()
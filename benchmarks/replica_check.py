@@ -0,0 +1,112 @@
+"""
+Checks read-replica routing and read-your-writes stickiness.
+
+    python benchmarks/replica_check.py [--sticky-seconds 1]
+
+The primary and the replica are two SQLite files. The replica is a snapshot
+of the primary taken after seeding and never updated, i.e. a replica that
+lags forever, so a read shows which database served it. Counts statements
+per database for each step and exits non-zero if a read went to the wrong
+one: catalog and loan listings go to the replica, except for a user who has
+just borrowed (or had a book borrowed for them), who reads from the primary
+until REPLICA_STICKY_SECONDS have passed.
+"""
+import argparse
+import json
+import os
+import sqlite3
+import sys
+import tempfile
+import time
+
+from _support import authed_client, make_app
+
+
+def temp_database():
+    fd, path = tempfile.mkstemp(suffix='.db', prefix='library-replica-')
+    os.close(fd)
+    return path
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sticky-seconds', type=int, default=1)
+    args = parser.parse_args()
+
+    primary_path, replica_path = temp_database(), temp_database()
+    os.environ['DATABASE_REPLICA_URLS'] = f'sqlite:///{replica_path}'
+    os.environ['REPLICA_STICKY_SECONDS'] = str(args.sticky_seconds)
+    os.environ['CACHE_ENABLED'] = 'false'
+    app = make_app(f'sqlite:///{primary_path}')
+
+    from sqlalchemy import event
+    from db import db
+    import replicas
+    from models import Book, User
+
+    with app.app_context():
+        db.session.add_all([
+            User(username='librarian', password='x', role='librarian', email='librarian@example.com'),
+            User(username='member', password='x', role='member', email='member@example.com'),
+            User(username='other', password='x', role='member', email='other@example.com'),
+        ])
+        db.session.add_all([Book(title=f'Title {i}', author='Author', quantity=3, available=True) for i in range(20)])
+        db.session.commit()
+        engines = dict(db.engines)
+
+    # Snapshot the primary into the replica file
+    source, target = sqlite3.connect(primary_path), sqlite3.connect(replica_path)
+    source.backup(target)
+    source.close()
+    target.close()
+
+    statements = {}
+    for key, engine in engines.items():
+        name = key or 'primary'
+        event.listen(engine, 'before_cursor_execute',
+                     lambda *a, name=name: statements.__setitem__(name, statements.get(name, 0) + 1))
+
+    librarian, member, other = (authed_client(app, user_id, role)
+                                for user_id, role in ((1, 'librarian'), (2, 'member'), (3, 'member')))
+    # A process looks each token up in revoked_tokens, on the primary, the first time it sees it
+    for client in (librarian, member, other):
+        client.get('/books/?limit=1')
+    steps = []
+
+    def step(description, client, method, path, expected_db, check=None, **kwargs):
+        statements.clear()
+        response = client.open(path, method=method, **kwargs)
+        served_by = sorted(statements)
+        ok = response.status_code < 400 and (expected_db is None or served_by == [expected_db])
+        if check is not None:
+            ok = ok and check(response.get_json())
+        steps.append({'step': description, 'status': response.status_code, 'statements': dict(statements),
+                      'ok': ok})
+        return response
+
+    def loan_count(expected):
+        return lambda body: len(body['loans'] if isinstance(body, dict) else body) == expected
+
+    step('member lists books', member, 'GET', '/books/?limit=5', 'replica1')
+    step('first search builds the index from the primary', member, 'GET', '/books/search?query=title', None)
+    step('member searches', member, 'GET', '/books/search?query=title', 'replica1')
+    step('librarian lists users', librarian, 'GET', '/users/', 'replica1')
+    response = step('librarian borrows for member', librarian, 'POST', '/loans/borrow', None,
+                    json={'user_id': 2, 'book_id': 1})
+    # Sent back with the librarian's next requests, as the SPA does
+    librarian.environ_base['HTTP_X_READ_PRIMARY_UNTIL'] = response.headers.get(replicas.STICKY_HEADER, '')
+    step('member sees the new loan', member, 'GET', '/loans/user/2', 'primary', loan_count(1))
+    step('librarian sees the new loan', librarian, 'GET', '/loans/', 'primary', loan_count(1))
+    replicas._sticky.clear()  # As on a worker that did not serve the write: only the header is left
+    step('librarian sees it on another worker', librarian, 'GET', '/loans/', 'primary', loan_count(1))
+    step('other member reads the lagging replica', other, 'GET', '/loans/', 'replica1', loan_count(0))
+    time.sleep(args.sticky_seconds + 0.2)
+    step('member back on the replica', member, 'GET', '/loans/user/2', 'replica1', loan_count(0))
+
+    ok = all(s['ok'] for s in steps)
+    print(json.dumps({'sticky_seconds': args.sticky_seconds, 'steps': steps, 'ok': ok}, indent=2))
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,131 @@
+"""
+Serialization microbenchmark: building and encoding 10k-row list responses.
+
+    python benchmarks/serialize_bench.py [--rows 10000] [--repeat 5]
+
+Compares, for the GET /books/ and GET /loans/ payloads, the per-route dict
+building the routes used to do (ORM objects, strftime per date) with the
+compiled serializers in serializers.py, and Flask's default JSON provider
+with the orjson provider from json_provider.py. Database time is excluded:
+rows are loaded once up front. Reports the best of --repeat runs in
+milliseconds per payload, rows per second and encoded MB per second.
+"""
+import argparse
+import json
+import time
+from datetime import date, timedelta
+
+from _support import make_app
+
+
+def best_ms(function, repeat):
+    timings = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        function()
+        timings.append(time.perf_counter() - started)
+    return min(timings) * 1000
+
+
+def old_books(books):
+    return [{
+        'id': book.id,
+        'title': book.title,
+        'author': book.author,
+        'available': book.available,
+        'quantity': book.quantity,
+        'image_url': book.image_url
+    } for book in books]
+
+
+def old_loans(loans):
+    return [{
+        'id': loan.id,
+        'title': loan.title,
+        'user_id': loan.user_id,
+        'book_id': loan.book_id,
+        'loan_date': loan.loan_date.strftime('%Y-%m-%d'),
+        'return_date': loan.return_date.strftime('%Y-%m-%d'),
+        'date_returned': loan.date_returned.strftime('%Y-%m-%d') if loan.date_returned else None
+    } for loan in loans]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rows', type=int, default=10000)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    app = make_app()
+
+    from datetime import datetime
+    from flask.json.provider import DefaultJSONProvider
+    from sqlalchemy import insert
+    from db import db
+    from models import Book, Loan, User
+    from book_routes import BOOK_LIST_COLUMNS
+    from loan_queries import LOAN_LIST_COLUMNS
+    import json_provider
+    import serializers
+
+    start = date(2024, 1, 1)
+    with app.app_context():
+        db.session.execute(insert(User.__table__), [{'username': 'reader', 'password': 'x', 'role': 'member',
+                                                     'email': 'reader@example.com'}])
+        db.session.execute(insert(Book.__table__), [
+            {'title': f'Title number {i}', 'author': f'Author {i % 300}', 'available': True, 'quantity': 3,
+             'image_url': f'/images/{i}.webp' if i % 2 else None}
+            for i in range(args.rows)
+        ])
+        db.session.execute(insert(Loan.__table__), [
+            {'user_id': 1, 'book_id': i + 1, 'title': f'Title number {i}', 'loan_date': start + timedelta(days=i % 365),
+             'return_date': start + timedelta(days=i % 365 + 30),
+             'date_returned': datetime(2024, 3, 1, 12, 0) if i % 3 else None}
+            for i in range(args.rows)
+        ])
+        db.session.commit()
+
+    providers = {'stdlib': DefaultJSONProvider(app)}
+    if json_provider.orjson is not None:
+        providers['orjson'] = json_provider.OrjsonProvider(app)
+
+    results = {}
+    with app.test_request_context():
+        books = Book.query.all()
+        book_rows = db.session.query(*BOOK_LIST_COLUMNS).all()
+        loan_rows = db.session.query(*LOAN_LIST_COLUMNS).all()
+        assert old_books(books) == serializers.book.many(book_rows)
+        assert old_loans(loan_rows) == serializers.loan.many(loan_rows)
+
+        for name, old, old_input, serializer, new_input in (
+            ('books', old_books, books, serializers.book, book_rows),
+            ('loans', old_loans, loan_rows, serializers.loan, loan_rows),
+        ):
+            payload = serializer.many(new_input)
+            size_mb = len(providers['stdlib'].response(payload).get_data()) / 1e6
+            case = {
+                'build_ms': {
+                    'dict_comprehension': round(best_ms(lambda: old(old_input), args.repeat), 2),
+                    'serializer': round(best_ms(lambda: serializer.many(new_input), args.repeat), 2),
+                },
+                'encode_ms': {},
+                'payload_mb': round(size_mb, 2),
+            }
+            for provider_name, provider in providers.items():
+                case['encode_ms'][provider_name] = round(best_ms(lambda: provider.response(payload), args.repeat), 2)
+            fastest = providers['orjson' if 'orjson' in providers else 'stdlib']
+            before = best_ms(lambda: providers['stdlib'].response(old(old_input)), args.repeat)
+            after = best_ms(lambda: fastest.response(serializer.many(new_input)), args.repeat)
+            case['total_ms'] = {'before': round(before, 2), 'after': round(after, 2)}
+            case['rows_per_second'] = {'before': round(args.rows / before * 1000),
+                                       'after': round(args.rows / after * 1000)}
+            case['encode_mb_per_second'] = {name: round(size_mb / ms * 1000, 1)
+                                            for name, ms in case['encode_ms'].items()}
+            case['speedup'] = round(before / after, 2)
+            results[name] = case
+
+    print(json.dumps({'rows': args.rows, 'encoders': list(providers), 'payloads': results}, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -17,6 +17,10 @@ startPeriodicTokenCheck(() => {
 // Axios global configuration
 axios.defaults.baseURL = 'http://127.0.0.1:5000'; 
 
+// After a write the API answers with X-Read-Primary-Until: sending it back until then
+// keeps our reads off lagging read replicas, so we see our own changes
+const READ_PRIMARY_UNTIL = 'X-Read-Primary-Until';
+
 // Request interceptor to attach Authorization header
 axios.interceptors.request.use(
   (config) => {
@@ -30,6 +34,10 @@ axios.interceptors.request.use(
       }
       config.headers.Authorization = `Bearer ${token}`;
     }
+    const readPrimaryUntil = localStorage.getItem('readPrimaryUntil');
+    if (readPrimaryUntil) {
+      config.headers[READ_PRIMARY_UNTIL] = readPrimaryUntil;
+    }
     return config;
   },
   (error) => Promise.reject(error)
@@ -37,7 +45,13 @@ axios.interceptors.request.use(
 
 // Response interceptor to handle 401 errors and expired token
 axios.interceptors.response.use(
-  (response) => response,
+  (response) => {
+    const readPrimaryUntil = response.headers[READ_PRIMARY_UNTIL.toLowerCase()];
+    if (readPrimaryUntil) {
+      localStorage.setItem('readPrimaryUntil', readPrimaryUntil);
+    }
+    return response;
+  },
   (error) => {
     if (error.response?.status === 401 || (error.response?.data?.message && error.response.data.message === 'Token expired')) {
       // Remove the token if expired
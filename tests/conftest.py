@@ -0,0 +1,39 @@
+"""Fixtures for the backend tests: the app against a throwaway SQLite database."""
+import os
+import sys
+
+import pytest
+
+BACKEND_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'backend')
+
+
+@pytest.fixture(scope='session')
+def app(tmp_path_factory):
+    # config.py reads the environment when it is first imported
+    os.environ['DATABASE_URL'] = f"sqlite:///{tmp_path_factory.mktemp('db') / 'library.db'}"
+    os.environ['SUGGEST_SNAPSHOT_PATH'] = str(tmp_path_factory.mktemp('suggest') / 'suggest.json')
+    sys.path.insert(0, os.path.abspath(BACKEND_DIR))
+
+    from app import create_app
+    from db import db
+
+    app = create_app(start_background=False)
+    app.config.update(TESTING=True, SQL_COUNT_HEADER=True)
+    with app.app_context():
+        db.create_all()
+    return app
+
+
+@pytest.fixture(scope='session')
+def authed_client(app):
+    """Returns a function making test clients that send an access token for a user id and role."""
+    from auth import issue_access_token
+
+    def make(user_id=1, role='librarian'):
+        with app.app_context():
+            token = issue_access_token(user_id, role)
+        client = app.test_client()
+        client.environ_base['HTTP_AUTHORIZATION'] = f'Bearer {token}'
+        return client
+
+    return make
@@ -0,0 +1,59 @@
+"""
+Loan listings and delete endpoints run a constant number of SQL statements
+no matter how many loans are involved: each endpoint is called with a small
+and a large loan history and the X-SQL-Count headers must match.
+"""
+from datetime import date, timedelta
+
+import pytest
+
+ENDPOINTS = [
+    ('GET', '/loans/', lambda ids: '/loans/'),
+    ('GET', '/loans/user/<id>', lambda ids: f"/loans/user/{ids['user']}?limit=1000"),
+    ('DELETE', '/books/<id>', lambda ids: f"/books/{ids['book']}"),
+    ('DELETE', '/users/<id>/delete', lambda ids: f"/users/{ids['user']}/delete"),
+]
+
+
+def seed(app, loan_count):
+    """Creates one user and one book with `loan_count` returned loans between them."""
+    from db import db
+    from models import Book, Loan, User
+
+    with app.app_context():
+        db.drop_all()
+        db.create_all()
+        user = User(username='reader', password='x', role='member', email='reader@example.com')
+        book = Book(title='Counting Book', author='Tester', quantity=1)
+        db.session.add_all([user, book])
+        db.session.flush()
+        today = date.today()
+        db.session.add_all([
+            Loan(user_id=user.id, book_id=book.id, title=book.title, loan_date=today,
+                 return_date=today + timedelta(days=30), date_returned=today)
+            for _ in range(loan_count)
+        ])
+        db.session.commit()
+        return {'user': user.id, 'book': book.id}
+
+
+def statement_counts(app, client, loan_count):
+    ids = seed(app, loan_count)
+    counts = {}
+    for method, name, path in ENDPOINTS:
+        response = client.open(path(ids), method=method)
+        assert response.status_code == 200, (name, response.get_json())
+        counts[name] = int(response.headers['X-SQL-Count'])
+    return counts
+
+
+@pytest.fixture(scope='module')
+def counts(app, authed_client):
+    # A fresh token each time: the first request with a token also looks it up in revoked_tokens
+    return statement_counts(app, authed_client(), 2), statement_counts(app, authed_client(), 200)
+
+
+@pytest.mark.parametrize('name', [name for _, name, _ in ENDPOINTS])
+def test_statement_count_does_not_grow_with_loans(counts, name):
+    small, large = counts
+    assert small[name] == large[name]